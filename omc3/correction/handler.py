@@ -28,6 +28,7 @@ from omc3.correction.model_appenders import add_coupling_to_model
 from omc3.correction.response_io import read_fullresponse
 from omc3.model.accelerators.accelerator import Accelerator
 from omc3.utils import logging_tools
+from omc3.utils.contexts import timeit
 from omc3.utils.stats import rms
 
 LOG = logging_tools.get_logger(__name__)
@@ -52,10 +53,13 @@ def correct(accel_inst: Accelerator, opt: DotDict) -> None:
         opt.weights,
     )
 
+    twiss_response = None  # kept to be updated with the model, if `update_response` is given
     if opt.fullresponse_path is not None:
         resp_dict = _load_fullresponse(opt.fullresponse_path, vars_list)
     else:
-        resp_dict = response_twiss.create_response(accel_inst, opt.variable_categories, optics_params)
+        twiss_response = response_twiss.create_twiss_response(accel_inst, opt.variable_categories,
+                                                              opt.float32_response)
+        resp_dict = response_twiss.get_response(twiss_response, optics_params)
 
     # the model in accel_inst is modified later, so save nominal model here to variables
     nominal_model = _maybe_add_coupling_to_model(accel_inst.model, optics_params)
@@ -70,38 +74,45 @@ def correct(accel_inst: Accelerator, opt: DotDict) -> None:
     # ######### Iteration Phase ######### #
     for iteration in range(opt.iterations):
         LOG.info(f"Correction Iteration {iteration+1} of {opt.iterations}.")
-
-        # ######### Update Model and Response ######### #
-        if iteration > 0:
-            LOG.debug("Updating model via MADX.")
-            corr_model_path = opt.output_dir / f"twiss_{iteration}{EXT}"
-
-            corr_model_elements = _create_corrected_model(corr_model_path, [opt.change_params_path], accel_inst)
-            corr_model_elements = _maybe_add_coupling_to_model(corr_model_elements, optics_params)
-
-            bpms_index_mask = accel_inst.get_element_types_mask(corr_model_elements.index, types=["bpm"])
-            corr_model = corr_model_elements.loc[bpms_index_mask, :]
-
-            meas_dict = model_appenders.add_differences_to_model_to_measurements(corr_model, meas_dict)
-
-            if opt.update_response:
-                LOG.debug("Updating response.")
-                # please look away for the next two lines.
-                accel_inst._model = corr_model
-                accel_inst._elements = corr_model_elements
-                resp_dict = response_twiss.create_response(accel_inst, opt.variable_categories, optics_params)
-                resp_dict = filters.filter_response_index(resp_dict, meas_dict, optics_params)
-                resp_matrix = _join_responses(resp_dict, optics_params, vars_list)
-
-        # ######### Actual optimization ######### #
-        delta += _calculate_delta(resp_matrix, meas_dict, optics_params, vars_list, opt.method, method_options)
-
-        # remove unused correctors from vars_list
-        delta, resp_matrix, vars_list = _filter_by_strength(delta, resp_matrix, opt.min_corrector_strength)
-
-        writeparams(opt.change_params_path, delta, "Values to match model to measurement.")
-        writeparams(opt.change_params_correct_path, -delta, "Values to correct the measurement.")
-        LOG.debug(f"Cumulative delta: {np.sum(np.abs(delta.loc[:, DELTA].to_numpy())):.5e}")
+        with timeit(lambda t: LOG.info(f"Time needed for correction iteration {iteration+1}: {t} s")):
+
+            # ######### Update Model and Response ######### #
+            if iteration > 0:
+                LOG.debug("Updating model via MADX.")
+                corr_model_path = opt.output_dir / f"twiss_{iteration}{EXT}"
+
+                corr_model_elements = _create_corrected_model(corr_model_path, [opt.change_params_path], accel_inst)
+                corr_model_elements = _maybe_add_coupling_to_model(corr_model_elements, optics_params)
+
+                bpms_index_mask = accel_inst.get_element_types_mask(corr_model_elements.index, types=["bpm"])
+                corr_model = corr_model_elements.loc[bpms_index_mask, :]
+
+                meas_dict = model_appenders.add_differences_to_model_to_measurements(corr_model, meas_dict)
+
+                if opt.update_response:
+                    LOG.debug("Updating response.")
+                    with timeit(lambda t: LOG.debug(f"  Time updating response: {t} s")):
+                        # please look away for the next two lines.
+                        accel_inst._model = corr_model
+                        accel_inst._elements = corr_model_elements
+                        if twiss_response is None:
+                            twiss_response = response_twiss.create_twiss_response(
+                                accel_inst, opt.variable_categories, opt.float32_response)
+                        else:
+                            twiss_response.update_model(accel_inst)
+                        resp_dict = response_twiss.get_response(twiss_response, optics_params)
+                        resp_dict = filters.filter_response_index(resp_dict, meas_dict, optics_params)
+                        resp_matrix = _join_responses(resp_dict, optics_params, vars_list)
+
+            # ######### Actual optimization ######### #
+            delta += _calculate_delta(resp_matrix, meas_dict, optics_params, vars_list, opt.method, method_options)
+
+            # remove unused correctors from vars_list
+            delta, resp_matrix, vars_list = _filter_by_strength(delta, resp_matrix, opt.min_corrector_strength)
+
+            writeparams(opt.change_params_path, delta, "Values to match model to measurement.")
+            writeparams(opt.change_params_correct_path, -delta, "Values to correct the measurement.")
+            LOG.debug(f"Cumulative delta: {np.sum(np.abs(delta.loc[:, DELTA].to_numpy())):.5e}")
     write_knob(opt.knob_path, delta)
     LOG.info("Finished Iterative Global Correction.")
 
@@ -175,7 +186,7 @@ def _load_fullresponse(full_response_path: Path, variables: Sequence[str]) -> di
     a change of a single quadrupole strength
     """
     LOG.debug("Starting loading Full Response optics")
-    full_response_data = read_fullresponse(full_response_path)
+    full_response_data = read_fullresponse(full_response_path, variables=variables)
 
     # There is a check in read_fullresponse but there all variables need to be present.
     # Here only some. So I leave it like that (jdilly 2021-06-03)
@@ -3,12 +3,21 @@ Response Matrix IO
 ------------------
 
 Input and output functions for response matrices.
+
+The fullresponse is written in a chunked layout: the matrix of each optics parameter is stored
+as compressed array with one row per variable, chunked along the variables,
+next to its index (e.g. BPMs) and columns (variables).
+Reading a subset of the variables therefore only reads and decompresses the chunks containing them.
+Fullresponse files in the older table layout can still be read
+and converted with :func:`convert_fullresponse`.
 """
 from collections import defaultdict
 from pathlib import Path
-from typing import Dict, Sequence, Set
+from typing import Dict, Iterable, List, Sequence, Set, Tuple
 
+import numpy as np
 import pandas as pd
+import tables
 import logging
 
 
@@ -16,13 +25,20 @@ LOG = logging.getLogger(__name__)
 
 COMPLIB = 'blosc'  # zlib is the standard compression
 COMPLEVEL = 9  # goes from 0-9, 9 is highest compression, None deactivates if COMPLIB is None
+CHECKPOINT = 'checkpoint'  # group of the checkpoints in the fullresponse file
+RESPONSE = 'response'  # group of the response matrices in the chunked layout
+VALUES, INDEX, COLUMNS = 'values', 'index', 'columns'  # nodes of a response matrix in the chunked layout
+CHUNK_VARIABLES = 16  # number of variables per chunk in the chunked layout
 
 
 # Fullresponse -----------------------------------------------------------------
 
 
-def read_fullresponse(path: Path, optics_parameters: Sequence[str] = None) -> Dict[str, pd.DataFrame]:
+def read_fullresponse(path: Path, optics_parameters: Sequence[str] = None,
+                      variables: Sequence[str] = None, bpms: Sequence[str] = None) -> Dict[str, pd.DataFrame]:
     """Load the response matrices from disk.
+    Only the given variables (columns) and BPMs (index entries) are loaded, if given.
+    Variables and BPMs not found in the matrices are ignored.
     Beware: As empty DataFrames are skipped on write,
     default for not found entries are empty DataFrames.
     """
@@ -30,27 +46,77 @@ def read_fullresponse(path: Path, optics_parameters: Sequence[str] = None) -> Di
         raise IOError(f"Fullresponse file {str(path)} does not exist.")
 
     LOG.info(f"Loading response matrices from file '{str(path)}'")
-    with pd.HDFStore(path, mode='r') as store:
-        _check_keys(store, optics_parameters, 'fullresponse')
+    fullresponse = defaultdict(pd.DataFrame)
+    if _is_chunked(path):
+        with tables.open_file(path, mode='r') as h5file:
+            groups = {group._v_name: group for group in h5file.get_node(f"/{RESPONSE}")}
+            _check_keys(set(groups), optics_parameters, 'fullresponse')
+            if optics_parameters is None:
+                optics_parameters = groups
+            for p in optics_parameters:
+                fullresponse[p] = _read_chunked_response(groups[p], variables, bpms)
+        return fullresponse
 
-        fullresponse = defaultdict(pd.DataFrame)
+    with pd.HDFStore(path, mode='r') as store:
+        _check_keys(_main_store_groups(store), optics_parameters, 'fullresponse')
         if optics_parameters is None:
             optics_parameters = _main_store_groups(store)
         for p in optics_parameters:
-            fullresponse[p] = store[p]
+            response_df = store[p]
+            fullresponse[p] = response_df.loc[_isin(response_df.index, bpms), _isin(response_df.columns, variables)]
     return fullresponse
 
 
-def write_fullresponse(path: Path, fullresponse: Dict[str, pd.DataFrame]):
-    """Write the full response matrices to disk.
+def write_fullresponse(path: Path, fullresponse: Dict[str, pd.DataFrame], chunked: bool = True):
+    """Write the full response matrices to disk, in the chunked layout or (``chunked=False``)
+    in the older table layout. Checkpoints in the file are removed.
     Beware: Empty Dataframes are skipped! (HDF creates gigantic files otherwise)
     """
     LOG.info(f"Saving response matrices into file '{str(path)}'")
     if path.exists():
         LOG.warning(f"Fullresponse file {str(path)} already exist and will be overwritten.")
-    with pd.HDFStore(path, mode='w', complib=COMPLIB, complevel=COMPLEVEL) as store:
+
+    if not chunked:
+        with pd.HDFStore(path, mode='w', complib=COMPLIB, complevel=COMPLEVEL) as store:
+            for param, response_df in fullresponse.items():
+                store.put(value=response_df, key=param, format="table")
+        return
+
+    filters = tables.Filters(complib=COMPLIB, complevel=COMPLEVEL)
+    with tables.open_file(path, mode='w', filters=filters) as h5file:
+        h5file.create_group("/", RESPONSE)
         for param, response_df in fullresponse.items():
-            store.put(value=response_df, key=param, format="table")
+            if response_df.empty:
+                continue
+            _write_chunked_response(h5file, h5file.create_group(f"/{RESPONSE}", param), response_df)
+
+
+def convert_fullresponse(path: Path, out_path: Path = None):
+    """Convert a fullresponse file (e.g. in the older table layout) into the chunked layout.
+    If no ``out_path`` is given, the file is converted in place.
+    """
+    LOG.info(f"Converting fullresponse file '{str(path)}' to the chunked layout.")
+    write_fullresponse(path if out_path is None else out_path, read_fullresponse(path), chunked=True)
+
+
+def read_response_checkpoints(path: Path) -> Dict[str, pd.DataFrame]:
+    """Load the checkpoints of an unfinished response creation from the response file.
+    Returns an empty dictionary if there is no such file or no checkpoints in it.
+    """
+    if not path.exists():
+        return {}
+
+    with pd.HDFStore(path, mode='r') as store:
+        return {key.split('/')[-1]: store[key] for key in store.keys() if key.split('/')[1] == CHECKPOINT}
+
+
+def write_response_checkpoint(path: Path, name: str, data: pd.DataFrame):
+    """Add a checkpoint of the response creation, e.g. the results of a batch of variables,
+    to the response file. The checkpoints are removed when the full response is written.
+    """
+    LOG.debug(f"Saving checkpoint '{name}' into file '{str(path)}'")
+    with pd.HDFStore(path, mode='a', complib=COMPLIB, complevel=COMPLEVEL) as store:
+        store.put(value=data, key=f"{CHECKPOINT}/{name}", format="table")
 
 
 # Varmap -----------------------------------------------------------------------
@@ -66,7 +132,7 @@ def read_varmap(path: Path, k_values: Sequence[str] = None) -> Dict[str, Dict[st
 
     LOG.info(f"Loading varmap from file '{str(path)}'")
     with pd.HDFStore(path, mode='r') as store:
-        _check_keys(store, k_values, 'varmap')
+        _check_keys(_main_store_groups(store), k_values, 'varmap')
 
         varmap = defaultdict(lambda: defaultdict(pd.Series))
         for key in store.keys():
@@ -91,11 +157,10 @@ def write_varmap(path: Path, varmap: Dict[str, Dict[str, pd.Series]]):
 # Helper -----------------------------------------------------------------------
 
 
-def _check_keys(store: pd.HDFStore, keys: Sequence[str], id:str):
+def _check_keys(groups: Set[str], keys: Sequence[str], id:str):
     if keys is None:
         return
 
-    groups = _main_store_groups(store)
     not_found = [k for k in keys if k not in groups]
     if len(not_found):
         raise ValueError(f"The following keys could not be found in {id} file:"
@@ -103,5 +168,66 @@ def _check_keys(store: pd.HDFStore, keys: Sequence[str], id:str):
 
 
 def _main_store_groups(store: pd.HDFStore) -> Set[str]:
-    """Returns sequence of unique main store groups."""
-    return {k.split('/')[1] for k in store.keys()}
+    """Returns sequence of unique main store groups, without the checkpoints."""
+    return {k.split('/')[1] for k in store.keys()} - {CHECKPOINT}
+
+
+def _is_chunked(path: Path) -> bool:
+    """Checks if the fullresponse file is in the chunked layout."""
+    with tables.open_file(path, mode='r') as h5file:
+        return f"/{RESPONSE}" in h5file
+
+
+def _write_chunked_response(h5file: tables.File, group: tables.Group, response_df: pd.DataFrame):
+    """Write the response matrix transposed, so that the responses to each variable are contiguous,
+    chunked into blocks of variables."""
+    values = np.ascontiguousarray(response_df.to_numpy().T)
+    h5file.create_carray(group, VALUES, obj=values, chunkshape=(min(CHUNK_VARIABLES, values.shape[0]), values.shape[1]))
+    h5file.create_array(group, INDEX, obj=_labels_to_array(response_df.index))
+    h5file.create_array(group, COLUMNS, obj=_labels_to_array(response_df.columns))
+    group._v_attrs.index_name = response_df.index.name
+    group._v_attrs.columns_name = response_df.columns.name
+
+
+def _read_chunked_response(group: tables.Group, variables: Sequence[str] = None,
+                           bpms: Sequence[str] = None) -> pd.DataFrame:
+    """Read the response matrix of the given variables and BPMs from a group of the chunked layout.
+    Only contiguous runs of the selected variables are read from the file."""
+    index = _array_to_labels(group[INDEX].read(), group._v_attrs.index_name)
+    columns = _array_to_labels(group[COLUMNS].read(), group._v_attrs.columns_name)
+
+    positions = np.flatnonzero(_isin(columns, variables))
+    values_node = group[VALUES]
+    values = np.empty((0, index.size), dtype=values_node.dtype)
+    if positions.size:
+        values = np.concatenate([values_node[start:stop] for start, stop in _get_runs(positions)])
+
+    rows = _isin(index, bpms)
+    return pd.DataFrame(data=values[:, rows].T, index=index[rows], columns=columns[positions])
+
+
+def _get_runs(positions: np.ndarray) -> List[Tuple[int, int]]:
+    """Returns the (start, stop) slices of the contiguous runs in the sorted positions."""
+    runs = np.split(positions, np.flatnonzero(np.diff(positions) != 1) + 1)
+    return [(run[0], run[-1] + 1) for run in runs]
+
+
+def _isin(labels: pd.Index, selection: Iterable[str] = None) -> np.ndarray:
+    """Boolean mask of the labels in the selection, all of them if no selection is given."""
+    if selection is None:
+        return np.ones(labels.size, dtype=bool)
+    return labels.isin(selection)
+
+
+def _labels_to_array(labels: pd.Index) -> np.ndarray:
+    """Convert index labels to an array storable in HDF5, i.e. string labels to utf-8 bytes."""
+    if labels.dtype == object:
+        return np.char.encode(labels.to_numpy(dtype=str), "utf-8")
+    return labels.to_numpy()
+
+
+def _array_to_labels(array: np.ndarray, name: str = None) -> pd.Index:
+    """Convert an array of stored labels back to an index."""
+    if array.dtype.kind == "S":
+        return pd.Index(np.char.decode(array, "utf-8").astype(object), name=name)
+    return pd.Index(array, name=name)
@@ -9,23 +9,29 @@ The variables under investigation need to be provided as a list (which can be ob
 class).
 
 For now, the response matrix is stored in a hdf5 file.
+The variables are run in small batches of MAD-X jobs, distributed dynamically over the processes.
+The results of finished batches can be checkpointed into this file, to resume interrupted runs.
+The twiss tables of the jobs are restricted to the columns needed for the responses and
+collected directly into one array, from which the response matrices are calculated.
 
 :author: Lukas Malina, Joschua Dilly, Jaime (...) Coello de Portugal
 """
-import copy
+import hashlib
 import multiprocessing
+import time
+from contextlib import suppress
 from pathlib import Path
 from typing import Dict, Sequence, Tuple, List
 
 import numpy as np
 import pandas as pd
-import tfs
 from optics_functions.coupling import coupling_via_cmatrix
 
 import omc3.madx_wrapper as madx_wrapper
-from omc3.optics_measurements.constants import (BETA, DISPERSION, F1001, F1010,
+from omc3.optics_measurements.constants import (ALPHA, BETA, DISPERSION, F1001, F1010, NAME,
                                        NORM_DISPERSION, PHASE_ADV, TUNE, PHASE)
 from omc3.correction.constants import INCR
+from omc3.correction.response_io import read_response_checkpoints, write_response_checkpoint
 from omc3.model.accelerators.accelerator import Accelerator, AccElementTypes
 from omc3.utils import logging_tools
 from omc3.utils.contexts import suppress_warnings, timeit
@@ -35,23 +41,46 @@ LOG = logging_tools.get_logger(__name__)
 
 # Full Response Mad-X ##########################################################
 
+NOMINAL = "0"  # name of the twiss without changed variables
+VARIABLE = "VARIABLE"
+BATCH = "batch"  # prefix of the checkpoint names, followed by the batch index
+FINGERPRINT = "fingerprint"  # checkpoint identifying the run the checkpoints belong to
+BATCHES_PER_PROCESS = 4  # default number of batches per process, balances MAD-X startup and load
+TWISS_COLUMNS = [NAME, f"{BETA}X", f"{ALPHA}X", f"{BETA}Y", f"{ALPHA}Y", f"{DISPERSION}X", f"{DISPERSION}Y",
+                 f"{PHASE_ADV}X", f"{PHASE_ADV}Y", "R11", "R12", "R21", "R22"]  # columns needed for the responses
+RESULT_COLUMNS = [f"{PHASE_ADV}X", f"{PHASE_ADV}Y", f"{BETA}X", f"{BETA}Y", f"{DISPERSION}X", f"{DISPERSION}Y",
+                  f"{F1001}R", f"{F1001}I", f"{F1010}R", f"{F1010}I", f"{TUNE}1", f"{TUNE}2", INCR]
+
 
 def create_fullresponse(
     accel_inst: Accelerator,
     variable_categories: Sequence[str],
     delta_k: float = 2e-5,
     num_proc: int = multiprocessing.cpu_count(),
-    temp_dir: Path = None
+    temp_dir: Path = None,
+    batch_size: int = None,
+    checkpoint_path: Path = None,
 ) -> Dict[str, pd.DataFrame]:
     """ Generate a dictionary containing response matrices for
         beta, phase, dispersion, tune and coupling and saves it to a file.
 
+        The variables are split into small batches, each run in its own MAD-X job.
+        The jobs are handed to the processes whenever one is free, so that slow batches
+        do not stall the others. The results of each finished batch can be stored as checkpoint
+        in the response file, from which an interrupted run is resumed.
+
         Args:
             accel_inst : Accelerator Instance.
             variable_categories (list): Categories of the variables/knobs to use. (from .json)
             delta_k (float): delta K1L to be applied to quads for sensitivity matrix
             num_proc (int): Number of processes to use in parallel.
             temp_dir (str): temporary directory. If ``None``, uses folder of original_jobfile.
+            batch_size (int): Number of variables per MAD-X job.
+                If ``None``, the variables are split into about four batches per process.
+            checkpoint_path (Path): Response file to store the results of the finished batches in.
+                Variables found in its checkpoints are not run again.
+                Checkpoints of a run with a different model, MAD-X job, variables or delta_k are refused.
+                The checkpoints are removed when the fullresponse is written into this file.
     """
     LOG.debug("Generating Fullresponse via Mad-X.")
     with timeit(lambda t: LOG.debug(f"  Total time generating fullresponse: {t} s")):
@@ -62,52 +91,118 @@ def create_fullresponse(
         variables = accel_inst.get_variables(classes=variable_categories)
         if len(variables) == 0:
             raise ValueError("No variables found! Make sure your categories are valid!")
-        num_proc = num_proc if len(variables) > num_proc else len(variables)
-        process_pool = multiprocessing.Pool(processes=num_proc)
 
-        incr_dict = _generate_madx_jobs(accel_inst, variables, delta_k, num_proc, temp_dir)
-        _call_madx(process_pool, temp_dir, num_proc)
-        _clean_up(temp_dir, num_proc)
-
-        var_to_twiss = _load_madx_results(variables, process_pool, incr_dict, temp_dir)
-        fullresponse = _create_fullresponse_from_dict(var_to_twiss)
+        results = _ResultsArray(list(variables) + [NOMINAL])
+        fingerprint = _get_fingerprint(accel_inst, variables, delta_k)
+        first_index = _load_checkpoints(checkpoint_path, results, fingerprint)
+        remaining = [var for var in [NOMINAL] + list(variables) if var not in results.done]
+        if len(remaining):
+            batches = _get_batches(remaining, batch_size, num_proc)
+            jobs = _generate_madx_jobs(accel_inst, batches, delta_k, temp_dir, first_index=first_index)
+            _run_madx_jobs(jobs, num_proc, temp_dir, results, checkpoint_path)
 
+        fullresponse = _create_fullresponse_from_array(results.data, results.bpms, results.keys)
     return fullresponse
 
 
+class _ResultsArray:
+    """ Collects the results of the MAD-X runs into one preallocated array.
+
+    The array has the shape (columns, bpms, runs), with the columns as in ``RESULT_COLUMNS``
+    and the runs in the order of ``keys``. It is allocated when the first results arrive,
+    as only then the BPMs are known.
+    """
+    def __init__(self, keys: Sequence[str]):
+        self.keys = list(keys)
+        self.bpms = None
+        self.data = None
+        self.done = set()
+        self._positions = {key: idx for idx, key in enumerate(self.keys)}
+
+    def add(self, batch_results: pd.DataFrame) -> None:
+        """ Write the results of a batch into the array, ignoring runs not in ``keys``. """
+        variables = batch_results.index.unique(level=VARIABLE)
+        bpms = batch_results.index.unique(level=NAME)
+        if self.data is None:
+            self.bpms = bpms
+            self.data = np.empty((len(RESULT_COLUMNS), bpms.size, len(self.keys)))
+        elif not bpms.equals(self.bpms) or len(batch_results) != len(variables) * bpms.size:
+            raise ValueError("The twiss tables of the MAD-X runs contain different BPMs.")
+
+        values = batch_results.loc[:, RESULT_COLUMNS].to_numpy().reshape(len(variables), bpms.size, -1)
+        for var, var_values in zip(variables, values):
+            if var in self._positions:
+                self.data[:, :, self._positions[var]] = var_values.T
+                self.done.add(var)
+
+
+def _get_fingerprint(accel_inst: Accelerator, variables: Sequence[str], delta_k: float) -> str:
+    """ Hash identifying a run by its model directory, MAD-X job, variables and delta_k. """
+    content = "\n".join([str(Path(accel_inst.model_dir).absolute()), _get_madx_job(accel_inst),
+                         *variables, f"{delta_k:.15e}"])
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def _load_checkpoints(checkpoint_path: Path, results: _ResultsArray, fingerprint: str) -> int:
+    """ Add the results of the runs found in the checkpoints and return the first unused batch index.
+    As the batches finish in any order, the indices of the checkpoints can have gaps.
+    Without checkpoints, the fingerprint of this run is stored for the checkpoints to come. """
+    if checkpoint_path is None:
+        return 0
+
+    checkpoints = read_response_checkpoints(checkpoint_path)
+    stored_fingerprint = checkpoints.pop(FINGERPRINT, None)
+    if not len(checkpoints):
+        write_response_checkpoint(checkpoint_path, FINGERPRINT, pd.DataFrame({FINGERPRINT: [fingerprint]}))
+        return 0
+
+    if stored_fingerprint is None or stored_fingerprint[FINGERPRINT].iloc[0] != fingerprint:
+        raise ValueError(f"The checkpoints in '{checkpoint_path}' were created for a different model, "
+                         "MAD-X job, variables or delta_k. Please remove them or run with the same settings.")
+
+    for batch_results in checkpoints.values():
+        results.add(batch_results)
+
+    if len(results.done):
+        LOG.info(f"Resuming from checkpoints in '{checkpoint_path}': "
+                 f"{len(results.done)} of {len(results.keys)} MAD-X runs already done.")
+    return max((int(name[len(BATCH):]) for name in checkpoints), default=-1) + 1
+
+
+def _get_batches(variables: Sequence[str], batch_size: int, num_proc: int) -> List[List[str]]:
+    """ Split the variables into batches, each to be run in one MAD-X job. """
+    if batch_size is None:
+        batch_size = int(np.ceil(len(variables) / (BATCHES_PER_PROCESS * num_proc)))
+    return [variables[idx:idx + batch_size] for idx in range(0, len(variables), batch_size)]
+
+
 def _generate_madx_jobs(
     accel_inst: Accelerator,
-    variables: Sequence[str],
+    batches: Sequence[Sequence[str]],
     delta_k: float,
-    num_proc: int,
-    temp_dir: Path
-) -> Dict[str, float]:
-    """ Generates madx job-files """
+    temp_dir: Path,
+    first_index: int = 0,
+) -> List[Tuple[int, Path, List[str], float]]:
+    """ Generates madx job-files, one per batch, and returns the jobs for the process pool. """
     LOG.debug("Generating MADX jobfiles.")
-    incr_dict = {'0': 0.0}
-    vars_per_proc = int(np.ceil(len(variables) / num_proc))
-
     madx_job = _get_madx_job(accel_inst)
 
-    for proc_idx in range(num_proc):
-        jobfile_path = _get_jobfiles(temp_dir, proc_idx)
+    jobs = []
+    for index, batch in enumerate(batches, start=first_index):
+        jobfile_path = _get_jobfiles(temp_dir, index)
 
         current_job = madx_job
-        for i in range(vars_per_proc):
-            var_idx = proc_idx * vars_per_proc + i
-            if var_idx >= len(variables):
-                break
-            var = variables[var_idx]
-            incr_dict[var] = delta_k
+        for var in batch:
+            if var == NOMINAL:
+                current_job += f"twiss, file='{str(temp_dir / f'twiss.{NOMINAL}')}';\n\n"
+                continue
             current_job += f"{var} = {var}{delta_k:+.15e};\n"
             current_job += f"twiss, file='{str(temp_dir / f'twiss.{var}')}';\n"
             current_job += f"{var} = {var}{-delta_k:+.15e};\n\n"
 
-        if proc_idx == num_proc - 1:
-            current_job += f"twiss, file='{str(temp_dir / 'twiss.0')}';\n"
-
         jobfile_path.write_text(current_job)
-    return incr_dict
+        jobs.append((index, jobfile_path, list(batch), delta_k))
+    return jobs
 
 
 def _get_madx_job(accel_inst: Accelerator) -> str:
@@ -118,66 +213,69 @@ def _get_madx_job(accel_inst: Accelerator) -> str:
     job_content += (
         "select, flag=twiss, clear;\n"
         f"select, flag=twiss, pattern='{accel_inst.RE_DICT[AccElementTypes.BPMS]}', "
-        "column=NAME,S,BETX,ALFX,BETY,ALFY,DX,DY,DPX,DPY,X,Y,K1L,MUX,MUY,R11,R12,R21,R22;\n\n")
+        f"column={','.join(TWISS_COLUMNS)};\n\n")
     return job_content
 
 
-def _call_madx(process_pool: multiprocessing.Pool, temp_dir: str, num_proc: int) -> None:
-    """ Call madx in parallel """
-    LOG.debug(f"Starting {num_proc:d} MAD-X jobs...")
-    madx_jobs = [_get_jobfiles(temp_dir, index) for index in range(num_proc)]
-    process_pool.map(_launch_single_job, madx_jobs)
+def _run_madx_jobs(
+    jobs: Sequence[Tuple[int, Path, List[str], float]],
+    num_proc: int,
+    temp_dir: Path,
+    results: _ResultsArray,
+    checkpoint_path: Path = None,
+) -> None:
+    """ Run the MAD-X jobs in parallel, each as soon as a process is free,
+    and collect (and checkpoint) the results of each batch as it finishes. """
+    n_runs = sum(len(job[2]) for job in jobs)
+    LOG.debug(f"Starting {len(jobs):d} MAD-X jobs for {n_runs:d} runs on {num_proc:d} processes...")
+    n_runs_done = 0
+    start_time = time.time()
+    try:
+        with multiprocessing.Pool(processes=min(num_proc, len(jobs))) as process_pool, \
+                open(temp_dir / "response_madx_full.log", "w") as full_log:
+            for n_done, (index, batch_results, log) in enumerate(
+                    process_pool.imap_unordered(_run_single_batch, jobs), start=1):
+                full_log.write(log)
+                if checkpoint_path is not None:
+                    write_response_checkpoint(checkpoint_path, f"{BATCH}{index:d}", batch_results)
+                results.add(batch_results)
+                n_runs_done += batch_results.index.unique(level=VARIABLE).size
+
+                elapsed = time.time() - start_time
+                rate = n_runs_done / elapsed
+                LOG.info(f"  MAD-X job {n_done:d}/{len(jobs):d} done: {n_runs_done:d}/{n_runs:d} runs "
+                         f"in {elapsed:.1f} s ({rate:.2f} runs/s, ~{(n_runs - n_runs_done) / rate:.0f} s left).")
+    finally:
+        for _, jobfile_path, _, _ in jobs:
+            with suppress(FileNotFoundError):
+                jobfile_path.unlink()
     LOG.debug("MAD-X jobs done.")
 
 
-def _clean_up(temp_dir: Path, num_proc: int) -> None:
-    """ Merge Logfiles and clean temporary outputfiles """
-    LOG.debug("Cleaning output and building log...")
-    full_log = ""
-    for index in range(num_proc):
-        job_path = _get_jobfiles(temp_dir, index)
-        log_path = job_path.with_name(f"{job_path.name}.log")
-        full_log += log_path.read_text()
-        log_path.unlink()
-        job_path.unlink()
-    full_log_path = temp_dir / "response_madx_full.log"
-    full_log_path.write_text(full_log)
-
-
-def _load_madx_results(
-    variables: List[str],
-    process_pool: multiprocessing.Pool,
-    incr_dict: dict,
-    temp_dir: Path
-) -> Dict[str, tfs.TfsDataFrame]:
-    """ Load the madx results in parallel and return var-tfs dictionary """
-    LOG.debug("Loading Madx Results.")
-    vars_and_paths = []
-    for value in variables + ['0']:
-        vars_and_paths.append((value, temp_dir))
-    var_to_twiss = {}
-    for var, tfs_data in process_pool.map(_load_and_remove_twiss, vars_and_paths):
-        tfs_data[INCR] = incr_dict[var]
-        var_to_twiss[var] = tfs_data
-    return var_to_twiss
-
-
-def _create_fullresponse_from_dict(var_to_twiss: Dict[str, tfs.TfsDataFrame]) -> Dict[str, pd.DataFrame]:
-    """ Convert var-tfs dictionary to fullresponse dictionary. """
-    var_to_twiss = _add_coupling(var_to_twiss)
-    keys = list(var_to_twiss.keys())
-
-    columns = [f"{PHASE_ADV}X", f"{PHASE_ADV}Y", f"{BETA}X", f"{BETA}Y", f"{DISPERSION}X", f"{DISPERSION}Y",
-               f"{F1001}R", f"{F1001}I", f"{F1010}R", f"{F1010}I", f"{TUNE}1", f"{TUNE}2", INCR]
-
-    bpms = var_to_twiss["0"].index
-    resp = np.empty((len(keys), bpms.size, len(columns)))
-    
-    for i, key in enumerate(keys):
-        resp[i] = var_to_twiss[key].loc[:, columns].to_numpy()
+def _run_single_batch(job: Tuple[int, Path, List[str], float]) -> Tuple[int, pd.DataFrame, str]:
+    """ Function for pool to run the MAD-X job of a batch and retrieve its results and log """
+    index, jobfile_path, variables, delta_k = job
+    _launch_single_job(jobfile_path)
+
+    log_path = jobfile_path.with_name(f"{jobfile_path.name}.log")
+    log = log_path.read_text()
+    log_path.unlink()
 
-    resp = resp.transpose(2, 1, 0)
-    model_index = list(keys).index("0")
+    batch_twiss = pd.concat(
+        dict(_load_and_remove_twiss((var, jobfile_path.parent)) for var in variables),
+        names=[VARIABLE, NAME],
+    )
+    batch_twiss = _add_coupling(batch_twiss)
+    batch_twiss[INCR] = np.where(batch_twiss.index.get_level_values(VARIABLE) == NOMINAL, 0.0, delta_k)
+    return index, batch_twiss.loc[:, RESULT_COLUMNS], log
+
+
+def _create_fullresponse_from_array(resp: np.ndarray, bpms: pd.Index, keys: Sequence[str]) -> Dict[str, pd.DataFrame]:
+    """ Convert the results array (columns, bpms, runs) to fullresponse dictionary.
+    The array is modified in place. """
+    keys = list(keys)
+    columns = RESULT_COLUMNS
+    model_index = list(keys).index(NOMINAL)
 
     # create normalized dispersion and dividing BET by nominal model
     NDX_arr = np.divide(resp[columns.index(f"{DISPERSION}X")], np.sqrt(resp[columns.index(f"{BETA}X")]))
@@ -198,7 +296,7 @@ def _create_fullresponse_from_dict(var_to_twiss: Dict[str, tfs.TfsDataFrame]) ->
     resp = np.delete(resp, model_index, axis=2)
     NDX_arr = np.delete(NDX_arr, model_index, axis=1)
     NDY_arr = np.delete(NDY_arr, model_index, axis=1)
-    keys.remove("0")
+    keys.remove(NOMINAL)
 
     NDX_arr = np.divide(NDX_arr, resp[columns.index(f"{INCR}")])
     NDY_arr = np.divide(NDY_arr, resp[columns.index(f"{INCR}")])
@@ -234,35 +332,74 @@ def _launch_single_job(inputfile_path: Path) -> None:
     madx_wrapper.run_file(inputfile_path, log_file=log_file, cwd=inputfile_path.parent)
 
 
-def _load_and_remove_twiss(var_and_path: Tuple[str, Path]) -> Tuple[str, tfs.TfsDataFrame]:
+def _load_and_remove_twiss(var_and_path: Tuple[str, Path]) -> Tuple[str, pd.DataFrame]:
     """ Function for pool to retrieve results """
     (var, path) = var_and_path
     twissfile = path / f"twiss.{var}"
-    tfs_data = tfs.read(twissfile, index="NAME")
-    tfs_data[f"{TUNE}1"] = tfs_data.Q1
-    tfs_data[f"{TUNE}2"] = tfs_data.Q2
+    twiss = _read_twiss(twissfile)
     twissfile.unlink()
-    return var, tfs_data
+    return var, twiss
+
+
+def _read_twiss(twiss_path: Path) -> pd.DataFrame:
+    """
+    Reads the ``TWISS_COLUMNS`` of a twiss table written by MAD-X, with the tunes as columns.
+
+    Only the header lines are parsed in python, to find the tunes and the column names.
+    The table itself is parsed by the c-engine of ``pandas.read_csv`` straight into
+    float columns, skipping the header parsing and validation of ``tfs.read``.
+
+    Args:
+        twiss_path (Path): Path to the twiss file.
+
+    Returns:
+        DataFrame of the twiss columns indexed by ``NAME``, with the tune columns added.
+    """
+    tunes, column_names, n_lines = {}, None, 0
+    with open(twiss_path) as twiss_file:
+        for n_lines, line in enumerate(twiss_file, start=1):
+            if line.startswith("@"):
+                _, header, _, value = line.split(maxsplit=3)
+                if header in ("Q1", "Q2"):
+                    tunes[f"{TUNE}{header[-1]}"] = float(value)
+            elif line.startswith("*"):
+                column_names = line.split()[1:]
+            elif line.startswith("$"):
+                break
+
+    if column_names is None or len(tunes) != 2:
+        raise IOError(f"Could not find the column names and tunes in twiss file '{twiss_path}'.")
+
+    twiss = pd.read_csv(
+        twiss_path,
+        engine="c",
+        skiprows=n_lines,
+        sep=r"\s+",
+        quotechar='"',
+        names=column_names,
+        usecols=TWISS_COLUMNS,
+        index_col=NAME,
+        dtype={column: np.float64 for column in TWISS_COLUMNS if column != NAME},
+    )
+    return twiss.assign(**tunes)
 
 
-def _add_coupling(dict_of_tfs: Dict[str, tfs.TfsDataFrame]) -> Dict[str, tfs.TfsDataFrame]:
+def _add_coupling(twiss: pd.DataFrame) -> pd.DataFrame:
     """
-    For each TfsDataFrame in the input dictionary, computes the coupling RDTs and adds a column for
-    the real and imaginary parts of the computed coupling RDTs. Returns a copy of the input dictionary with
-    the aforementioned computed columns added for each TfsDataFrame.
+    Computes the coupling RDTs of the (possibly stacked) twiss dataframe and returns a copy with columns
+    for the real and imaginary parts of the computed coupling RDTs added.
 
     Args:
-        dict_of_tfs (Dict[str, tfs.TfsDataFrame]): dictionary of Twiss dataframes.
+        twiss (pd.DataFrame): Twiss dataframe, e.g. of all runs of a batch.
 
     Returns:
-        An identical dictionary of Twiss dataframes, with the computed columns added.
+        A copy of the Twiss dataframe, with the computed columns added.
     """
-    result_dict_of_tfs = copy.deepcopy(dict_of_tfs)
     with timeit(lambda elapsed: LOG.debug(f"  Time adding coupling: {elapsed} s")):
-        for var, tfs_dframe in result_dict_of_tfs.items():  # already copies, so it's safe to act on them
-            coupling_rdts_df = coupling_via_cmatrix(tfs_dframe)
-            tfs_dframe[f"{F1001}R"] = np.real(coupling_rdts_df[f"{F1001}"]).astype(np.float64)
-            tfs_dframe[f"{F1001}I"] = np.imag(coupling_rdts_df[f"{F1001}"]).astype(np.float64)
-            tfs_dframe[f"{F1010}R"] = np.real(coupling_rdts_df[f"{F1010}"]).astype(np.float64)
-            tfs_dframe[f"{F1010}I"] = np.imag(coupling_rdts_df[f"{F1010}"]).astype(np.float64)
-        return result_dict_of_tfs
+        coupling_rdts_df = coupling_via_cmatrix(twiss, output=("rdts",))
+        return twiss.assign(**{
+            f"{F1001}R": np.real(coupling_rdts_df[f"{F1001}"]).astype(np.float64),
+            f"{F1001}I": np.imag(coupling_rdts_df[f"{F1001}"]).astype(np.float64),
+            f"{F1010}R": np.real(coupling_rdts_df[f"{F1010}"]).astype(np.float64),
+            f"{F1010}I": np.imag(coupling_rdts_df[f"{F1010}"]).astype(np.float64),
+        })
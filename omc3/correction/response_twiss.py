@@ -135,6 +135,7 @@ LOG = logging_tools.get_logger(__name__)
 
 DUMMY_ID = "DUMMY_PLACEHOLDER"
 PLANES = ("X", "Y")
+MODEL_COLUMNS = [f"{col}{plane}" for col in (BETA, PHASE_ADV, DISPERSION) for plane in PLANES]
 
 # Twiss Response Class ########################################################
 
@@ -151,6 +152,9 @@ class TwissResponse:
             'bpms': All BPMS (Default)
             'bpms+': BPMS+ used magnets (== magnets defined by variables in varfile)
             'all': All BPMS and Magnets given in the model (Markers are removed)
+        float32 (bool): Calculate the responses of the elements in single precision,
+            to reduce the memory needed for large models.
+            The responses mapped to the variables are still returned in double precision.
 
     """
 
@@ -158,41 +162,67 @@ class TwissResponse:
     #            INIT
     ################################
 
-    def __init__(self, accel_inst, variable_categories, varmap_or_path, at_elements="bpms"):
+    def __init__(self, accel_inst, variable_categories, varmap_or_path, at_elements="bpms", float32=False):
 
         LOG.debug("Initializing TwissResponse.")
         with timeit(lambda t: LOG.debug(f"  Time initializing TwissResponse: {t} s")):
             # Get input
+            self._dtype = np.float32 if float32 else np.float64
             self._twiss = self._get_model_twiss(accel_inst)
+            self._set_model_precision()
             self._beam_sign = 1 if getattr(accel_inst, "beam", 1) == 1 else -1
             self._variables = accel_inst.get_variables(classes=variable_categories)
             self._var_to_el = self._get_variable_mapping(varmap_or_path)
             self._elements_in = self._get_input_elements()
             self._elements_out = self._get_output_elements(at_elements)
 
-            # calculate all phase advances
-            self._phase_advances = get_phase_advances(self._twiss)
-
-            # All responses are calcluated as needed, see getters below!
-            # slots for response matrices
-            self._beta = None
-            self._dispersion = None
-            self._phase = None
-            self._phase_adv = None
-            self._tune = None
-            self._coupling = None
-            self._beta_beat = None
-            self._norm_dispersion = None
-
-            # slots for mapped response matrices
-            self._coupling_mapped = None
-            self._beta_mapped = None
-            self._dispersion_mapped = None
-            self._phase_mapped = None
-            self._phase_adv_mapped = None
-            self._tune_mapped = None
-            self._beta_beat_mapped = None
-            self._norm_dispersion_mapped = None
+            # model independent structures, created as needed and kept on model updates
+            self._mapping_matrices = {}
+
+            self._reset_responses()
+
+    def _reset_responses(self):
+        """ Empties the slots of the (mapped) response matrices. """
+        # All responses are calcluated as needed, see getters below!
+        # slots for response matrices
+        self._beta = None
+        self._dispersion = None
+        self._phase = None
+        self._phase_adv = None
+        self._tune = None
+        self._coupling = None
+        self._beta_beat = None
+        self._norm_dispersion = None
+
+        # slots for mapped response matrices
+        self._coupling_mapped = None
+        self._beta_mapped = None
+        self._dispersion_mapped = None
+        self._phase_mapped = None
+        self._phase_adv_mapped = None
+        self._tune_mapped = None
+        self._beta_beat_mapped = None
+        self._norm_dispersion_mapped = None
+
+    def update_model(self, accel_inst):
+        """Updates the model dependent terms, i.e. the optics functions, phases and tunes,
+        from the elements model of the given accelerator instance.
+        The variables, their mapping onto the elements and the in- and output elements are kept,
+        so all of these elements need to be present in the new model.
+        The responses are recalculated the next time they are requested.
+
+        Args:
+            accel_inst (accelerator): Accelerator Instance, containing the updated elements model.
+        """
+        LOG.debug("Updating model of TwissResponse.")
+        with timeit(lambda t: LOG.debug(f"  Time updating TwissResponse: {t} s")):
+            model = accel_inst.elements
+            twiss = self._twiss
+            elements = twiss.index.drop(DUMMY_ID)
+            columns = [col for col in MODEL_COLUMNS if col in twiss.columns and col in model.columns]
+            twiss.loc[elements, columns] = model.loc[elements, columns].to_numpy(dtype=self._dtype)
+            twiss.headers.update({tune: model.headers[tune] for tune in ("Q1", "Q2")})
+            self._reset_responses()
 
     @staticmethod
     def _get_model_twiss(accel_inst):
@@ -208,6 +238,11 @@ class TwissResponse:
         model.loc[DUMMY_ID, [f"{S}", f"{PHASE_ADV}X", f"{PHASE_ADV}Y"]] = 0.0
         return model
 
+    def _set_model_precision(self):
+        """ Converts the optics columns of the model to the precision used in the calculations. """
+        columns = [col for col in MODEL_COLUMNS if col in self._twiss.columns]
+        self._twiss[columns] = self._twiss[columns].astype(self._dtype)
+
     def _get_variable_mapping(self, varmap_or_path):
         """Get variable mapping as dictionary
 
@@ -283,6 +318,38 @@ class TwissResponse:
             # all, obviously
             return [idx for idx in tw_idx if idx != DUMMY_ID]
 
+    ################################
+    #     Phase Advance Blocks
+    ################################
+
+    def _get_phase_advances(self, plane, elements_in, elements_out):
+        """Phase advances DPhi(i,j) = Phi(j) - Phi(i) from elements_in (i) to elements_out (j).
+
+        Only the needed blocks are calculated,
+        as the matrix of all elements exceeds memory space for large models.
+        """
+        phases_in = self._twiss.loc[elements_in, f"{PHASE_ADV}{plane}"].to_numpy()
+        phases_out = self._twiss.loc[elements_out, f"{PHASE_ADV}{plane}"].to_numpy()
+        return pd.DataFrame(phases_out[None, :] - phases_in[:, None], index=elements_in, columns=elements_out)
+
+    def _get_dphi(self, plane, elements_in, elements_out):
+        """ dphi of the phase advances from elements_in to elements_out """
+        return dphi(self._get_phase_advances(plane, elements_in, elements_out), self._get_tune(plane))
+
+    def _get_tau(self, plane, elements_in, elements_out):
+        """ tau of the phase advances from elements_in to elements_out """
+        return tau(self._get_phase_advances(plane, elements_in, elements_out), self._get_tune(plane))
+
+    def _get_tune(self, plane):
+        """ Tune in the precision of the phase advances, so that dphi and tau keep it. """
+        return self._dtype(self._twiss.Q1 if plane == "X" else self._twiss.Q2)
+
+    def _get_s_order(self, elements_in, elements_out):
+        """Matrix pi(i,j) = s(i) < s(j) from elements_in (i) to elements_out (j)."""
+        s_in = self._twiss.loc[elements_in, f"{S}"].to_numpy()
+        s_out = self._twiss.loc[elements_out, f"{S}"].to_numpy()
+        return (s_in[:, None] < s_out[None, :]).astype(self._dtype)
+
     ################################
     #       Response Matrix
     ################################
@@ -292,14 +359,13 @@ class TwissResponse:
         LOG.debug("Calculate Coupling Matrix")
         with timeit(lambda t: LOG.debug(f"  Time needed: {t} s")):
             tw = self._twiss
-            adv = self._phase_advances
             el_out = self._elements_out
             k1s_el = self._elements_in["K1SL"]
             dcoupl = dict.fromkeys(["1001", "1010"])
 
             i2pi = 2j * np.pi
-            phx = dphi(adv["X"].loc[k1s_el, el_out], tw.Q1).to_numpy()
-            phy = dphi(adv["Y"].loc[k1s_el, el_out], tw.Q2).to_numpy()
+            phx = self._get_dphi("X", k1s_el, el_out).to_numpy()
+            phy = self._get_dphi("Y", k1s_el, el_out).to_numpy()
             bet_term = np.sqrt(tw.loc[k1s_el, f"{BETA}X"].to_numpy() * tw.loc[k1s_el, f"{BETA}Y"].to_numpy())
 
             for coupling_rdt in ["1001", "1010"]:
@@ -315,7 +381,6 @@ class TwissResponse:
         LOG.debug("Calculate Beta Response Matrix")
         with timeit(lambda t: LOG.debug(f"  Time needed: {t} s")):
             tw = self._twiss
-            adv = self._phase_advances
             el_out = self._elements_out
             k1_el = self._elements_in["K1L"]
             dbeta = dict.fromkeys(PLANES)
@@ -325,7 +390,7 @@ class TwissResponse:
                 q = tw.Q1 if plane == "X" else tw.Q2
                 coeff_sign = -1 if plane == "X" else 1
 
-                pi2tau = 2 * np.pi * tau(adv[plane].loc[k1_el, el_out], q)
+                pi2tau = 2 * np.pi * self._get_tau(plane, k1_el, el_out)
 
                 dbeta[plane] = pd.DataFrame(
                     tw.loc[el_out, col_beta].to_numpy()[None, :]
@@ -343,7 +408,6 @@ class TwissResponse:
         LOG.debug("Calculate Dispersion Response Matrix")
         with timeit(lambda t: LOG.debug(f"  Time needed: {t} s")):
             tw = self._twiss
-            adv = self._phase_advances
             el_out = self._elements_out
             els_in = self._elements_in
 
@@ -371,7 +435,7 @@ class TwissResponse:
                     out_str = f"{plane}_{el_type}"
 
                     if len(el_in):
-                        pi2tau = 2 * np.pi * tau(adv[plane].loc[el_in, el_out], q)
+                        pi2tau = 2 * np.pi * self._get_tau(plane, el_in, el_out)
                         bet_term = np.sqrt(tw.loc[el_in, col_beta])
 
                         try:
@@ -395,7 +459,6 @@ class TwissResponse:
         LOG.debug("Calculate Normalized Dispersion Response Matrix")
         with timeit(lambda t: LOG.debug(f"  Time needed: {t} s")):
             tw = self._twiss
-            adv = self._phase_advances
             el_out = self._elements_out
             els_in = self._elements_in
 
@@ -427,7 +490,7 @@ class TwissResponse:
                     out_str = "{p:s}_{t:s}".format(p=plane, t=el_type)
 
                     if len(el_in):
-                        pi2tau = 2 * np.pi * tau(adv[plane].loc[el_in, el_out], q)
+                        pi2tau = 2 * np.pi * self._get_tau(plane, el_in, el_out)
                         beta_in = tw.loc[el_in, col_beta]
                         bet_term = np.sqrt(beta_in)
 
@@ -471,7 +534,6 @@ class TwissResponse:
         LOG.debug("Calculate Phase Advance Response Matrix")
         with timeit(lambda elapsed: LOG.debug(f"  Time needed: {elapsed} s")):
             tw = self._twiss
-            adv = self._phase_advances
             k1_el = self._elements_in["K1L"]
 
             el_out_all = [DUMMY_ID] + self._elements_out  # Add MU[XY] = 0.0 to the start
@@ -481,13 +543,10 @@ class TwissResponse:
             if len(k1_el) > 0:
                 dmu = dict.fromkeys(PLANES)
 
-                pi = pd.DataFrame(tw[f"{S}"].to_numpy()[:, None] < tw[f"{S}"].to_numpy()[None, :],  # pi(i,j) = s(i) < s(j)
-                                      index=tw.index, columns=tw.index, dtype=int)
-
                 pi_term = (
-                    pi.loc[k1_el, el_out].to_numpy()
-                    - pi.loc[k1_el, el_out_mm].to_numpy()
-                    + np.diag(pi.loc[el_out, el_out_mm].to_numpy())[None, :]
+                    self._get_s_order(k1_el, el_out)
+                    - self._get_s_order(k1_el, el_out_mm)
+                    + (tw.loc[el_out, f"{S}"].to_numpy() < tw.loc[el_out_mm, f"{S}"].to_numpy())[None, :]
                 )
 
                 for plane in PLANES:
@@ -495,7 +554,7 @@ class TwissResponse:
                     q = tw.Q1 if plane == "X" else tw.Q2
                     coeff_sign = 1 if plane == "X" else -1
 
-                    pi2tau = 2 * np.pi * tau(adv[plane].loc[k1_el, el_out_all], q)
+                    pi2tau = 2 * np.pi * self._get_tau(plane, k1_el, el_out_all)
                     brackets = 2 * pi_term + (
                         (np.sin(2 * pi2tau.loc[:, el_out].to_numpy())
                          - np.sin(2 * pi2tau.loc[:, el_out_mm].to_numpy())) / np.sin(2 * np.pi * q)
@@ -521,24 +580,20 @@ class TwissResponse:
         LOG.debug("Calculate Phase Response Matrix")
         with timeit(lambda t: LOG.debug(f"  Time needed: {t} s")):
             tw = self._twiss
-            adv = self._phase_advances
             k1_el = self._elements_in["K1L"]
             el_out = self._elements_out
 
             if len(k1_el) > 0:
                 dmu = dict.fromkeys(PLANES)
 
-                pi = pd.DataFrame(tw["S"].to_numpy()[:, None] < tw["S"].to_numpy()[None, :],  # pi(i,j) = s(i) < s(j)
-                                      index=tw.index, columns=tw.index, dtype=int)
-
-                pi_term = pi.loc[k1_el, el_out].to_numpy()
+                pi_term = self._get_s_order(k1_el, el_out)
 
                 for plane in PLANES:
                     col_beta = f"{BETA}{plane}"
                     q = tw.Q1 if plane == "X" else tw.Q2
                     coeff_sign = 1 if plane == "X" else -1
 
-                    pi2tau = 2 * np.pi * tau(adv[plane].loc[k1_el, [DUMMY_ID] + el_out], q)
+                    pi2tau = 2 * np.pi * self._get_tau(plane, k1_el, [DUMMY_ID] + el_out)
                     brackets = 2 * pi_term + (
                         (np.sin(2 * pi2tau.loc[:, el_out].to_numpy())
                          - np.sin(2 * pi2tau.loc[:, DUMMY_ID].to_numpy()[:, None])
@@ -599,41 +654,47 @@ class TwissResponse:
     def _map_dispersion_response(self, disp):
         """ Maps all dispersion matrices """
         disp_mapped = dict.fromkeys(disp.keys())
-        m2v = self._map_to_variables
         for plane in disp:
-            mapping = self._var_to_el[plane.split("_")[1]]
-            disp_mapped[plane] = m2v(disp[plane], mapping)
+            disp_mapped[plane] = self._map_to_variables(disp[plane], plane.split("_")[1])
         return disp_mapped
 
-    @staticmethod
-    def _map_to_variables(df, mapping):
-        r"""Maps from magnets to variables using self._var_to_el.
-        Could actually be done by matrix multiplication :math:'A \cdot var_to_el',
-         yet, as var_to_el is very sparsely populated, looping is easier.
+    def _map_to_variables(self, df, order):
+        r"""Maps from magnets to variables using self._var_to_el, i.e. :math:'A \cdot var_to_el'.
+        The mapping matrices are created once per order and kept on model updates.
 
         Args:
             df: DataFrame or dictionary of DataFrames to map
-            mapping: mapping to be applied (e.g. var_to_el[order])
+            order: order of the mapping to be applied (e.g. 'K1L' for var_to_el['K1L'])
         Returns:
             DataFrame or dictionary of mapped DataFrames
         """
+        mapping = self._get_mapping_matrix(order)
 
-        def map_fun(df, mapping):
+        def map_fun(df):
             """ Actual mapping function """
-            df_map = pd.DataFrame(index=df.index, columns=mapping.keys())
-            for var, magnets in mapping.items():
-                df_map[var] = df.loc[:, upper(magnets.index)].mul(magnets.to_numpy(), axis="columns").sum(axis="columns")
-            return df_map
+            return pd.DataFrame(df.loc[:, mapping.index].to_numpy() @ mapping.to_numpy(),
+                                index=df.index, columns=mapping.columns)
 
         # convenience wrapper for dicts
         if isinstance(df, dict):
             mapped = dict.fromkeys(df.keys())
             for plane in mapped:
-                mapped[plane] = map_fun(df[plane], mapping)
+                mapped[plane] = map_fun(df[plane])
         else:
-            mapped = map_fun(df, mapping)
+            mapped = map_fun(df)
         return mapped
 
+    def _get_mapping_matrix(self, order):
+        """Returns the mapping var_to_el[order] as matrix of magnets x variables."""
+        if order not in self._mapping_matrices:
+            mapping = self._var_to_el[order]
+            magnets = pd.Index(list(dict.fromkeys(mag for var in mapping for mag in upper(mapping[var].index))))
+            matrix = np.zeros((len(magnets), len(mapping)))
+            for idx, var_magnets in enumerate(mapping.values()):
+                np.add.at(matrix[:, idx], magnets.get_indexer(upper(var_magnets.index)), var_magnets.to_numpy())
+            self._mapping_matrices[order] = pd.DataFrame(matrix, index=magnets, columns=list(mapping.keys()))
+        return self._mapping_matrices[order]
+
     ################################
     #          Getters
     ################################
@@ -646,7 +707,7 @@ class TwissResponse:
             self._beta_beat = self._normalize_beta_response(self._beta)
 
         if mapped and not self._beta_beat_mapped:
-            self._beta_beat_mapped = self._map_to_variables(self._beta_beat, self._var_to_el["K1L"])
+            self._beta_beat_mapped = self._map_to_variables(self._beta_beat, "K1L")
         return self._beta_beat_mapped if mapped else self._beta_beat
 
     def get_dispersion(self, mapped=True):
@@ -674,7 +735,7 @@ class TwissResponse:
             self._phase = self._calc_phase_response()
 
         if mapped and not self._phase_mapped:
-            self._phase_mapped = self._map_to_variables(self._phase, self._var_to_el["K1L"])
+            self._phase_mapped = self._map_to_variables(self._phase, "K1L")
 
         if mapped:
             return self._phase_mapped
@@ -687,7 +748,7 @@ class TwissResponse:
             self._phase_adv = self._calc_phase_advance_response()
 
         if mapped and not self._phase_adv_mapped:
-            self._phase_adv_mapped = self._map_to_variables(self._phase_adv, self._var_to_el["K1L"])
+            self._phase_adv_mapped = self._map_to_variables(self._phase_adv, "K1L")
 
         if mapped:
             return self._phase_adv_mapped
@@ -700,7 +761,7 @@ class TwissResponse:
             self._tune = self._calc_tune_response()
 
         if mapped and not self._tune_mapped:
-            self._tune_mapped = self._map_to_variables(self._tune, self._var_to_el["K1L"])
+            self._tune_mapped = self._map_to_variables(self._tune, "K1L")
 
         if mapped:
             return self._tune_mapped
@@ -713,7 +774,7 @@ class TwissResponse:
             self._coupling = self._calc_coupling_response()
 
         if mapped and not self._coupling_mapped:
-            self._coupling_mapped = self._map_to_variables(self._coupling, self._var_to_el["K1SL"])
+            self._coupling_mapped = self._map_to_variables(self._coupling, "K1SL")
 
         if mapped:
             return self._coupling_mapped
@@ -831,26 +892,36 @@ def dphi(data, q):
 
 def tau(data, q):
     """Return tau from phase advances in data, see Eq. 8 in [#DillyUpdatedGlobalOpticsCorrection2018]_"""
-    return data + np.where(data <= 0, q / 2, -q / 2)  # '<=' seems to be what MAD-X does
+    return data + np.where(data <= 0, q, -q) / 2  # '<=' seems to be what MAD-X does
 
 
 # Wrapper ##################################################################
 
 
+def create_twiss_response(accel_inst: Accelerator, vars_categories: Sequence[str],
+                          float32: bool = False) -> TwissResponse:
+    """ Creates the TwissResponse, e.g. to be updated with the model in iterative corrections.
+    With ``float32``, the responses of the elements are calculated in single precision. """
+    varmap_path = check_varmap_file(accel_inst, vars_categories)
+    return TwissResponse(accel_inst, vars_categories, varmap_path, float32=float32)
+
+
+def get_response(twiss_response: TwissResponse, optics_params: List[str]) -> dict:
+    """ Returns the responses of the optics parameters from the TwissResponse """
+    response: dict = twiss_response.get_response_for(optics_params)
+    if not any([resp.size for resp in response.values()]):
+        raise ValueError("Responses are all empty. "
+                         f"Are variables {twiss_response.get_variable_names()} correct for '{optics_params}'?")
+    return response
+
+
 def create_response(
     accel_inst: Accelerator,
     vars_categories: Sequence[str],
     optics_params: List[str],
+    float32: bool = False,
 ) -> dict:
     """ Wrapper to create response via TwissResponse """
     LOG.debug("Creating response via TwissResponse.")
-    varmap_path = check_varmap_file(accel_inst, vars_categories)
-
     with timeit(lambda t: LOG.debug(f"Total time getting TwissResponse: {t} s")):
-        tr = TwissResponse(accel_inst, vars_categories, varmap_path)
-        response: dict = tr.get_response_for(optics_params)
-
-    if not any([resp.size for resp in response.values()]):
-        raise ValueError("Responses are all empty. "
-                         f"Are variables {tr.get_variable_names()} correct for '{optics_params}'?")
-    return response
+        return get_response(create_twiss_response(accel_inst, vars_categories, float32), optics_params)
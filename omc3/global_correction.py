@@ -60,6 +60,14 @@ to use. Check :ref:`modules/model:Model` to see which ones are needed.
     Input in order of optics_params.
 
 
+- **float32_response**:
+
+    Calculate the analytical response in single precision,
+    which halves its memory. Not used with **fullresponse_path**.
+
+    action: ``store_true``
+
+
 - **fullresponse_path**:
 
     Path to the fullresponse binary file.If not given, calculates the
@@ -272,6 +280,10 @@ def correction_params():
     params.add_parameter(name="update_response",
                          action="store_true",
                          help="Update the (analytical) response per iteration.", )
+    params.add_parameter(name="float32_response",
+                         action="store_true",
+                         help="Calculate the analytical response in single precision, "
+                              "which halves its memory. Not used with `fullresponse_path`.", )
     return params
 
 
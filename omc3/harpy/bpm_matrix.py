@@ -0,0 +1,70 @@
+"""
+BPM Matrix
+----------
+
+This module contains the internal representation of turn-by-turn data used throughout ``harpy``.
+
+Instead of ``DataFrames``, the BPM x turn matrices are kept as a contiguous `numpy` array
+together with the BPM names, so that the cleaning and frequency analysis can operate on the
+array directly, without the copies involved in `pandas` indexing and alignment.
+``DataFrames`` are only built for the output.
+"""
+from dataclasses import dataclass
+from typing import Sequence, Union
+
+import numpy as np
+import pandas as pd
+
+
+@dataclass
+class BPMMatrix:
+    """ Matrix with one row per BPM, e.g. a TbT matrix (BPMs x turns) or the U matrix of its
+    singular value decomposition (BPMs x singular values).
+
+    Args:
+        index: BPM names, i.e. the labels of the rows of ``data``.
+        data: 2D array of the matrix values.
+    """
+    index: pd.Index
+    data: np.ndarray
+
+    def __post_init__(self):
+        self.index = pd.Index(self.index)
+        if self.data.ndim != 2 or self.data.shape[0] != self.index.size:
+            raise ValueError(f"Data of shape {self.data.shape} does not fit "
+                             f"the number of BPMs ({self.index.size}).")
+
+    @classmethod
+    def from_frame(cls, frame: pd.DataFrame) -> "BPMMatrix":
+        """ Creates a `BPMMatrix` from a ``DataFrame`` indexed by BPM names.
+        This does not copy the data, if the ``DataFrame`` is already backed by a single array. """
+        return cls(index=frame.index, data=frame.to_numpy())
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def empty(self) -> bool:
+        return self.data.size == 0
+
+    def select(self, rows: Union[np.ndarray, slice]) -> "BPMMatrix":
+        """ Returns a new `BPMMatrix` with the rows selected by a boolean mask,
+        an array of positions or a slice. """
+        return BPMMatrix(index=self.index[rows], data=self.data[rows])
+
+    def loc(self, names: Sequence[str]) -> "BPMMatrix":
+        """ Returns a new `BPMMatrix` with the rows of the given BPM names, in the given order. """
+        return self.select(self.get_positions(names))
+
+    def get_positions(self, names: Sequence[str]) -> np.ndarray:
+        """ Returns the row-positions of the given BPM names.
+
+        Raises:
+            KeyError: if any of the BPMs is not present in the matrix.
+        """
+        positions = self.index.get_indexer(pd.Index(names))
+        if np.any(positions < 0):
+            missing = pd.Index(names)[positions < 0]
+            raise KeyError(f"BPMs {list(missing)} are not present in the matrix.")
+        return positions
@@ -6,12 +6,18 @@ This module contains the cleaning functionality of ``harpy``.
 """
 import numpy as np
 import pandas as pd
+from scipy.sparse.linalg import svds
 
+from omc3.harpy.bpm_matrix import BPMMatrix
 from omc3.utils import logging_tools
 from omc3.utils.contexts import timeit
 
 LOGGER = logging_tools.getLogger(__name__)
 NTS_LIMIT = 8.  # Noise to signal limit
+SVD_ENGINES = ("exact", "randomized", "lanczos")
+SVD_OVERSAMPLING = 10  # Additional singular values calculated by the truncated SVD engines
+SVD_MAX_POWER_ITERATIONS = 20  # Maximal number of power iterations of the randomized SVD
+SVD_RANDOM_SEED = 0  # Fixed seed, so that the randomized SVD is reproducible
 
 
 def clean(harpy_input, bpm_data, model):
@@ -21,7 +27,7 @@ def clean(harpy_input, bpm_data, model):
 
     Args:
         harpy_input: The input object containing the analysis settings.
-        bpm_data: DataFrame of BPM TbT matrix indexed by BPM names.
+        bpm_data: `BPMMatrix` of BPM TbT matrix indexed by BPM names.
         model: model containing BPMs longitudinal locations indexed by BPM names.
 
     Returns:
@@ -43,7 +49,7 @@ def clean(harpy_input, bpm_data, model):
 def _get_only_model_bpms(bpm_data, model):
     if model is None:
         return bpm_data, []
-    bpm_data_in_model = bpm_data.loc[model.index.intersection(bpm_data.index)]
+    bpm_data_in_model = bpm_data.loc(model.index.intersection(bpm_data.index))
     not_in_model = bpm_data.index.difference(model.index)
     return bpm_data_in_model, [f"{bpm} not found in model" for bpm in not_in_model]
 
@@ -57,7 +63,7 @@ def _cut_cleaning(harpy_input, bpm_data, model):
     all_bad_bpms = _index_union(known_bad_bpms, bpm_flatness, bpm_spikes, exact_zeros)
     original_bpms = bpm_data.index
 
-    bpm_data = bpm_data.loc[bpm_data.index.difference(all_bad_bpms, sort=False)]
+    bpm_data = bpm_data.select(~bpm_data.index.isin(all_bad_bpms))
     bad_bpms_with_reasons = _get_bad_bpms_summary(
         harpy_input, known_bad_bpms, bpm_flatness, bpm_spikes, exact_zeros
     )
@@ -69,19 +75,26 @@ def _cut_cleaning(harpy_input, bpm_data, model):
 
 
 def _svd_clean(bpm_data, harpy_input):
-    bpm_data_mean = np.mean(bpm_data.to_numpy(), axis=1)
-    u_mat, sv_mat, u_mask = svd_decomposition(bpm_data - bpm_data_mean[:, None],
+    bpm_data_mean = np.mean(bpm_data.data, axis=1)
+    u_mat, sv_mat, u_mask = svd_decomposition(BPMMatrix(index=bpm_data.index,
+                                                        data=bpm_data.data - bpm_data_mean[:, None]),
                                               harpy_input.sing_val,
                                               dominance_limit=harpy_input.svd_dominance_limit,
-                                              num_iter=harpy_input.num_svd_iterations)
+                                              num_iter=harpy_input.num_svd_iterations,
+                                              engine=harpy_input.svd_engine,
+                                              tolerance=harpy_input.svd_tolerance)
 
     clean_u, dominant_bpms = _clean_dominant_bpms(u_mat, u_mask, harpy_input.svd_dominance_limit)
-    clean_data = clean_u.dot(sv_mat) + bpm_data_mean[np.all(u_mask, axis=1), None]
-    bpm_res = (clean_data - bpm_data.loc[clean_u.index]).std(axis=1)
-    orbit_offset = (clean_data - bpm_data.loc[clean_u.index]).mean(axis=1)
+    good_bpms = np.all(u_mask, axis=1)
+    clean_data = BPMMatrix(index=clean_u.index,
+                           data=clean_u.data.dot(sv_mat) + bpm_data_mean[good_bpms, None])
+    residuals = clean_data.data - bpm_data.data[good_bpms]
+    bpm_res = pd.Series(index=clean_u.index, data=np.std(residuals, axis=1, ddof=1))
+    orbit_offset = np.mean(residuals, axis=1)
+    del residuals
     LOGGER.debug(f"Average closed orbit offset: {np.mean(orbit_offset)}")
     LOGGER.debug(f"Average BPM resolution: {np.mean(bpm_res)}")
-    average_signal = np.mean(np.std(clean_data, axis=1))
+    average_signal = np.mean(np.std(clean_data.data, axis=1))
     LOGGER.debug(f"np.mean(np.std(A, axis=1): {average_signal}")
     if np.mean(bpm_res) > NTS_LIMIT * average_signal:
         raise ValueError("The data is too noisy. The most probable explanation "
@@ -96,8 +109,8 @@ def _detect_known_bad_bpms(bpm_data, list_of_bad_bpms):
 
 def _detect_flat_bpms(bpm_data, min_peak_to_peak):
     """Detects BPMs with the same values for all turns."""
-    cond = ((bpm_data.max(axis=1) - bpm_data.min(axis=1)).abs() < min_peak_to_peak)
-    bpm_flatness = bpm_data[cond].index
+    cond = np.abs(np.max(bpm_data.data, axis=1) - np.min(bpm_data.data, axis=1)) < min_peak_to_peak
+    bpm_flatness = bpm_data.index[cond]
     if bpm_flatness.size:
         LOGGER.debug(f"Flat BPMS detected (diff min/max <= {min_peak_to_peak}. "
                      f"BPMs removed: {bpm_flatness.size}")
@@ -106,8 +119,8 @@ def _detect_flat_bpms(bpm_data, min_peak_to_peak):
 
 def _detect_bpms_with_spikes(bpm_data, max_peak_cut):
     """Detects BPMs with spikes > `max_peak_cut`."""
-    too_high = bpm_data[bpm_data.max(axis=1) > max_peak_cut].index
-    too_low = bpm_data[bpm_data.min(axis=1) < -max_peak_cut].index
+    too_high = bpm_data.index[np.max(bpm_data.data, axis=1) > max_peak_cut]
+    too_low = bpm_data.index[np.min(bpm_data.data, axis=1) < -max_peak_cut]
     bpm_spikes = too_high.union(too_low)
     if bpm_spikes.size:
         LOGGER.debug(f"Spikes > {max_peak_cut} detected. BPMs removed: {bpm_spikes.size}")
@@ -119,7 +132,7 @@ def _detect_bpms_with_exact_zeros(bpm_data, keep_exact_zeros):
     if keep_exact_zeros:
         LOGGER.debug("Skipped exact zero check")
         return pd.Index([])
-    exact_zeros = bpm_data[~np.all(bpm_data, axis=1)].index
+    exact_zeros = bpm_data.index[~np.all(bpm_data.data, axis=1)]
     if exact_zeros.size:
         LOGGER.debug(f"Exact zeros detected. BPMs removed: {exact_zeros.size}")
     return exact_zeros
@@ -157,7 +170,7 @@ def _index_union(*indices):
 
 def _fix_polarity(wrong_polarity_names, bpm_data):
     """Fixes wrong polarity."""
-    bpm_data.loc[wrong_polarity_names, :] = -1 * bpm_data.loc[wrong_polarity_names, :].to_numpy()
+    bpm_data.data[bpm_data.get_positions(wrong_polarity_names)] *= -1
     return bpm_data
 
 
@@ -166,31 +179,37 @@ def _resync_bpms(harpy_input, bpm_data, model):
     LOGGER.debug("Will resynchronize BPMs")
     bpm_pos = model.index.get_loc(harpy_input.first_bpm)
     if harpy_input.opposite_direction:
-        mask = np.array([x in model.index[bpm_pos::-1] for x in bpm_data.index])
+        mask = bpm_data.index.isin(model.index[bpm_pos::-1])
     else:
-        mask = np.array([x in model.index[bpm_pos:] for x in bpm_data.index])
-    bpm_data.loc[mask] = np.roll(bpm_data.loc[mask], -1, axis=1)
-    return bpm_data.iloc[:, :-1]
+        mask = bpm_data.index.isin(model.index[bpm_pos:])
+    bpm_data.data[mask] = np.roll(bpm_data.data[mask], -1, axis=1)
+    return BPMMatrix(index=bpm_data.index, data=bpm_data.data[:, :-1])
 
 
-def svd_decomposition(matrix, num_singular_values, dominance_limit=None, num_iter=None):
+def svd_decomposition(matrix, num_singular_values, dominance_limit=None, num_iter=None,
+                      engine="exact", tolerance=1e-4):
     """
     Computes reduced (K largest values) singular value decomposition of a matrix.
     Requiring K singular values from MxN matrix results in matrices sized:
     `((M,K) x diag(K) x (K,N))`
 
     Args:
-        matrix: matrix to be decomposed.
+        matrix: `BPMMatrix` to be decomposed.
         num_singular_values: Required number of singular values for reconstruction.
         dominance_limit: limit on SVD dominance.
         num_iter: maximal number of iteration to remove elements and renormalise matrices.
+        engine: the algorithm used for the decomposition. ``exact`` computes the full SVD,
+            while ``randomized`` (randomized range finder with power iterations) and ``lanczos``
+            (`scipy` ARPACK) only compute the largest singular values (plus some oversampling),
+            which is much faster for large matrices.
+        tolerance: relative accuracy target of the singular values for the truncated engines.
 
     Returns:
-        An indexed DataFrame of U matrix `(M,K)`,
+        An indexed `BPMMatrix` of U matrix `(M,K)`,
         the product of S and V^T matrices `(diag(K).x(K,N))`,
         and the U matrix mask for cleaned elements.
     """
-    u_mat, s_mat, vt_mat = np.linalg.svd(matrix, full_matrices=False)
+    u_mat, s_mat, vt_mat = _get_svd(matrix.data, num_singular_values, engine, tolerance)
     u_mat, s_mat, u_mat_mask = _remove_dominant_elements(u_mat, s_mat, dominance_limit, num_iter=num_iter)
 
     available = np.sum(s_mat > 0.)
@@ -200,11 +219,56 @@ def svd_decomposition(matrix, num_singular_values, dominance_limit=None, num_ite
     LOGGER.debug(f"Number of singular values to keep: {keep}")
 
     indices = np.argsort(s_mat)[::-1][:keep]
-    return (pd.DataFrame(index=matrix.index, data=u_mat[:, indices]),
+    return (BPMMatrix(index=matrix.index, data=u_mat[:, indices]),
             np.dot(np.diag(s_mat[indices]), vt_mat[indices, :]),
             u_mat_mask[:, :int(np.max(indices))+1])
 
 
+def _get_svd(matrix, num_singular_values, engine, tolerance):
+    """
+    Computes the singular value decomposition with the given engine.
+    The truncated engines return ``num_singular_values`` plus ``SVD_OVERSAMPLING`` components,
+    sorted by decreasing singular values, so that enough components are available
+    if some are reduced by the removal of dominant elements.
+    """
+    if engine not in SVD_ENGINES:
+        raise NotImplementedError(f"Unknown SVD engine {engine}, choose from {SVD_ENGINES}.")
+    num_components = num_singular_values + SVD_OVERSAMPLING
+    if engine == "exact" or num_components >= min(matrix.shape):
+        return np.linalg.svd(matrix, full_matrices=False)
+    if engine == "randomized":
+        return _randomized_svd(matrix, num_components, tolerance)
+    start_vector = np.random.default_rng(SVD_RANDOM_SEED).standard_normal(min(matrix.shape))
+    u_mat, s_mat, vt_mat = svds(matrix, k=num_components, tol=tolerance, v0=start_vector)
+    order = np.argsort(s_mat)[::-1]
+    return u_mat[:, order], s_mat[order], vt_mat[order, :]
+
+
+def _randomized_svd(matrix, num_components, tolerance):
+    """
+    Randomized SVD via range finding with power (subspace) iterations, see Halko et al.,
+    `SIAM Review 53 (2011)`. The iterations stop, when the relative change of the singular values
+    is below ``tolerance``.
+    """
+    rng = np.random.default_rng(SVD_RANDOM_SEED)
+    n_random = min(num_components + SVD_OVERSAMPLING, min(matrix.shape))
+    q_mat, _ = np.linalg.qr(matrix @ rng.standard_normal((matrix.shape[1], n_random)))
+    s_previous = None
+    for _ in range(SVD_MAX_POWER_ITERATIONS):
+        q_mat, _ = np.linalg.qr(matrix.T @ q_mat)
+        q_mat, _ = np.linalg.qr(matrix @ q_mat)
+        u_small, s_mat, vt_mat = np.linalg.svd(q_mat.T @ matrix, full_matrices=False)
+        if (s_previous is not None and
+                np.max(np.abs(s_mat[:num_components] - s_previous)) <= tolerance * s_mat[0]):
+            break
+        s_previous = s_mat[:num_components]
+    else:
+        LOGGER.warning(f"Randomized SVD did not reach the tolerance {tolerance} "
+                       f"within {SVD_MAX_POWER_ITERATIONS} power iterations.")
+    return (q_mat @ u_small[:, :num_components], s_mat[:num_components],
+            vt_mat[:num_components, :])
+
+
 def _remove_dominant_elements(u_mat, s_mat, dominance_limit, num_iter=3):
     u_mat_mask = np.ones(u_mat.shape, dtype=bool)
     if dominance_limit is None:
@@ -226,9 +290,10 @@ def _remove_dominant_elements(u_mat, s_mat, dominance_limit, num_iter=3):
 
 
 def _clean_dominant_bpms(u_mat, u_mat_mask, svd_dominance_limit):
-    dominant_bpms = u_mat[np.any(~u_mat_mask, axis=1)].index
+    dominant_mask = np.any(~u_mat_mask, axis=1)
+    dominant_bpms = u_mat.index[dominant_mask]
     if dominant_bpms.size > 0:
         LOGGER.debug(f"Bad BPMs from SVD detected. Number of BPMs removed: {dominant_bpms.size}")
-    clean_u = u_mat.loc[u_mat.index.difference(dominant_bpms, sort=False)]
+    clean_u = u_mat.select(~dominant_mask)
     return clean_u, [f"{bpm_name} Dominant BPM in SVD, peak value > {svd_dominance_limit}"
                      for bpm_name in dominant_bpms]
@@ -28,3 +28,7 @@ COL_NATMU = "NATMU"
 COL_FREQ = "FREQ"
 COL_PHASE = "PHASE"
 COL_ERR = "ERR"
+
+# Headers ---
+# only set in memory, on harpy results whose main amplitudes are not halved as in the lin files
+HEADER_UNSCALED_AMPS = "UNSCALED_AMPLITUDES"
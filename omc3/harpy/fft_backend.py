@@ -0,0 +1,177 @@
+"""
+FFT Backend
+-----------
+
+This module provides the `FFT` functions used by ``harpy`` with interchangeable backends:
+
+- ``numpy``: single-threaded `FFT` of `numpy`, always available and the default.
+- ``scipy``: `FFT` of `scipy.fft`, parallelised over the rows of the matrix with ``workers``.
+- ``pyfftw``: `FFTW` via ``pyFFTW``, if installed. Multi-threaded, the plans are kept for the
+  lifetime of the process and the `FFTW` wisdom can be saved to and loaded from a file,
+  so that the planning is only done once.
+
+The backends are cached, so that the same backend object (and its plans) is re-used for all
+planes, bunches and files analysed in a process.
+"""
+import os
+import struct
+import tempfile
+import threading
+from functools import lru_cache
+from typing import Tuple
+
+import numpy as np
+import scipy.fft
+
+from omc3.utils import logging_tools
+
+LOGGER = logging_tools.get_logger(__name__)
+
+# --- optional pyfftw import block ---------------------------------------------
+
+try:
+    import pyfftw
+    import pyfftw.interfaces.numpy_fft
+except ImportError as e:
+    LOGGER.debug(f"Could not import pyFFTW: {str(e)}")
+    pyfftw = None
+
+# ------------------------------------------------------------------------------
+
+PYFFTW_PLANNER_EFFORT = "FFTW_MEASURE"
+
+
+def is_pyfftw_installed() -> bool:
+    """ Returns ``True`` if pyFFTW is installed. """
+    return pyfftw is not None
+
+
+class NumpyFFT:
+    """ Single-threaded `FFT` of `numpy`. All transforms are along the last axis. """
+    def rfft(self, matrix, n):
+        return np.fft.rfft(matrix, n=n)
+
+    def fft(self, matrix, n=None):
+        return np.fft.fft(matrix, n=n)
+
+    def ifft(self, matrix):
+        return np.fft.ifft(matrix)
+
+
+class ScipyFFT:
+    """ `FFT` of `scipy.fft`, parallelised over the rows with ``workers`` threads. """
+    def __init__(self, workers: int = 1):
+        self.workers = workers
+
+    def rfft(self, matrix, n):
+        return scipy.fft.rfft(matrix, n=n, workers=self.workers)
+
+    def fft(self, matrix, n=None):
+        return scipy.fft.fft(matrix, n=n, workers=self.workers)
+
+    def ifft(self, matrix):
+        return scipy.fft.ifft(matrix, workers=self.workers)
+
+
+class PyFFTW:
+    """
+    `FFTW` via pyFFTW with ``workers`` threads. The plans are cached for the lifetime of the
+    process. If a ``wisdom_file`` is given, the `FFTW` wisdom is loaded from it, and saved to it
+    whenever a new transform has been planned.
+    The backend is shared by the threads of the chunked `FFTs`, so planning and saving are locked.
+    """
+    def __init__(self, workers: int = 1, wisdom_file: str = None):
+        if not is_pyfftw_installed():
+            raise ImportError("The 'pyfftw' FFT backend requires pyFFTW to be installed.")
+        self.workers = workers
+        self.wisdom_file = wisdom_file
+        self._planned = set()
+        self._lock = threading.Lock()
+        pyfftw.interfaces.cache.enable()
+        if wisdom_file is not None and os.path.isfile(wisdom_file):
+            try:
+                pyfftw.import_wisdom(read_wisdom(wisdom_file))
+            except IOError as e:
+                LOGGER.warning(f"Could not load FFTW wisdom, it will be planned anew: {str(e)}")
+            else:
+                LOGGER.debug(f"Loaded FFTW wisdom from {wisdom_file}")
+
+    def rfft(self, matrix, n):
+        return self._transform(pyfftw.interfaces.numpy_fft.rfft, matrix, n)
+
+    def fft(self, matrix, n=None):
+        return self._transform(pyfftw.interfaces.numpy_fft.fft, matrix, n)
+
+    def ifft(self, matrix):
+        return self._transform(pyfftw.interfaces.numpy_fft.ifft, matrix, None)
+
+    def _transform(self, function, matrix, n):
+        key = (function.__name__, matrix.shape, matrix.dtype, n)
+        if key in self._planned:
+            return function(matrix, n=n, threads=self.workers, planner_effort=PYFFTW_PLANNER_EFFORT)
+        with self._lock:
+            result = function(matrix, n=n, threads=self.workers, planner_effort=PYFFTW_PLANNER_EFFORT)
+            if key not in self._planned:
+                self._save_wisdom()
+                self._planned.add(key)
+        return result
+
+    def _save_wisdom(self):
+        if self.wisdom_file is not None:
+            write_wisdom(self.wisdom_file, pyfftw.export_wisdom())
+
+
+def write_wisdom(wisdom_file: str, wisdom: Tuple[bytes, ...]):
+    """
+    Writes the `FFTW` wisdom, a tuple of byte strings, each prefixed by its length.
+    The wisdom is first written to a unique temporary file, which then replaces the wisdom file,
+    as several processes might share it.
+    """
+    directory, name = os.path.split(os.path.abspath(wisdom_file))
+    with tempfile.NamedTemporaryFile(dir=directory, prefix=f"{name}.", suffix=".tmp", delete=False) as tmp_file:
+        for part in wisdom:
+            tmp_file.write(struct.pack("<Q", len(part)))
+            tmp_file.write(part)
+    os.replace(tmp_file.name, wisdom_file)
+
+
+def read_wisdom(wisdom_file: str) -> Tuple[bytes, ...]:
+    """ Reads the `FFTW` wisdom written by ``write_wisdom``. """
+    with open(wisdom_file, "rb") as wisdom:
+        content = wisdom.read()
+    parts, position, prefix = [], 0, struct.calcsize("<Q")
+    while position < len(content):
+        if position + prefix > len(content):
+            raise IOError(f"FFTW wisdom file {wisdom_file} is truncated or not a wisdom file.")
+        (length,) = struct.unpack_from("<Q", content, position)
+        position += prefix
+        parts.append(content[position:position + length])
+        position += length
+    if position != len(content):
+        raise IOError(f"FFTW wisdom file {wisdom_file} is truncated or not a wisdom file.")
+    return tuple(parts)
+
+
+FFT_BACKENDS = ("numpy", "scipy", "pyfftw")
+
+
+@lru_cache(maxsize=None)
+def get_backend(name: str = "numpy", workers: int = 1, wisdom_file: str = None):
+    """
+    Provides the (cached) `FFT` backend.
+
+    Args:
+        name: name of the backend, one of ``numpy``, ``scipy`` or ``pyfftw``.
+        workers: number of threads of the ``scipy`` and ``pyfftw`` backends.
+        wisdom_file: file to load and save the `FFTW` wisdom of the ``pyfftw`` backend.
+
+    Returns:
+        Backend object with the functions ``rfft``, ``fft`` and ``ifft`` along the last axis.
+    """
+    if name == "numpy":
+        return NumpyFFT()
+    if name == "scipy":
+        return ScipyFFT(workers)
+    if name == "pyfftw":
+        return PyFFTW(workers, wisdom_file)
+    raise NotImplementedError(f"Unknown FFT backend {name}")
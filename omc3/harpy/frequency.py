@@ -10,6 +10,9 @@ analysis.
 Also searches for resonances in the calculated spectra.
 """
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache, partial
 from numbers import Number
 
 import numpy as np
@@ -17,6 +20,8 @@ import pandas as pd
 
 from omc3.utils import logging_tools, outliers
 from omc3.definitions.constants import PLANES, PI2
+from omc3.harpy import fft_backend
+from omc3.harpy.bpm_matrix import BPMMatrix
 from omc3.harpy.constants import (COL_TUNE, COL_AMP, COL_MU,
                                   COL_NATTUNE, COL_NATAMP, COL_NATMU,
                                   COL_FREQ, COL_PHASE)
@@ -41,6 +46,7 @@ def _get_resonance_lines(order):
 
 MAIN_LINES = {"X": (1, 0, 0), "Y": (0, 1, 0), "Z": (0, 0, 1)}
 Z_TOLERANCE = 0.0003
+NAFF_ITERATIONS = 3
 
 
 def estimate_tunes(harpy_input, usvs):
@@ -54,22 +60,23 @@ def estimate_tunes(harpy_input, usvs):
     Returns:
         list of estimated tunes [x, y, z].
     """
-    tunex = _estimate_tune(usvs["X"][1], harpy_input.window, q_s=False)
-    tuney = _estimate_tune(usvs["Y"][1], harpy_input.window, q_s=False)
+    fft = get_fft_backend(harpy_input)
+    tunex = _estimate_tune(usvs["X"][1], harpy_input.window, fft, q_s=False)
+    tuney = _estimate_tune(usvs["Y"][1], harpy_input.window, fft, q_s=False)
     if harpy_input.autotunes == "transverse":
         return [tunex, tuney, 0]
-    tunez = _estimate_tune(usvs["X"][1], harpy_input.window, q_s=True)
+    tunez = _estimate_tune(usvs["X"][1], harpy_input.window, fft, q_s=True)
     return [tunex, tuney, tunez]
 
 
-def _estimate_tune(sv_mat, window, q_s=False):
+def _estimate_tune(sv_mat, window, fft, q_s=False):
     upper_power = int(np.power(2, np.ceil(np.log2(sv_mat.shape[1]))))
     synchro_limit = int(upper_power / 16)  # 0.03125: synchrotron tunes are lower, betatron higher
-    coefs = np.abs(np.fft.rfft(np.mean(sv_mat, axis=0) * windowing(sv_mat.shape[1], window),
-                               n=2 * upper_power))
+    coefs = np.abs(fft.rfft(np.mean(sv_mat, axis=0) * windowing(sv_mat.shape[1], window),
+                            n=2 * upper_power))
     if q_s:
-        return np.fft.rfftfreq(2 * upper_power)[np.argmax(coefs[:synchro_limit])]
-    return np.fft.rfftfreq(2 * upper_power)[synchro_limit + np.argmax(coefs[synchro_limit:])]
+        return get_frequency_grid(2 * upper_power)[np.argmax(coefs[:synchro_limit])]
+    return get_frequency_grid(2 * upper_power)[synchro_limit + np.argmax(coefs[synchro_limit:])]
 
 
 def harpy_per_plane(harpy_input, bpm_matrix, usv, tunes, plane):
@@ -79,7 +86,7 @@ def harpy_per_plane(harpy_input, bpm_matrix, usv, tunes, plane):
 
     Args:
         harpy_input: Analysis settings.
-        bpm_matrix: TbT BPM matrix.
+        bpm_matrix: `BPMMatrix` of TbT BPM data.
         usv: U and SV^T matrices decomposed matrices, can be ``None``.
         tunes: list of tunes [x, y, z].
         plane: marking the horizontal or vertical plane, **X** or **Y**.
@@ -89,7 +96,9 @@ def harpy_per_plane(harpy_input, bpm_matrix, usv, tunes, plane):
     """
     df = pd.DataFrame(index=bpm_matrix.index)
     frequencies, coefficients = windowed_padded_rfft(harpy_input, bpm_matrix, tunes, usv)
-    df, not_tune_bpms = _get_main_resonances(tunes, dict(FREQS=frequencies, COEFFS=coefficients),
+    refine = get_peak_refinement(harpy_input, bpm_matrix)
+    df, not_tune_bpms = _get_main_resonances(tunes, dict(FREQS=frequencies, COEFFS=coefficients,
+                                                         REFINE=refine),
                                                 plane, harpy_input.tolerance, df)
     cleaned_by_tune_bpms = clean_by_tune(df.loc[:, f"{COL_TUNE}{plane}"], harpy_input.tune_clean_limit)
     df = df.loc[df.index.difference(cleaned_by_tune_bpms)]
@@ -98,8 +107,8 @@ def harpy_per_plane(harpy_input, bpm_matrix, usv, tunes, plane):
                                           df.loc[:, f"{COL_TUNE}{plane}"].to_numpy(), bpm_matrix.shape[1])
 
     bad_bpms_summaries = _get_bad_bpms_summary(not_tune_bpms, cleaned_by_tune_bpms)
-    bpm_matrix = bpm_matrix.loc[df.index]
-    spectra = dict(FREQS=frequencies.loc[df.index], COEFFS=coefficients.loc[df.index])
+    spectra = dict(FREQS=frequencies.loc(df.index), COEFFS=coefficients.loc[df.index],
+                   REFINE=refine)
 
     if _get_natural_tunes(harpy_input, tunes) is not None:
         df_nattunes = _calculate_natural_tunes(
@@ -127,34 +136,35 @@ def find_resonances(tunes, nturns, plane, spectra, order_resonances):
         tunes: list of tunes [x, y, z].
         nturns: length of analysed data.
         plane: marking the horizontal or vertical plane, **X** or **Y**.
-        spectra: frequencies and complex coefficients.
+        spectra: frequencies and complex coefficients, optionally with the peak refinement
+            function (see :func:`get_peak_refinement`) under ``REFINE``.
 
     Returns:
         A DataFrame.
     """
     resonance_lines = _get_resonance_lines(order_resonances)
 
-    df = pd.DataFrame(index=spectra["FREQS"].index, columns=OrderedDict())
     resonances_freqs = _compute_resonances_with_freqs(plane, tunes, resonance_lines)
     if tunes[2] > 0.0:
         resonances_freqs.update(_compute_resonances_with_freqs("Z", tunes, resonance_lines))
-    for resonance in resonances_freqs.keys():
-        tolerance = _get_resonance_tolerance(resonance, nturns)
-        max_coefs, max_freqs = _search_highest_coefs(resonances_freqs[resonance], tolerance,
-                                                     spectra["FREQS"], spectra["COEFFS"])
+    tolerances = [_get_resonance_tolerance(resonance, nturns) for resonance in resonances_freqs.keys()]
+    max_coefs, max_freqs = _search_highest_coefs_of_lines(list(resonances_freqs.values()), tolerances,
+                                                          spectra["FREQS"], spectra["COEFFS"],
+                                                          spectra.get("REFINE"))
+    columns = OrderedDict()
+    for i, (resonance, freq) in enumerate(resonances_freqs.items()):
         resstr = _get_resonance_suffix(resonance)
-        df[f"{COL_FREQ}{resstr}"], df[f"{COL_AMP}{resstr}"], df[f"{COL_PHASE}{resstr}"] = _get_freqs_amps_phases(
-            max_freqs, max_coefs, resonances_freqs[resonance])
-
-        df[f"{COL_PHASE}{resstr}"] = _realign_phases(df.loc[:, f"{COL_PHASE}{resstr}"].to_numpy(),
-                                               df.loc[:, f"{COL_FREQ}{resstr}"].to_numpy(), nturns)
+        columns[f"{COL_FREQ}{resstr}"], columns[f"{COL_AMP}{resstr}"], phases = _get_freqs_amps_phases(
+            max_freqs[:, i], max_coefs[:, i], freq)
+        columns[f"{COL_PHASE}{resstr}"] = _realign_phases(phases, columns[f"{COL_FREQ}{resstr}"], nturns)
 
-    return df
+    return pd.DataFrame(index=spectra["FREQS"].index, data=columns)
 
 
 def _get_main_resonances(tunes, spectra, plane, tolerance, df):
     freq = sum(r * t for r, t in zip(tunes, MAIN_LINES[plane])) % 1
-    max_coefs, max_freqs = _search_highest_coefs(freq, tolerance, spectra["FREQS"], spectra["COEFFS"])
+    max_coefs, max_freqs = _search_highest_coefs(freq, tolerance, spectra["FREQS"], spectra["COEFFS"],
+                                                 spectra.get("REFINE"))
     if not np.any(max_coefs) and plane != "Z":
         raise ValueError(f"No main {plane} resonances found, "
                          f"try to increase the tolerance or adjust the tunes")
@@ -170,7 +180,8 @@ def _calculate_natural_tunes(spectra, nattunes, tolerance, plane):
     df = pd.DataFrame(index=spectra["FREQS"].index, columns=OrderedDict())
     x, y, _ = nattunes
     freq = x % 1 if plane == "X" else y % 1
-    max_coefs, max_freqs = _search_highest_coefs(freq, tolerance, spectra["FREQS"], spectra["COEFFS"])
+    max_coefs, max_freqs = _search_highest_coefs(freq, tolerance, spectra["FREQS"], spectra["COEFFS"],
+                                                 spectra.get("REFINE"))
     df[f"{COL_NATTUNE}{plane}"], df[f"{COL_NATAMP}{plane}"], df[f"{COL_NATMU}{plane}"] = _get_freqs_amps_phases(
         max_freqs, max_coefs, freq)
     return df
@@ -204,7 +215,7 @@ def _get_bad_bpms_summary(not_tune_bpms, cleaned_by_tune_bpms):
             [f"{bpm_name} tune is too far from average" for bpm_name in cleaned_by_tune_bpms])
 
 
-def _search_highest_coefs(freq, tolerance, frequencies, coefficients):
+def _search_highest_coefs(freq, tolerance, frequencies, coefficients, refine=None):
     """
     Finds the highest coefficients in frequencies/coefficients in freq +- tolerance.
 
@@ -213,24 +224,155 @@ def _search_highest_coefs(freq, tolerance, frequencies, coefficients):
         tolerance:
         frequencies:
         coefficients:
+        refine: function refining the found peaks, see :func:`get_peak_refinement`.
+            Defaults to ``None``, i.e. the peaks are given on the frequency grid of the spectra.
 
     Returns:
         Tuple of maximum coefficients and the corresponding frequencies.
     """
-    p_freq = freq if freq < 0.5 else 1 - freq
-    min_val, max_val = p_freq - tolerance, p_freq + tolerance
-    freq_vals = frequencies.to_numpy()
+    max_coefs, max_freqs = _search_highest_coefs_of_lines([freq], [tolerance], frequencies,
+                                                          coefficients, refine)
+    return (pd.Series(index=coefficients.index, data=max_coefs[:, 0]),
+            pd.Series(index=coefficients.index, data=max_freqs[:, 0]))
+
+
+def _search_highest_coefs_of_lines(freqs, tolerances, frequencies, coefficients, refine=None):
+    """
+    Finds the highest coefficients in frequencies/coefficients in freq +- tolerance,
+    for all the given lines at once.
+    The frequencies of a column belong to the same output bin for all BPMs, and they are
+    increasing along the columns. Hence, only the columns of the windows of the lines are
+    gathered, and the maximum per window is found in a single pass over them.
+
+    Args:
+        freqs: frequencies of the lines from interval (0, 1).
+        tolerances: tolerances of the lines.
+        frequencies: `SpectrumFrequencies`.
+        coefficients:
+        refine: function refining the found peaks, see :func:`get_peak_refinement`.
+
+    Returns:
+        Tuple of arrays (BPMs x lines) of maximum coefficients and the corresponding frequencies.
+    """
+    freqs = np.asarray(freqs, dtype=float)
+    p_freqs = np.where(freqs < 0.5, freqs, 1 - freqs)
+    min_vals, max_vals = p_freqs - tolerances, p_freqs + tolerances
+    grid, grid_indices = frequencies.grid, frequencies.grid_indices
     coefs_vals = coefficients.to_numpy()
-    on_window_mask = (freq_vals >= min_val) & (freq_vals <= max_val)
-    filtered_coefs = np.where(on_window_mask, coefs_vals, 0)
-    filtered_amps = np.abs(filtered_coefs)
-    max_indices = np.argmax(filtered_amps, axis=1)
-    max_coefs = filtered_coefs[np.arange(coefs_vals.shape[0]), max_indices]
-    max_coefs = pd.Series(index=coefficients.index, data=max_coefs)
-    max_pfreqs = freq_vals[np.arange(freq_vals.shape[0]), max_indices]
-    max_freqs = max_pfreqs if freq < 0.5 else 1 - max_pfreqs
-    max_freqs = pd.Series(index=coefficients.index, data=np.where(max_coefs != 0, max_freqs, 0))
-    return max_coefs, max_freqs
+    starts = np.searchsorted(grid[np.max(grid_indices, axis=0)], min_vals, side="left")
+    ends = np.maximum(np.searchsorted(grid[np.min(grid_indices, axis=0)], max_vals, side="right"), starts)
+    widths = ends - starts
+    offsets = np.cumsum(widths) - widths
+    # an additional column outside all windows, so that reduceat also works for empty windows
+    columns = np.append(np.arange(np.sum(widths)) + np.repeat(starts - offsets, widths), 0)
+    window_freqs = grid[grid_indices[:, columns]]
+    on_window_mask = ((window_freqs >= np.append(np.repeat(min_vals, widths), np.inf)) &
+                      (window_freqs <= np.append(np.repeat(max_vals, widths), -np.inf)))
+    window_coefs = np.where(on_window_mask, coefs_vals[:, columns], 0)
+    window_amps = np.abs(window_coefs)
+    max_amps = np.maximum.reduceat(window_amps, offsets, axis=1)
+    # first maximum of each window, as np.argmax
+    is_max = window_amps == np.pad(np.repeat(max_amps, widths, axis=1), ((0, 0), (0, 1)), constant_values=-1)
+    max_positions = np.minimum.reduceat(np.where(is_max, np.arange(columns.size), columns.size - 1),
+                                        offsets, axis=1)
+    max_positions = np.where(widths > 0, max_positions, columns.size - 1)
+    rows = np.arange(coefs_vals.shape[0])[:, None]
+    max_coefs = window_coefs[rows, max_positions]
+    max_pfreqs = window_freqs[rows, max_positions]
+    if refine is not None:
+        for i in range(freqs.size):
+            found = max_coefs[:, i] != 0
+            max_pfreqs[found, i], max_coefs[found, i] = refine(coefficients.index[found], max_pfreqs[found, i])
+    max_freqs = np.where(freqs < 0.5, max_pfreqs, 1 - max_pfreqs)
+    return max_coefs, np.where(max_coefs != 0, max_freqs, 0)
+
+
+def get_peak_refinement(harpy_input, bpm_matrix):
+    """
+    Provides the function refining the peaks found in the spectra of the given TbT data
+    with the method given by ``harpy_input.peak_refinement``:
+    ``parabolic`` and ``jacobsen`` interpolate the amplitudes, respectively the complex
+    coefficients, of the peak and its two neighbours on the frequency grid,
+    ``naff`` maximises the amplitude with a few Newton iterations.
+    The coefficients are then recalculated at the refined frequencies.
+
+    Args:
+        harpy_input: Analysis settings.
+        bpm_matrix: `BPMMatrix` of TbT BPM data.
+
+    Returns:
+        Function of the BPM names and the peak frequencies (from interval [0, 0.5]), returning
+        the refined frequencies and coefficients, or ``None`` if no refinement was requested.
+    """
+    if harpy_input.peak_refinement is None:
+        return None
+    windowed = BPMMatrix(index=bpm_matrix.index,
+                         data=bpm_matrix.data * windowing(bpm_matrix.shape[1], window=harpy_input.window))
+    return partial(_refine_peaks, PEAK_REFINEMENTS[harpy_input.peak_refinement], windowed,
+                   1 / np.power(2, harpy_input.turn_bits + 1))
+
+
+def _refine_peaks(get_offsets, windowed, step, bpm_names, freqs):
+    signal = windowed.loc(bpm_names).data
+    freqs = freqs + step * get_offsets(signal, freqs, step)
+    # the factor 2 as in the spectra, which are just one half
+    return freqs, 2 * np.sum(_get_dft_terms(signal, freqs), axis=1)
+
+
+def _parabolic_offsets(signal, freqs, step):
+    return _get_interpolated_offsets(*np.abs(_get_neighbour_coefs(signal, freqs, step)).T)
+
+
+def _jacobsen_offsets(signal, freqs, step):
+    return np.real(_get_interpolated_offsets(*_get_neighbour_coefs(signal, freqs, step).T))
+
+
+def _get_neighbour_coefs(signal, freqs, step):
+    """ Coefficients at the given frequencies and their neighbours on the frequency grid.
+    With the turns counted from the middle of the signal, the coefficients around a peak
+    have the same phase, so they can also be interpolated as complex numbers. """
+    turns = _get_centered_turns(signal.shape[1])
+    neighbours = np.exp(-PI2 * 1j * step * np.outer(turns, [-1, 0, 1]))
+    return _get_dft_terms(signal, freqs, centered=True).dot(neighbours)
+
+
+def _get_interpolated_offsets(lower, peak, upper):
+    curvatures = lower - 2 * peak + upper
+    offsets = 0.5 * (lower - upper) / np.where(curvatures == 0, 1, curvatures)
+    return np.where(curvatures == 0, 0, offsets)
+
+
+def _naff_offsets(signal, freqs, step):
+    turns = _get_centered_turns(signal.shape[1])
+    offsets = np.zeros(freqs.size)
+    for _ in range(NAFF_ITERATIONS):
+        terms = _get_dft_terms(signal, freqs + step * offsets, centered=True)
+        coefs, first, second = (np.sum(terms, axis=1), terms.dot(-PI2 * 1j * turns),
+                                terms.dot(-np.square(PI2 * turns)))
+        gradient = np.real(np.conj(coefs) * first)
+        curvature = np.square(np.abs(first)) + np.real(np.conj(coefs) * second)
+        # the peak is within the neighbouring grid frequencies, no step otherwise
+        newton_steps = -gradient / np.where(curvature < 0, curvature, -np.inf) / step
+        offsets = np.clip(offsets + newton_steps, -1, 1)
+    return offsets
+
+
+PEAK_REFINEMENTS = {"parabolic": _parabolic_offsets, "jacobsen": _jacobsen_offsets,
+                    "naff": _naff_offsets}
+
+
+def _get_dft_terms(signal, freqs, centered=False):
+    """ Terms of the `DFT` of each row of the (already windowed) ``signal`` at its frequency in
+    ``freqs``. The turns are counted from the middle of the signal, if ``centered``.
+    The phasors are calculated as cumulative products, which is much faster than the
+    exponential of the full matrix, with a relative error of the order of n_turns * eps. """
+    phasors = np.repeat(np.exp(-PI2 * 1j * freqs)[:, None], signal.shape[1], axis=1)
+    phasors[:, 0] = np.exp(PI2 * 1j * freqs * (signal.shape[1] - 1) / 2) if centered else 1
+    return signal * np.cumprod(phasors, axis=1, out=phasors)
+
+
+def _get_centered_turns(n_turns):
+    return np.arange(n_turns) - (n_turns - 1) / 2
 
 
 def _get_resonance_suffix(resonance):
@@ -259,41 +401,169 @@ def _get_resonance_tolerance(resonance, n_turns):
 def windowed_padded_rfft(harpy_input, matrix, tunes, svd=None):
     """
     Calculates the spectra using specified windowing function and zero-padding.
+    The spectra are calculated, masked and reduced to the maximum per output bin in chunks of
+    ``harpy_input.fft_chunk_size`` BPMs, so that the peak memory scales with the chunk size
+    instead of the number of BPMs. The chunks are processed by ``harpy_input.fft_threads``
+    threads in parallel. The `FFTs` are calculated with the backend ``harpy_input.fft_backend``.
 
     Args:
         harpy_input: A `HarpyInput` object.
-        matrix: `pd.DataFrame` of TbT matrix (BPMs x turns).
+        matrix: `BPMMatrix` of TbT matrix (BPMs x turns).
         tunes: list of tunes [x, y, z].
         svd: reduced (U_matrix, np.dot(S_matrix, V_matrix)) of original TbT matrix, defaults to
             ``None``.
 
     Returns:
-        Tuple of `pd.DataFrames`, for frequencies and coefficients.
+        Tuple of `SpectrumFrequencies` and `pd.DataFrame` of the coefficients.
     """
     padded_len, output_len = np.power(2, harpy_input.turn_bits), np.power(2, harpy_input.output_bits)
     sub_bins = int(padded_len / output_len)
     mask = get_freq_mask(harpy_input, tunes, 2 / matrix.shape[1])
-    n_bins = int(np.sum(mask) / sub_bins)
     n_bpms = len(matrix.index)
+    masked_rfft = partial(MASKED_RFFT_ENGINES[harpy_input.spectral_engine], get_fft_backend(harpy_input))
     if svd is None:
-        tbt_matrix = matrix.loc[:, :].to_numpy()
-        coefs = np.fft.rfft(tbt_matrix * windowing(tbt_matrix.shape[1], window=harpy_input.window),
-                            n=padded_len * 2)[:, mask]
+        tbt_matrix = matrix.data
+        get_coefs = partial(_get_rfft_coefs, masked_rfft, tbt_matrix,
+                            windowing(tbt_matrix.shape[1], window=harpy_input.window),
+                            padded_len * 2, mask)
     else:
         u, sv = svd
-        s_vt_freq = np.fft.rfft(sv * windowing(sv.shape[1], window=harpy_input.window),
-                                n=padded_len * 2)
-        coefs = np.dot(u, s_vt_freq[:, mask])
-    argsmax = (np.indices((n_bpms, n_bins))[1] * sub_bins +
-               np.argmax(np.abs(np.reshape(coefs, (n_bpms, n_bins, sub_bins))), axis=2))
+        s_vt_freq = masked_rfft(sv * windowing(sv.shape[1], window=harpy_input.window),
+                                padded_len * 2, mask)
+        get_coefs = partial(_get_svd_coefs, u.data, s_vt_freq)
+
+    chunk_size = harpy_input.fft_chunk_size or n_bpms
+    chunks = [slice(start, start + chunk_size) for start in range(0, n_bpms, chunk_size)]
+    reduce_chunk = partial(_get_max_coefs_per_bin, get_coefs, sub_bins)
+    if harpy_input.fft_threads > 1 and len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=harpy_input.fft_threads) as executor:
+            results = list(executor.map(reduce_chunk, chunks))
+    else:
+        results = [reduce_chunk(chunk) for chunk in chunks]
+    max_coefs = np.concatenate([coefs for coefs, _ in results])
+    argsmax = np.concatenate([indices for _, indices in results])
+
     # two 2 in following line is because we have just half of spectra
-    coefficients = pd.DataFrame(index=matrix.index, data=2 * coefs[np.arange(n_bpms)[:, None], argsmax])
-    del coefs
-    frequencies = pd.DataFrame(index=matrix.index, data=np.outer(np.ones(n_bpms), np.fft.rfftfreq(
-            padded_len * 2)[mask])[np.arange(n_bpms)[:, None], argsmax])
+    coefficients = pd.DataFrame(index=matrix.index, data=2 * max_coefs)
+    frequencies = SpectrumFrequencies(index=matrix.index, grid=get_frequency_grid(padded_len * 2)[mask],
+                                      grid_indices=argsmax.astype(np.int32))
     return frequencies, coefficients
 
 
+@dataclass
+class SpectrumFrequencies:
+    """ Frequencies of the spectra of the BPMs, stored compactly as indices into the common
+    frequency grid instead of a dense (BPMs x bins) matrix of frequencies.
+
+    Args:
+        index: BPM names.
+        grid: increasing frequencies.
+        grid_indices: (BPMs x bins) indices of the frequencies in the ``grid``.
+    """
+    index: pd.Index
+    grid: np.ndarray
+    grid_indices: np.ndarray
+
+    def loc(self, names) -> "SpectrumFrequencies":
+        """ Returns the frequencies of the given BPMs, in the given order. """
+        return SpectrumFrequencies(index=pd.Index(names), grid=self.grid,
+                                   grid_indices=self.grid_indices[self.index.get_indexer(names)])
+
+    def to_numpy(self) -> np.ndarray:
+        return self.grid[self.grid_indices]
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(index=self.index, data=self.to_numpy())
+
+
+@lru_cache(maxsize=4)
+def get_frequency_grid(n_fft):
+    """ Frequencies of the real `FFT` of length ``n_fft``, cached as these are the same for all
+    planes, bunches and files. The returned array is read-only. """
+    grid = np.fft.rfftfreq(n_fft)
+    grid.flags.writeable = False
+    return grid
+
+
+def _get_rfft_coefs(masked_rfft, tbt_matrix, window, n_fft, mask, rows):
+    return masked_rfft(tbt_matrix[rows] * window, n_fft, mask)
+
+
+def _get_svd_coefs(u_mat, s_vt_freq, rows):
+    return np.dot(u_mat[rows], s_vt_freq)
+
+
+def get_fft_backend(harpy_input):
+    """ Returns the `FFT` backend given by the analysis settings, see :mod:`omc3.harpy.fft_backend`. """
+    return fft_backend.get_backend(harpy_input.fft_backend, harpy_input.fft_workers,
+                                   harpy_input.fft_wisdom)
+
+
+def _padded_rfft(fft, matrix, n_fft, mask):
+    """ Zero-padded real `FFT` of the rows of ``matrix``, evaluated on the full frequency grid
+    of ``n_fft // 2 + 1`` frequencies and then masked. """
+    return fft.rfft(matrix, n=n_fft)[:, mask]
+
+
+def _zoom_rfft(fft, matrix, n_fft, mask):
+    """
+    Same as :func:`_padded_rfft`, but the spectrum is only evaluated in the windows of consecutive
+    frequencies given by ``mask``, via a chirp-z transform (Bluestein's algorithm) per window.
+    The cost scales with the number of turns plus the width of the windows instead of with
+    ``n_fft``, which is much faster if the mask only covers a small part of the spectrum.
+    If the windows cover most of the spectrum, the full `FFT` is cheaper and used instead.
+    """
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], mask.astype(np.int8), [0]))))
+    starts, ends = edges[::2], edges[1::2]
+    n_turns = matrix.shape[1]
+    # chirp-z needs two complex FFTs, i.e. roughly the cost of four real FFTs of same length
+    if 4 * sum(_get_convolution_length(n_turns, end - start) for start, end in zip(starts, ends)) > n_fft:
+        return _padded_rfft(fft, matrix, n_fft, mask)
+    return np.concatenate(
+        [_chirp_z(fft, matrix, n_fft, start, end - start) for start, end in zip(starts, ends)]
+        or [np.zeros((matrix.shape[0], 0), dtype=complex)],
+        axis=1
+    )
+
+
+def _chirp_z(fft, matrix, n_fft, first_bin, n_bins):
+    """ Evaluates the `DFT` of length ``n_fft`` of the rows of ``matrix`` at the ``n_bins``
+    consecutive frequency bins starting at ``first_bin``. """
+    n_turns = matrix.shape[1]
+    conv_len = _get_convolution_length(n_turns, n_bins)
+    turns = np.arange(n_turns, dtype=np.int64)
+    # exact integer arithmetic modulo the period before going to floating point
+    shift = np.exp(-PI2 * 1j * ((turns * first_bin) % n_fft) / n_fft)
+    kernel = np.zeros(conv_len, dtype=complex)
+    kernel[:n_bins] = np.conj(_get_chirp(np.arange(n_bins, dtype=np.int64), n_fft))
+    kernel[conv_len - n_turns + 1:] = np.conj(_get_chirp(np.arange(n_turns - 1, 0, -1, dtype=np.int64), n_fft))
+    convolved = fft.ifft(fft.fft(matrix * (shift * _get_chirp(turns, n_fft)), n=conv_len)
+                         * fft.fft(kernel))
+    return convolved[:, :n_bins] * _get_chirp(np.arange(n_bins, dtype=np.int64), n_fft)
+
+
+def _get_convolution_length(n_turns, n_bins):
+    return int(np.power(2, np.ceil(np.log2(n_turns + n_bins - 1))))
+
+
+def _get_chirp(indices, n_fft):
+    return np.exp(-np.pi * 1j * ((indices * indices) % (2 * n_fft)) / n_fft)
+
+
+MASKED_RFFT_ENGINES = {"fft": _padded_rfft, "zoom": _zoom_rfft}
+
+
+def _get_max_coefs_per_bin(get_coefs, sub_bins, rows):
+    """ Calculates the coefficients of the given rows and returns the coefficient with the maximal
+    amplitude per output bin of ``sub_bins`` consecutive frequencies, with its index. """
+    coefs = get_coefs(rows)
+    n_bpms, n_bins = coefs.shape[0], int(coefs.shape[1] / sub_bins)
+    argsmax = (np.indices((n_bpms, n_bins))[1] * sub_bins +
+               np.argmax(np.abs(np.reshape(coefs, (n_bpms, n_bins, sub_bins))), axis=2))
+    return coefs[np.arange(n_bpms)[:, None], argsmax], argsmax
+
+
+@lru_cache(maxsize=None)
 def windowing(length, window='hamming'):
     """
     Provides specified windowing function of given length.
@@ -301,27 +571,32 @@ def windowing(length, window='hamming'):
     Currently, the following windowing functions are implemented (sorted by increasing width of
     main lobe, also decreasing spectral leakage in closest lobes):
     ``rectangle``, ``welch``, ``triangle``, ``hann``, ``hamming``, ``nuttal3``, and ``nuttal4``.
+    The windows are cached, as they are the same for all planes, bunches and files.
 
     Args:
         length: length of the window.
         window: type of the windowing function.
 
     Returns:
-        Normalised windowing function of specified type and length.
+        Normalised windowing function of specified type and length, as read-only array.
     """
-    ints2pi = PI2 * np.arange(length) / (length - 1)
-    windows = {
-        "nuttal4": 0.3125 - 0.46875 * np.cos(ints2pi) + 0.1875 * np.cos(2 * ints2pi) - 0.03125 * np.cos(3 * ints2pi),
-        "nuttal3": 0.375 - 0.5 * np.cos(ints2pi) + 0.125 * np.cos(2 * ints2pi),
-        "hamming": (25 / 46) - (21 / 46) * np.cos(ints2pi),
-        "hann": 0.5 - 0.5 * np.cos(ints2pi),
-        "welch": 1 - np.square((ints2pi / np.pi) - 1),
-        "triangle": 1 - np.abs((ints2pi / np.pi) - 1),
-        "rectangle": np.ones(length)
-    }
-    if window not in windows.keys():
+    if window not in WINDOWS.keys():
         raise NotImplementedError(f"Unknown windowing function {window}")
-    return windows[window] / np.sum(windows[window])
+    values = WINDOWS[window](PI2 * np.arange(length) / (length - 1))
+    values = values / np.sum(values)
+    values.flags.writeable = False
+    return values
+
+
+WINDOWS = {
+    "nuttal4": lambda ints2pi: 0.3125 - 0.46875 * np.cos(ints2pi) + 0.1875 * np.cos(2 * ints2pi) - 0.03125 * np.cos(3 * ints2pi),
+    "nuttal3": lambda ints2pi: 0.375 - 0.5 * np.cos(ints2pi) + 0.125 * np.cos(2 * ints2pi),
+    "hamming": lambda ints2pi: (25 / 46) - (21 / 46) * np.cos(ints2pi),
+    "hann": lambda ints2pi: 0.5 - 0.5 * np.cos(ints2pi),
+    "welch": lambda ints2pi: 1 - np.square((ints2pi / np.pi) - 1),
+    "triangle": lambda ints2pi: 1 - np.abs((ints2pi / np.pi) - 1),
+    "rectangle": lambda ints2pi: np.ones(ints2pi.size),
+}
 
 
 def get_freq_mask(harpy_input, tunes, auto_tol):
@@ -8,6 +8,7 @@ single-bunch `TbtData`.
 """
 from collections import OrderedDict
 from os.path import basename, join
+from typing import Dict
 
 import numpy as np
 import pandas as pd
@@ -16,9 +17,11 @@ import tfs
 from omc3.definitions import formats
 from omc3.definitions.constants import PLANES, PLANE_TO_NUM as P2N
 from omc3.harpy import clean, frequency, kicker
+from omc3.harpy.bpm_matrix import BPMMatrix
 from omc3.harpy.constants import (FILE_AMPS_EXT, FILE_FREQS_EXT, FILE_LIN_EXT,
                                   COL_NAME, COL_TUNE, COL_AMP, COL_MU,
-                                  COL_NATTUNE, COL_NATAMP, COL_PHASE, COL_ERR)
+                                  COL_NATTUNE, COL_NATAMP, COL_PHASE, COL_ERR,
+                                  HEADER_UNSCALED_AMPS)
 from omc3.utils import logging_tools
 from omc3.utils.contexts import timeit
 
@@ -27,16 +30,29 @@ ALL_PLANES = (*PLANES, "Z")
 PLANE_TO_NUM = {**P2N, "Z": 3}
 
 
-def run_per_bunch(tbt_data, harpy_input):
+class Lins(dict):
+    """
+    Harpy results of a single bunch, i.e. a `TfsDataFrame` per plane, passed in memory to the
+    optics measurement. Contrary to the lin files, the main amplitudes are not halved
+    (see ``lin_file_frames``), which is marked by the ``HEADER_UNSCALED_AMPS`` header of the frames.
+    """
+    def __init__(self, frames: Dict[str, tfs.TfsDataFrame], output_path_without_suffix: str):
+        super(Lins, self).__init__(frames)
+        self.output_path_without_suffix = output_path_without_suffix
+
+
+def run_per_bunch(tbt_data, harpy_input, write_lins=True):
     """
     Cleans data, analyses frequencies and searches for resonances.
 
     Args:
         tbt_data: single bunch `TbtData`.
         harpy_input: Analysis settings taken from the commandline.
+        write_lins: if ``False``, the lin files are not written even if requested in
+            ``to_write``, so that the caller can write them later (see ``write_lin_files``).
 
     Returns:
-        Dictionary with a `TfsDataFrame` per plane.
+        `Lins` with a `TfsDataFrame` per plane.
     """
     model = None if harpy_input.model is None else tfs.read(harpy_input.model, index=COL_NAME).loc[:, 'S']
     bpm_datas, usvs, lins, bad_bpms = {}, {}, {}, {}
@@ -49,8 +65,10 @@ def run_per_bunch(tbt_data, harpy_input):
 
     tune_estimates = harpy_input.tunes if harpy_input.autotunes is None else frequency.estimate_tunes(
         harpy_input, usvs if harpy_input.clean else
-        dict(X=clean.svd_decomposition(bpm_datas["X"], harpy_input.sing_val),
-             Y=clean.svd_decomposition(bpm_datas["Y"], harpy_input.sing_val)))
+        {plane: clean.svd_decomposition(bpm_datas[plane], harpy_input.sing_val,
+                                        engine=harpy_input.svd_engine,
+                                        tolerance=harpy_input.svd_tolerance)
+         for plane in PLANES})
 
     spectra = {}
     for plane in PLANES:
@@ -76,22 +94,54 @@ def run_per_bunch(tbt_data, harpy_input):
         lins[plane] = _sync_phase(lins[plane], plane)
         lins[plane] = _rescale_amps_to_main_line_and_compute_noise(lins[plane], plane)
         lins[plane] = lins[plane].sort_values('S', axis=0, ascending=True)
-        lins[plane] = tfs.TfsDataFrame(lins[plane], headers=_compute_headers(lins[plane], tbt_data.date))
-        if "lin" in harpy_input.to_write:
-            _write_lin_tfs(output_file_path, plane, lins[plane])
+        headers = _compute_headers(lins[plane], tbt_data.date)
+        headers[HEADER_UNSCALED_AMPS] = 1
+        lins[plane] = tfs.TfsDataFrame(lins[plane], headers=headers)
+    lins = Lins(lins, output_file_path)
+    if write_lins and "lin" in harpy_input.to_write:
+        write_lin_files(lin_file_frames(lins), output_file_path)
     return lins
 
 
+def lin_file_frames(lins: Lins) -> Dict[str, tfs.TfsDataFrame]:
+    """
+    Returns copies of the frames in the convention of the lin files,
+    i.e. with the main amplitudes divided by two for backwards compatibility with Drive.
+    Only frames marked by the ``HEADER_UNSCALED_AMPS`` header are rescaled, the header is removed.
+    """
+    frames = {}
+    for plane, lin_frame in lins.items():
+        frames[plane] = lin_frame.copy()
+        frames[plane].headers = OrderedDict(lin_frame.headers)
+        if not frames[plane].headers.pop(HEADER_UNSCALED_AMPS, False):
+            continue
+        # Division by two for backwards compatibility with Drive, i.e. the unit is [2mm]
+        # TODO  later remove
+        for column in (f"{COL_AMP}{plane}", f"{COL_NATAMP}{plane}"):
+            if column in lin_frame.columns:
+                frames[plane][column] = lin_frame.loc[:, column].to_numpy() / 2
+    return frames
+
+
+def write_lin_files(frames: Dict[str, tfs.TfsDataFrame], output_path_without_suffix: str):
+    for plane, lin_frame in frames.items():
+        _write_lin_tfs(output_path_without_suffix, plane, lin_frame)
+
+
 def _get_cut_tbt_matrix(tbt_data, turn_indices, plane):
+    """ Returns a view on the turns to analyse, i.e. without copying the data. """
     start = max(0, min(turn_indices))
     end = min(max(turn_indices), tbt_data.matrices[0][plane].shape[1])
-    return tbt_data.matrices[0][plane].iloc[:, start:end].T.reset_index(drop=True).T
+    bpm_data = BPMMatrix.from_frame(tbt_data.matrices[0][plane])
+    return BPMMatrix(index=bpm_data.index, data=bpm_data.data[:, start:end])
 
 
 def _scale_to_meters(bpm_data, unit):
+    """ Scales the data to meters. This creates the (only) copy of the TbT data,
+    which can then be modified in-place during the cleaning. """
     scales_to_meters = {'um': 1e-6, 'mm': 0.001, 'cm': 0.01, 'm': 1}
-    bpm_data.iloc[:,:] = bpm_data.iloc[:,:].to_numpy() * scales_to_meters[unit]
-    return bpm_data
+    return BPMMatrix(index=bpm_data.index,
+                     data=np.multiply(bpm_data.data, scales_to_meters[unit], dtype=float))
 
 
 def _closed_orbit_analysis(bpm_data, model, bpm_res):
@@ -102,13 +152,14 @@ def _closed_orbit_analysis(bpm_data, model, bpm_res):
     lin_frame['BPM_RES'] = 0.0 if bpm_res is None else bpm_res.loc[lin_frame.index]
     with timeit(lambda spanned: LOGGER.debug(f"Time for orbit_analysis: {spanned}")):
         lin_frame = _get_orbit_data(lin_frame, bpm_data)
-    return lin_frame, bpm_data.subtract(bpm_data.mean(axis=1), axis=0)
+    return lin_frame, BPMMatrix(index=bpm_data.index,
+                                data=bpm_data.data - lin_frame['CO'].to_numpy()[:, None])
 
 
 def _get_orbit_data(lin_frame, bpm_data):
-    lin_frame['PK2PK'] = np.max(bpm_data, axis=1) - np.min(bpm_data, axis=1)
-    lin_frame['CO'] = np.mean(bpm_data, axis=1)
-    lin_frame['CORMS'] = np.std(bpm_data, axis=1) / np.sqrt(bpm_data.shape[1])
+    lin_frame['PK2PK'] = np.max(bpm_data.data, axis=1) - np.min(bpm_data.data, axis=1)
+    lin_frame['CO'] = np.mean(bpm_data.data, axis=1)
+    lin_frame['CORMS'] = np.std(bpm_data.data, axis=1) / np.sqrt(bpm_data.shape[1])
     # TODO: Magic number 10?: Maybe accelerator dependent ... LHC 6-7?
     lin_frame['NOISE'] = lin_frame.loc[:, 'BPM_RES'] / np.sqrt(bpm_data.shape[1]) / 10.0
     return lin_frame
@@ -173,7 +224,7 @@ def _write_bad_bpms(output_path_without_suffix, plane, bad_bpms_with_reasons):
 
 def _write_spectrum(output_path_without_suffix, plane, spectra):
     tfs.write(f"{output_path_without_suffix}{FILE_AMPS_EXT.format(plane=plane.lower())}", spectra["COEFFS"].abs().T)
-    tfs.write(f"{output_path_without_suffix}{FILE_FREQS_EXT.format(plane=plane.lower())}", spectra["FREQS"].T)
+    tfs.write(f"{output_path_without_suffix}{FILE_FREQS_EXT.format(plane=plane.lower())}", spectra["FREQS"].to_frame().T)
 
 
 def _write_lin_tfs(output_path_without_suffix, plane, lin_frame):
@@ -193,11 +244,6 @@ def _rescale_amps_to_main_line_and_compute_noise(panda, plane):
     cols.remove(f"{COL_AMP}{plane}")
     panda.loc[:, cols] = panda.loc[:, cols].div(panda.loc[:, f"{COL_AMP}{plane}"], axis="index")
     amps = panda.loc[:, f"{COL_AMP}{plane}"].to_numpy()
-    # Division by two for backwards compatibility with Drive, i.e. the unit is [2mm]
-    # TODO  later remove
-    panda[f"{COL_AMP}{plane}"] = panda.loc[:, f"{COL_AMP}{plane}"].to_numpy() / 2
-    if f"{COL_NATAMP}{plane}" in panda.columns:
-        panda[f"{COL_NATAMP}{plane}"] = panda.loc[:, f"{COL_NATAMP}{plane}"].to_numpy() / 2
 
     if np.max(panda.loc[:, 'NOISE'].to_numpy()) == 0.0:
         return panda  # Do not calculated errors when no noise was calculated
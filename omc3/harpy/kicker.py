@@ -20,14 +20,14 @@ def phase_correction(bpm_data_orig, lin_frame, plane):
     Corrects phase of main spectral line assuming exponentially decaying oscillations.
 
     Args:
-        bpm_data_orig: matrix of original `TbtData`.
+        bpm_data_orig: `BPMMatrix` of original `TbtData`.
         lin_frame: DataFrame in which to correct the results.
         plane: marking the horizontal or vertical plane, **X** or **Y**.
 
     Returns:
         A `DataFrame` with corrected phases.
     """
-    bpm_data = bpm_data_orig.loc[lin_frame.index, :]
+    bpm_data = bpm_data_orig.loc(lin_frame.index).data
     damp, dstd = _get_damping(bpm_data)
     LOGGER.debug(f"Damping factor X: {damp:2.2e} +- {dstd:2.2e}")
     int_range = np.arange(0.0, bpm_data.shape[1])
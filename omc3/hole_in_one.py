@@ -30,11 +30,13 @@ by a different set of files:
 To run either of the two or both steps, see options ``--harpy`` and ``--optics``.
 """
 import os
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from copy import deepcopy
 from datetime import datetime
 from os.path import abspath, basename, dirname, join, splitext
-from typing import Generator, Tuple
+from typing import Callable, Generator, Iterable, List, Optional, Sequence, Tuple
 
 import turn_by_turn as tbt
 from generic_parser import DotDict
@@ -43,6 +45,7 @@ from generic_parser.entrypoint_parser import (EntryPoint, EntryPointParameters,
 
 from omc3.definitions import formats
 from omc3.harpy import handler
+from omc3.harpy.fft_backend import FFT_BACKENDS, is_pyfftw_installed
 from omc3.model import manager
 from omc3.optics_measurements import measure_optics
 from omc3.optics_measurements.measure_optics import InputFiles
@@ -111,6 +114,16 @@ def hole_in_one_entrypoint(opt, rest):
 
         Flags: **--tbt_datatype**
         Default: ``LHC``
+      - **num_processes** *(int)*: Number of processes used to analyse the bunches of all
+        given files in parallel. The analysis is serial if set to 1.
+
+        Flags: **--num_processes**
+        Default: ``1``
+      - **read_ahead**: If present, the next TbT file is read in a background thread
+        while the current one is being analysed.
+
+        Flags: **--read_ahead**
+        Action: ``store_true``
 
       *--Cleaning--*
 
@@ -160,6 +173,18 @@ def hole_in_one_entrypoint(opt, rest):
 
         Flags: **--svd_dominance_limit**
         Default: ``0.925``
+      - **svd_engine** *(str)*: Algorithm for the singular value decomposition.
+        ``randomized`` and ``lanczos`` only compute the largest singular values,
+        which is faster for large TbT matrices.
+
+        Flags: **--svd_engine**
+        Choices: ``('exact', 'randomized', 'lanczos')``
+        Default: ``exact``
+      - **svd_tolerance** *(float)*: Relative accuracy target of the singular values
+        for the ``randomized`` and ``lanczos`` SVD engines.
+
+        Flags: **--svd_tolerance**
+        Default: ``1e-04``
       - **wrong_polarity_bpms**: BPMs with swapped polarity in both planes.
 
         Flags: **--wrong_polarity_bpms**
@@ -208,6 +233,45 @@ def hole_in_one_entrypoint(opt, rest):
 
         Flags: **--turn_bits**
         Default: ``20``
+      - **spectral_engine** *(str)*: Algorithm to calculate the spectra. ``fft`` calculates
+        the full zero-padded spectrum, ``zoom`` only the frequency windows around the tunes and
+        resonance lines via chirp-z transforms, which is faster if these cover a small part
+        of the spectrum (e.g. with few resonances or with autotunes).
+
+        Flags: **--spectral_engine**
+        Choices: ``('fft', 'zoom')``
+        Default: ``fft``
+      - **peak_refinement** *(str)*: Refines the frequencies, amplitudes and phases of the
+        found lines beyond the frequency resolution given by ``turn_bits``, by interpolating
+        the spectrum around the peak (``parabolic``, ``jacobsen``) or by Newton iterations
+        on the windowed signal (``naff``). This allows to use a much lower ``turn_bits``.
+
+        Flags: **--peak_refinement**
+        Choices: ``('parabolic', 'jacobsen', 'naff')``
+      - **fft_chunk_size** *(int)*: Number of BPMs for which the spectra are calculated at once.
+        Limits the memory needed for the spectra. If not given, all BPMs are calculated at once.
+
+        Flags: **--fft_chunk_size**
+      - **fft_threads** *(int)*: Number of threads to calculate the spectra of the BPM chunks
+        in parallel.
+
+        Flags: **--fft_threads**
+        Default: ``1``
+      - **fft_backend** *(str)*: Library to calculate the FFTs. ``numpy`` is single-threaded,
+        ``scipy`` and ``pyfftw`` (if installed) use ``fft_workers`` threads per FFT.
+
+        Flags: **--fft_backend**
+        Choices: ``('numpy', 'scipy', 'pyfftw')``
+        Default: ``numpy``
+      - **fft_workers** *(int)*: Number of threads per FFT of the ``scipy`` and ``pyfftw``
+        FFT backends.
+
+        Flags: **--fft_workers**
+        Default: ``1``
+      - **fft_wisdom** *(str)*: File to load the FFTW wisdom from and to save it to,
+        for the ``pyfftw`` FFT backend. This avoids planning the same FFTs again in later runs.
+
+        Flags: **--fft_wisdom**
       - **window** *(str)*: Windowing function to be used for frequency analysis.
 
         Flags: **--window**
@@ -236,6 +300,11 @@ def hole_in_one_entrypoint(opt, rest):
 
         Flags: **--chromatic_beating**
         Action: ``store_true``
+      - **column_projection**: Only read the secondary lines of the lin files needed by the
+        requested analyses. Other lines are read from the files when first used.
+
+        Flags: **--column_projection**
+        Action: ``store_true``
       -  **compensation** *(str)*: Mode of compensation for the analysis after driven beam excitation.
 
         Flags: **-compensation**
@@ -263,6 +332,13 @@ def hole_in_one_entrypoint(opt, rest):
         Flags: **--rdt_magnet_order**
         Choices: ``(2 <= n <= 8)``
         Default: ``4``
+      - **num_processes** *(int)*: Number of threads used to read the lin files and to run the
+        independent stages of the analysis, e.g. the two planes, in parallel.
+        The analysis is serial if set to 1.
+        If Harpy is run as well, its value is used.
+
+        Flags: **--num_processes**
+        Default: ``1``
       - **only_coupling**: Calculate only coupling.
 
         Flags: **--only_coupling**
@@ -316,10 +392,12 @@ def hole_in_one_entrypoint(opt, rest):
     harpy_opt, optics_opt, accel_opt = _get_suboptions(opt, rest)
     _write_config_file(harpy_opt, optics_opt, accel_opt)
     lins = []
-    if harpy_opt is not None:
-        lins = _run_harpy(harpy_opt)
-    if optics_opt is not None:
-        _measure_optics(lins, optics_opt)
+    with _background_lin_writer() as write_lins:
+        if harpy_opt is not None:
+            # the harpy results are passed in memory, the lin files are written in the background
+            lins = _run_harpy(harpy_opt, write_lins if optics_opt is not None else None)
+        if optics_opt is not None:
+            _measure_optics(lins, optics_opt)
 
 
 def _get_suboptions(opt, rest):
@@ -328,7 +406,8 @@ def _get_suboptions(opt, rest):
         if opt.optics:
             rest = add_to_arguments(rest, entry_params=optics_params(),
                                     files=harpy_opt.files,
-                                    outputdir=harpy_opt.outputdir)
+                                    outputdir=harpy_opt.outputdir,
+                                    num_processes=harpy_opt.num_processes)
             harpy_opt.outputdir = join(harpy_opt.outputdir, 'lin_files')
             if harpy_opt.model is not None:
                 rest = add_to_arguments(rest, entry_params={"model_dir": {"flags": "--model_dir"}},
@@ -370,18 +449,91 @@ def _write_config_file(harpy_opt, optics_opt, accelerator_opt):
     save_options_to_config(os.path.join(out_dir, file_name), all_opt)
 
 
-def _run_harpy(harpy_options):
+def _run_harpy(harpy_options, write_lins: Optional[Callable[[handler.Lins], None]] = None
+    ) -> List[handler.Lins]:
+    """ Runs harpy on all bunches of all files. If ``write_lins`` is given, it is called with the
+    results of each bunch to write the lin files, otherwise they are written by harpy itself. """
     iotools.create_dirs(harpy_options.outputdir)
+    write_in_harpy = write_lins is None
     with timeit(lambda spanned: LOGGER.info(f"Total time for Harpy: {spanned}")):
-        lins = []
         all_options = _replicate_harpy_options_per_file(harpy_options)
-        tbt_datas = [(tbt.read_tbt(option.files, datatype=option.tbt_datatype), option) for option in all_options]
-        for tbt_data, option in tbt_datas:
-            lins.extend([handler.run_per_bunch(bunch_data, bunch_options)
-                         for bunch_data, bunch_options in _add_suffix_and_iter_bunches(tbt_data, option)])
+        tbt_datas = _read_tbt_files(all_options, read_ahead=harpy_options.read_ahead)
+        bunches = (bunch for tbt_data, option in tbt_datas
+                   for bunch in _add_suffix_and_iter_bunches(tbt_data, option))
+        if harpy_options.num_processes == 1:
+            results = (_run_harpy_per_bunch(bunch, write_in_harpy) for bunch in bunches)
+        else:
+            results = _run_harpy_in_pool(bunches, harpy_options.num_processes, write_in_harpy)
+        lins = []
+        for bunch_lins in results:
+            if not write_in_harpy and "lin" in harpy_options.to_write:
+                write_lins(bunch_lins)
+            lins.append(bunch_lins)
     return lins
 
 
+@contextmanager
+def _background_lin_writer() -> Generator[Callable[[handler.Lins], None], None, None]:
+    """ Yields a function writing the lin files of a bunch in a background thread, so that
+    the writing is not in the way of the analysis. The frames are copied right away, as they
+    are modified in the optics measurement. Waits for all files to be written on exit. """
+    writes = []
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        def write_lins(lins: handler.Lins):
+            writes.append(executor.submit(handler.write_lin_files, handler.lin_file_frames(lins),
+                                          lins.output_path_without_suffix))
+        yield write_lins
+    for write in writes:
+        write.result()  # raises errors of the writes
+
+
+def _read_tbt_files(all_options: Sequence[DotDict], read_ahead: bool = False
+    ) -> Generator[Tuple[tbt.TbtData, DotDict], None, None]:
+    """ Reads the TbT files one at a time, so that only the file currently analysed
+    (and the next one, if ``read_ahead``) is kept in memory.
+    With ``read_ahead`` the next file is read in a background thread while the current one is
+    being analysed. """
+    if not read_ahead:
+        for option in all_options:
+            yield _read_tbt(option), option
+        return
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_read = executor.submit(_read_tbt, all_options[0]) if len(all_options) else None
+        for index, option in enumerate(all_options):
+            tbt_data = next_read.result()
+            if index + 1 < len(all_options):
+                next_read = executor.submit(_read_tbt, all_options[index + 1])
+            yield tbt_data, option
+            del tbt_data
+
+
+def _read_tbt(option: DotDict) -> tbt.TbtData:
+    return tbt.read_tbt(option.files, datatype=option.tbt_datatype)
+
+
+def _run_harpy_in_pool(bunches: Iterable[Tuple[tbt.TbtData, DotDict]], num_processes: int,
+                       write_lins: bool = True) -> Generator[handler.Lins, None, None]:
+    """ Runs harpy on the bunches in a process pool. The results are yielded in order of the
+    given bunches, i.e. the same order as in the serial case. Only a limited number of bunches
+    is submitted at a time, so that the files are still read lazily. """
+    with ProcessPoolExecutor(max_workers=num_processes) as executor:
+        futures = deque()
+        for bunch in bunches:
+            if len(futures) >= 2 * num_processes:
+                yield futures.popleft().result()
+            futures.append(executor.submit(_run_harpy_per_bunch, bunch, write_lins))
+        for future in futures:
+            yield future.result()
+
+
+def _run_harpy_per_bunch(bunch: Tuple[tbt.TbtData, DotDict], write_lins: bool = True) -> handler.Lins:
+    """ Runs harpy on a single (bunch data, bunch options) pair. Needs to be at module level,
+    to be picklable for the process pool. """
+    bunch_data, bunch_options = bunch
+    return handler.run_per_bunch(bunch_data, bunch_options, write_lins=write_lins)
+
+
 def _replicate_harpy_options_per_file(options):
     list_of_options = []
     for input_file in options.files:
@@ -459,6 +611,16 @@ def _harpy_entrypoint(params):
         options.window = "rectangle"
     if not 2 <= options.resonances <= 8:
         raise AttributeError("The magnet order for resonance lines calculation should be between 2 and 8 (inclusive).")
+    if options.num_processes < 1:
+        raise AttributeError("The number of processes for harpy should be at least 1.")
+    if options.fft_chunk_size is not None and options.fft_chunk_size < 1:
+        raise AttributeError("The FFT chunk size should be positive.")
+    if options.fft_threads < 1:
+        raise AttributeError("The number of FFT threads should be at least 1.")
+    if options.fft_workers < 1:
+        raise AttributeError("The number of FFT workers should be at least 1.")
+    if options.fft_backend == "pyfftw" and not is_pyfftw_installed():
+        raise AttributeError("The 'pyfftw' FFT backend requires pyFFTW to be installed.")
 
     return options, rest
 
@@ -483,6 +645,12 @@ def harpy_params():
     params.add_parameter(name="tbt_datatype", default=HARPY_DEFAULTS["tbt_datatype"],
                          choices=list(tbt.io.TBT_MODULES.keys()),
                          help="Choose the datatype from which to import. ")
+    params.add_parameter(name="num_processes", type=int, default=HARPY_DEFAULTS["num_processes"],
+                         help="Number of processes used to analyse the bunches of all given files "
+                              "in parallel. The analysis is serial if set to 1.")
+    params.add_parameter(name="read_ahead", action="store_true",
+                         help="If present, the next TbT file is read in a background thread "
+                              "while the current one is being analysed.")
 
     # Cleaning parameters
     params.add_parameter(name="clean", action="store_true",
@@ -497,6 +665,14 @@ def harpy_params():
     params.add_parameter(name="svd_dominance_limit", type=float,
                          default=HARPY_DEFAULTS["svd_dominance_limit"],
                          help="Limit for single BPM dominating a mode.")
+    params.add_parameter(name="svd_engine", type=str, default=HARPY_DEFAULTS["svd_engine"],
+                         choices=("exact", "randomized", "lanczos"),
+                         help="Algorithm for the singular value decomposition. "
+                              "'randomized' and 'lanczos' only compute the largest singular "
+                              "values, which is faster for large TbT matrices.")
+    params.add_parameter(name="svd_tolerance", type=float, default=HARPY_DEFAULTS["svd_tolerance"],
+                         help="Relative accuracy target of the singular values "
+                              "for the 'randomized' and 'lanczos' SVD engines.")
     params.add_parameter(name="num_svd_iterations", type=int,
                          default=HARPY_DEFAULTS["num_svd_iterations"],
                          help="Maximal number of iterations of U matrix elements removal "
@@ -551,6 +727,36 @@ def harpy_params():
                               "per interval of size 2 ** (- output_bits - 1).")
     params.add_parameter(name="resonances", type=int, default=HARPY_DEFAULTS["resonances"],
                         help="Maximum magnet order of resonance lines to calculate.")
+    params.add_parameter(name="spectral_engine", type=str,
+                         default=HARPY_DEFAULTS["spectral_engine"], choices=("fft", "zoom"),
+                         help="Algorithm to calculate the spectra. 'fft' calculates the full "
+                              "zero-padded spectrum, 'zoom' only the frequency windows around "
+                              "the tunes and resonance lines via chirp-z transforms, which is "
+                              "faster if these cover a small part of the spectrum.")
+    params.add_parameter(name="peak_refinement", type=str,
+                         choices=("parabolic", "jacobsen", "naff"),
+                         help="Refines the frequencies, amplitudes and phases of the found lines "
+                              "beyond the frequency resolution given by turn_bits, by "
+                              "interpolating the spectrum around the peak ('parabolic', "
+                              "'jacobsen') or by Newton iterations on the windowed signal "
+                              "('naff'). This allows to use a much lower turn_bits.")
+    params.add_parameter(name="fft_chunk_size", type=int,
+                         help="Number of BPMs for which the spectra are calculated at once. "
+                              "Limits the memory needed for the spectra. "
+                              "If not given, all BPMs are calculated at once.")
+    params.add_parameter(name="fft_threads", type=int, default=HARPY_DEFAULTS["fft_threads"],
+                         help="Number of threads to calculate the spectra "
+                              "of the BPM chunks in parallel.")
+    params.add_parameter(name="fft_backend", type=str, default=HARPY_DEFAULTS["fft_backend"],
+                         choices=FFT_BACKENDS,
+                         help="Library to calculate the FFTs. 'numpy' is single-threaded, 'scipy' "
+                              "and 'pyfftw' (if installed) use fft_workers threads per FFT.")
+    params.add_parameter(name="fft_workers", type=int, default=HARPY_DEFAULTS["fft_workers"],
+                         help="Number of threads per FFT of the 'scipy' and 'pyfftw' FFT backends.")
+    params.add_parameter(name="fft_wisdom", type=str,
+                         help="File to load the FFTW wisdom from and to save it to, for the "
+                              "'pyfftw' FFT backend. This avoids planning the same FFTs again "
+                              "in later runs.")
     return params
 
 
@@ -559,6 +765,8 @@ def _optics_entrypoint(params):
     
     if "rdt" in options.nonlinear and not 2 <= options.rdt_magnet_order <= 8:
         raise AttributeError("The magnet order for RDT calculation should be between 2 and 8 (inclusive).")
+    if options.num_processes < 1:
+        raise AttributeError("The number of processes for the optics measurement should be at least 1.")
 
     return options, rest
 
@@ -604,6 +812,13 @@ def optics_params():
                          help="Calculate second order dispersion")
     params.add_parameter(name="chromatic_beating", action="store_true",
                          help="Calculate chromatic beatings: W, PHI and coupling")
+    params.add_parameter(name="num_processes", type=int, default=OPTICS_DEFAULTS["num_processes"],
+                         help="Number of threads used to read the lin files and to run the independent "
+                              "stages of the analysis, e.g. the two planes, in parallel. "
+                              "The analysis is serial if set to 1.")
+    params.add_parameter(name="column_projection", action="store_true",
+                         help="Only read the secondary lines of the lin files needed by the requested "
+                              "analyses. Other lines are read from the files when first used.")
     return params
 
 
@@ -614,6 +829,8 @@ HARPY_DEFAULTS = {
     "peak_to_peak": 1e-8,
     "max_peak": 0.02,
     "svd_dominance_limit": 0.925,
+    "svd_engine": "exact",
+    "svd_tolerance": 1e-4,
     "num_svd_iterations": 3,
     "tolerance": 0.01,
     "tune_clean_limit": 1e-5,
@@ -623,6 +840,11 @@ HARPY_DEFAULTS = {
     "to_write": ["lin", "bpm_summary"],
     "tbt_datatype": "lhc",
     "resonances": 4,
+    "num_processes": 1,
+    "spectral_engine": "fft",
+    "fft_threads": 1,
+    "fft_backend": "numpy",
+    "fft_workers": 1,
 }
 
 OPTICS_DEFAULTS = {
@@ -631,6 +853,7 @@ OPTICS_DEFAULTS = {
         "range_of_bpms": 11,
         "compensation": "model",
         "rdt_magnet_order": 4,
+        "num_processes": 1,
 }
 
 
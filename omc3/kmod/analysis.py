@@ -6,6 +6,7 @@ This module contains the analysis functionality of ``kmod``.
 It provides functions to calculate beta functions at different locations from K-modulation data.
 """
 import datetime
+from typing import NamedTuple
 
 import numpy as np
 import scipy.optimize
@@ -324,35 +325,160 @@ def phase_constraint(kmod_input_params, plane):
 
 
 def chi2(x, foc_magnet_df, def_magnet_df, plane, kmod_input_params, sign, BPM_distance, phase_adv_constraint):
+    """ Sum of squares of the ``waist_residuals`` of a single fit, at beta-waist ``x[0]`` and waist ``x[1]``. """
+    params = get_waist_fit_parameters(foc_magnet_df, def_magnet_df, plane, kmod_input_params, np.atleast_2d(sign),
+                                      BPM_distance, phase_adv_constraint)
+    return np.sum(waist_residuals(params, x[:1], x[1:]) ** 2)
 
-    b = x[0]
-    w = x[1]
 
-    if kmod_input_params.interaction_point:
+class WaistFitParameters(NamedTuple):
+    """
+    Parameters of the beta-waist fits as arrays, with one entry per fit, i.e. per row of the signs
+    from ``return_sign_for_err`` (the first being the nominal fit).
+    The quadrupole parameters are given for the focusing (``foc_``) and defocusing (``def_``) one.
+    """
+    foc_length: np.ndarray
+    foc_k: np.ndarray
+    foc_lstar: np.ndarray
+    foc_beta: np.ndarray
+    def_length: np.ndarray
+    def_k: np.ndarray
+    def_lstar: np.ndarray
+    def_beta: np.ndarray
+    beta_norm: float
+    phase_adv: np.ndarray
+    phase_adv_norm: float
+    phase_weight: float
+    bpm_distance: float
+
+    def take(self, index):
+        """ Returns the parameters of the fits at ``index``. """
+        return WaistFitParameters(*(value[index] if isinstance(value, np.ndarray) else value for value in self))
+
+
+def get_waist_fit_parameters(foc_magnet_df, def_magnet_df, plane, kmod_input_params, sign, BPM_distance,
+                             phase_adv_constraint) -> WaistFitParameters:
+    """ Gathers the parameters used in ``chi2`` for all rows of ``sign`` into `WaistFitParameters`. """
+    foc_beta, def_beta = (df.headers[f"{AVERAGE}{BETA}{plane}"] for df in (foc_magnet_df, def_magnet_df))
+    foc_err, def_err = (df.headers[f"{ERR}{AVERAGE}{BETA}{plane}"] for df in (foc_magnet_df, def_magnet_df))
+    return WaistFitParameters(
+        foc_length=foc_magnet_df.headers['LENGTH'] + sign[:, 0] * kmod_input_params.errorL,
+        foc_k=foc_magnet_df.headers[K] + sign[:, 1] * kmod_input_params.errorK * foc_magnet_df.headers[K],
+        foc_lstar=foc_magnet_df.headers['LSTAR'] + sign[:, 2] * kmod_input_params.misalignment,
+        foc_beta=foc_beta - sign[:, 3] * foc_err,
+        def_length=def_magnet_df.headers['LENGTH'] + sign[:, 4] * kmod_input_params.errorL,
+        def_k=def_magnet_df.headers[K] + sign[:, 5] * kmod_input_params.errorK * def_magnet_df.headers[K],
+        def_lstar=def_magnet_df.headers['LSTAR'] + sign[:, 6] * kmod_input_params.misalignment,
+        def_beta=def_beta - sign[:, 7] * def_err,
+        beta_norm=2.0 * (foc_beta + def_beta),
+        phase_adv=phase_adv_constraint[0] + sign[:, 8] * phase_adv_constraint[1],
+        phase_adv_norm=phase_adv_constraint[0],
+        phase_weight=kmod_input_params.phase_weight if kmod_input_params.interaction_point else 0,
+        bpm_distance=BPM_distance,
+    )
+
+
+def waist_residuals(params: WaistFitParameters, b, w):
+    """
+    Residuals of the beta-waist fits, whose sum of squares is ``chi2``, for arrays of
+    beta-waists ``b`` and waists ``w`` (one per fit). Returns an array of shape (3, fits).
+    """
+    beta_weight, phase_weight = np.sqrt(1 - params.phase_weight), np.sqrt(params.phase_weight)
+    return np.array([
+        beta_weight * (average_beta_focussing_quadrupole(b, w, params.foc_length, params.foc_k, params.foc_lstar)
+                       - params.foc_beta) / params.beta_norm,
+        beta_weight * (average_beta_defocussing_quadrupole(b, -w, params.def_length, params.def_k, params.def_lstar)
+                       - params.def_beta) / params.beta_norm,
+        phase_weight * (_phase_adv_from_kmod_value(params.bpm_distance, b, w) - params.phase_adv)
+        / params.phase_adv_norm,
+    ])
+
+
+def waist_jacobian(params: WaistFitParameters, b, w):
+    """ Analytic derivatives of ``waist_residuals`` by ``b`` and ``w``, of shape (3, 2, fits). """
+    beta_weight, phase_weight = np.sqrt(1 - params.phase_weight), np.sqrt(params.phase_weight)
+    jacobian = np.empty((3, 2, np.size(b)))
+    for row, (length, k, lstar, focussing) in enumerate((
+            (params.foc_length, params.foc_k, params.foc_lstar, True),
+            (params.def_length, params.def_k, params.def_lstar, False))):
+        # average beta = A * beta0 - C * alpha0 + B * gamma0, with gamma0 = 1 / b at the waist
+        a_coef, c_coef, b_coef = _average_beta_coefficients(length, k, focussing)
+        s = lstar - w if focussing else lstar + w
+        d_average_beta_db = a_coef * (1 - s ** 2 / b ** 2) - c_coef * s / b ** 2 - b_coef / b ** 2
+        d_average_beta_ds = 2 * a_coef * s / b + c_coef / b
+        jacobian[row, 0] = beta_weight * d_average_beta_db / params.beta_norm
+        jacobian[row, 1] = beta_weight * d_average_beta_ds * (-1 if focussing else 1) / params.beta_norm
+    l_minus, l_plus = params.bpm_distance - w, params.bpm_distance + w
+    d_phase_db = -(l_minus / (b ** 2 + l_minus ** 2) + l_plus / (b ** 2 + l_plus ** 2)) / (2 * np.pi)
+    d_phase_dw = (-b / (b ** 2 + l_minus ** 2) + b / (b ** 2 + l_plus ** 2)) / (2 * np.pi)
+    jacobian[2, 0] = phase_weight * d_phase_db / params.phase_adv_norm
+    jacobian[2, 1] = phase_weight * d_phase_dw / params.phase_adv_norm
+    return jacobian
+
+
+def _average_beta_coefficients(length, k, focussing):
+    """ Coefficients of beta0, -alpha0 and gamma0 in the average beta in the quadrupole. """
+    sqrt_k = np.sqrt(abs(k))
+    if focussing:
+        sinc_2 = np.sin(2 * sqrt_k * length) / (2 * sqrt_k * length)
+        return (1 + sinc_2) / 2, np.sin(sqrt_k * length) ** 2 / (abs(k) * length), (1 - sinc_2) / (2 * abs(k))
+    sinhc_2 = np.sinh(2 * sqrt_k * length) / (2 * sqrt_k * length)
+    return (1 + sinhc_2) / 2, np.sinh(sqrt_k * length) ** 2 / (abs(k) * length), (sinhc_2 - 1) / (2 * abs(k))
+
+
+def fit_beta_waist(params: WaistFitParameters, x0) -> np.ndarray:
+    """
+    Minimises ``chi2``, as the sum of squares of ``waist_residuals``, for all fits in ``params``.
+    The nominal (first) fit is found with Nelder-Mead from ``x0`` and refined by least-squares.
+    The perturbed fits start from the nominal result and are solved together,
+    as one least-squares problem of independent blocks.
+    Fits with the same parameters as the nominal one take its result and fits which are not
+    finite at their starting point stay there.
+
+    Returns:
+        Array of shape (fits, 2) with the beta-waist and waist of each fit.
+    """
+    x0 = np.asarray(x0, dtype=float)
+    nominal_params = params.take(slice(0, 1))
 
-        phase_adv = phase_adv_from_kmod(BPM_distance, b, 0.0, w, 0.0)[0]
-        weight = kmod_input_params.phase_weight
-    else:
-        phase_adv = 0.0
-        weight = 0
-
-    c2 = (1-weight)*(((average_beta_focussing_quadrupole(b, w, foc_magnet_df.headers['LENGTH'] +
-        sign[0] * kmod_input_params.errorL, foc_magnet_df.headers[K] +
-        sign[1] * kmod_input_params.errorK * foc_magnet_df.headers[K],
-        foc_magnet_df.headers['LSTAR'] +
-        sign[2] * kmod_input_params.misalignment) -
-        foc_magnet_df.headers[f"{AVERAGE}{BETA}{plane}"] +
-        sign[3] * foc_magnet_df.headers[f"{ERR}{AVERAGE}{BETA}{plane}"])/(def_magnet_df.headers[f"{AVERAGE}{BETA}{plane}"] + foc_magnet_df.headers[f"{AVERAGE}{BETA}{plane}"])/2.0) ** 2 +
-        ((average_beta_defocussing_quadrupole(b, -w, def_magnet_df.headers['LENGTH'] +
-        sign[4] * kmod_input_params.errorL, def_magnet_df.headers[K] +
-        sign[5] * kmod_input_params.errorK * def_magnet_df.headers[K],
-        def_magnet_df.headers['LSTAR'] +
-        sign[6] * kmod_input_params.misalignment) -
-        def_magnet_df.headers[f"{AVERAGE}{BETA}{plane}"] +
-        sign[7] * def_magnet_df.headers[f"{ERR}{AVERAGE}{BETA}{plane}"])/(foc_magnet_df.headers[f"{AVERAGE}{BETA}{plane}"] + def_magnet_df.headers[f"{AVERAGE}{BETA}{plane}"])/2.0) ** 2) + \
-        weight*(((phase_adv - (phase_adv_constraint[0]+sign[8]*phase_adv_constraint[1]))/phase_adv_constraint[0])**2)
-
-    return c2
+    def fun(x): return np.sum(waist_residuals(nominal_params, x[:1], x[1:]) ** 2)
+    nominal = scipy.optimize.minimize(fun=fun, x0=x0, method='nelder-mead', tol=1E-22).x
+    nominal = _least_squares(nominal_params, nominal)[0]
+
+    results = np.tile(nominal, (len(params.foc_k), 1))
+    per_fit = np.array([value for value in params if isinstance(value, np.ndarray)])
+    perturbed = np.flatnonzero(np.any(per_fit != per_fit[:, :1], axis=0))
+    if len(perturbed):
+        results[perturbed] = _least_squares(params.take(perturbed), nominal)
+    return results
+
+
+def _least_squares(params: WaistFitParameters, x0) -> np.ndarray:
+    """
+    Solves the independent fits in ``params`` in one least-squares problem, from ``x0`` for each.
+    Fits with non-finite residuals at ``x0`` are left there, as ``chi2`` can not be minimised for them.
+    """
+    results = np.tile(x0, (len(params.foc_k), 1))
+    finite = np.flatnonzero(np.all(np.isfinite(waist_residuals(params, results[:, 0], results[:, 1])), axis=0))
+    if not len(finite):
+        return results
+    params = params.take(finite)
+    n_fits = len(finite)
+
+    def residuals(x):
+        return waist_residuals(params, x[0::2], x[1::2]).T.ravel()
+
+    def jacobian(x):
+        blocks = waist_jacobian(params, x[0::2], x[1::2])  # (3, 2, fits)
+        jac = np.zeros((3 * n_fits, 2 * n_fits))
+        for fit in range(n_fits):
+            jac[3 * fit:3 * fit + 3, 2 * fit:2 * fit + 2] = blocks[:, :, fit]
+        return jac
+
+    result = scipy.optimize.least_squares(residuals, np.tile(x0, n_fits), jac=jacobian, method="lm",
+                                          xtol=1e-15, ftol=1e-15, gtol=1e-15)
+    results[finite] = result.x.reshape(n_fits, 2)
+    return results
 
 
 def get_beta_waist(magnet1_df, magnet2_df, kmod_input_params, plane):
@@ -360,19 +486,12 @@ def get_beta_waist(magnet1_df, magnet2_df, kmod_input_params, plane):
     n = 9
     sign = return_sign_for_err(n)
     foc_magnet_df, def_magnet_df = return_df(magnet1_df, magnet2_df, plane)
-    results = np.zeros((2*n+1, 2))
     BPML, BPMR = get_BPM(kmod_input_params)
     BPM_distance = get_BPM_distance(kmod_input_params, BPML, BPMR)
     phase_adv_constraint = phase_constraint(kmod_input_params, plane)
-    for i, s in enumerate(sign):
-
-        def fun(x): return chi2(x, foc_magnet_df, def_magnet_df, plane, kmod_input_params, s, BPM_distance, phase_adv_constraint)
-        fitresults = scipy.optimize.minimize(fun=fun,
-                                             x0=kmod_input_params.betastar_and_waist[plane],
-                                             method='nelder-mead',
-                                             tol=1E-22)
-
-        results[i, :] = fitresults.x[0], fitresults.x[1]
+    fit_params = get_waist_fit_parameters(foc_magnet_df, def_magnet_df, plane, kmod_input_params, sign,
+                                          BPM_distance, phase_adv_constraint)
+    results = fit_beta_waist(fit_params, kmod_input_params.betastar_and_waist[plane])
 
     beta_waist_err = get_err(results[1::2, 0]-results[0, 0])
     waist_err = get_err(results[1::2, 1]-results[0, 1])
@@ -11,7 +11,6 @@ import re
 import numpy as np
 import pandas as pd
 import tfs
-from scipy.linalg import circulant
 
 from omc3 import __version__ as VERSION
 from omc3.definitions.constants import PI2
@@ -73,7 +72,7 @@ def n_bpm_method(meas_input, phase, plane, meas_and_mdl_tunes):
 
     Args:
         meas_input: Optics measurement configuration object.
-        phase: phase matrices of measurement with errors and model tfs (bpm x bpm).
+        phase: `PhaseAdvances` of measurement with errors and model (bpm x bpm).
         plane: marking the horizontal or vertical plane, **X** or **Y**.
         meas_and_mdl_tunes: measured and model tunes.
 
@@ -81,7 +80,7 @@ def n_bpm_method(meas_input, phase, plane, meas_and_mdl_tunes):
         `TfsDataFrame` containing betas and alfas from phase.
     """
     n_bpms = meas_input.range_of_bpms
-    n_bpms_phases = len(phase["MEAS"].index)
+    n_bpms_phases = len(phase)
     if n_bpms_phases < n_bpms:
         LOGGER.warning(f"Found {n_bpms_phases} BPMs, but {n_bpms} "
                         "were requested in N-BPM method. Using all available BPMs instead,"
@@ -96,77 +95,94 @@ def n_bpm_method(meas_input, phase, plane, meas_and_mdl_tunes):
     beta_df = _get_filtered_model_df(meas_input, phase, plane)
     bk_model = _get_filtered_model_df(meas_input, phase, plane, best=True)
     tune, mdltune = meas_and_mdl_tunes
-    betas_alfas = np.zeros((len(phase["MEAS"].index), 4))
+    betas_alfas = np.zeros((len(phase), 4))
     nbpms = len(bk_model.index)
     n_comb = np.zeros(nbpms, dtype=int)
     m = int(n_bpms / 2)
     loc_range = np.arange(-m, m + 1)
-    phases_meas = phase["MEAS"] * PI2
-    phases_err = phase["ERRMEAS"] * PI2
-    phases_err.where(phases_err.notnull(), 1, inplace=True)
-
-    for indx, probed_bpm_name in enumerate(bk_model.index):
-        indx_el_first = elements.index.get_loc(bk_model.index[(indx - m) % nbpms])
-        indx_el_last = elements.index.get_loc(bk_model.index[(indx + m) % nbpms])
-        mu_column = "MU" + plane
-        if indx < m:
-            outer_meas_phase_adv = pd.concat((phases_meas.iloc[indx, nbpms + indx - m:] - tune * PI2, phases_meas.iloc[indx, :indx + m + 1]))
-            outer_meas_err = pd.concat((phases_err.iloc[indx, nbpms + indx - m:], phases_err.iloc[indx, :indx + m + 1]))
-            outer_mdl_ph = np.concatenate((bk_model.iloc[nbpms + indx - m:][mu_column] - mdltune, bk_model.iloc[:indx + m + 1][mu_column])) * PI2
-            outer_elmts = pd.concat((elements.iloc[indx_el_first:], elements.iloc[:indx_el_last + 1]))
-            outer_elmts_ph = np.concatenate((elements.iloc[indx_el_first:][mu_column] - mdltune, elements.iloc[:indx_el_last + 1][mu_column])) * PI2
-        elif indx + m >= nbpms:
-            outer_meas_phase_adv = pd.concat((phases_meas.iloc[indx, indx - m:], phases_meas.iloc[indx, :indx + m + 1 - nbpms] + tune * PI2))
-            outer_meas_err = pd.concat((phases_err.iloc[indx, indx - m:], phases_err.iloc[indx, :indx + m + 1 - nbpms]))
-            outer_mdl_ph = np.concatenate((bk_model.iloc[indx - m:][mu_column], bk_model.iloc[:indx + m + 1 - nbpms][mu_column] + mdltune)) * PI2
-            outer_elmts = pd.concat((elements.iloc[indx_el_first:], elements.iloc[:indx_el_last + 1]))
-            outer_elmts_ph = np.concatenate((elements.iloc[indx_el_first:][mu_column], elements.iloc[:indx_el_last + 1][mu_column] + mdltune)) * PI2
-        else:
-            outer_meas_phase_adv = phases_meas.iloc[indx, indx + loc_range]
-            outer_meas_err = phases_err.iloc[indx, indx + loc_range]
-            outer_mdl_ph = bk_model.iloc[indx + loc_range][mu_column].to_numpy() * PI2
-            outer_elmts = elements.iloc[indx_el_first:indx_el_last + 1]
-            outer_elmts_ph = elements.iloc[indx_el_first:indx_el_last + 1][mu_column].to_numpy() * PI2
-        # bpms_inds_elements was not used (jdilly)
-        # bpms_inds_elements = [outer_elmts.index.get_loc(bpm_name) for bpm_name in outer_meas_phase_adv.index.to_numpy()]
-        sin_squared_elements = np.square(np.sin(
-            outer_elmts_ph[:, np.newaxis] - outer_mdl_ph[np.newaxis, :]
-        ))
-        with np.errstate(divide='ignore'):
-            cot_meas = 1.0 / np.tan(outer_meas_phase_adv.to_numpy())
-            cot_model = 1.0 / np.tan((outer_mdl_ph - outer_mdl_ph[m]))
+
+    # phases in the range of BPMs around each probed BPM (BPMs x range),
+    # with the tune added where wrapping around the ring
+    range_positions = np.arange(nbpms)[:, np.newaxis] + loc_range[np.newaxis, :]
+    wraps = range_positions // nbpms
+    phases_meas = phase.band("MEAS", loc_range).T * PI2 + wraps * tune * PI2
+    phases_err = phase.band("ERRMEAS", loc_range).T * PI2
+    phases_err[np.isnan(phases_err)] = 1
+    phases_mdl = (bk_model[f"MU{plane}"].to_numpy()[range_positions % nbpms] + wraps * mdltune) * PI2
+    elements_ph, elements_bet, weights, bpm_locs = _get_elements_in_range(elements, bk_model.index,
+                                                                          plane, mdltune, m)
+
+    # all combinations of two BPMs in the range (BPMs x combinations)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cot_meas = 1.0 / np.tan(phases_meas)
+        cot_model = 1.0 / np.tan(phases_mdl - phases_mdl[:, m:m + 1])
+        ix, iy = np.triu_indices(2 * m + 1, k=1)
+        dif_cot_model = cot_model[:, ix] - cot_model[:, iy]
+        dif_cot_meas = cot_meas[:, ix] - cot_meas[:, iy]
         patter = (np.abs(cot_meas) <= COT_THRESHOLD) & (np.abs(cot_model) <= COT_THRESHOLD)
-        diag = np.concatenate((np.square(outer_meas_err.to_numpy()), outer_elmts.loc[:]["dK1"],
-                               outer_elmts.loc[:]["dX"], outer_elmts.loc[:]["KdS"],
-                               outer_elmts.loc[:]["mKdS"]))
-        outer_elmts = outer_elmts.rename(columns={"BET" + plane: "BETA"})
-        index_tuples = [[x, y] for x in loc_range[patter] + m for y in loc_range[patter] + m
-                        if (x < y) and (abs(cot_model[x] - cot_model[y]) > ZERO_THRESHOLD) and
-                        (np.sign(cot_model[x] - cot_model[y]) * np.sign(cot_meas[x] - cot_meas[y]) > 0)]
-        mat_t_beta, mat_t_alpha = np.zeros((len(index_tuples), len(diag))), np.zeros((len(index_tuples), len(diag)))
-        betas, alphas = np.empty(len(index_tuples)), np.empty(len(index_tuples))
-        for i, c in enumerate(index_tuples):
-            betas[i], alphas[i], mat_t_beta[i], mat_t_alpha[i] = \
-                calculate_beta_alpha_from_single_combination(c, sin_squared_elements, outer_elmts, cot_model,
-                                                             cot_meas, outer_meas_phase_adv, probed_bpm_name,
-                                                             bk_model.at[probed_bpm_name, "BET" + plane],
-                                                             bk_model.at[probed_bpm_name, "ALF" + plane], meas_input.range_of_bpms)
-
-        mask = diag != 0
-        mat_diag = np.diag(diag[mask])
-        mat_v_beta = np.dot(mat_t_beta[:, mask], np.dot(mat_diag, np.transpose(mat_t_beta[:, mask])))
-        mat_v_alpha = np.dot(mat_t_alpha[:, mask], np.dot(mat_diag, np.transpose(mat_t_alpha[:, mask])))
-
-        if np.any(mat_v_beta) and np.any(mat_v_alpha):
-            beti, beterr = _covariant_weighting(mat_v_beta, betas)
-            alfi, alferr = _covariant_weighting(mat_v_alpha, alphas)
-            n_comb[indx] = len(betas)
-        else:
-            LOGGER.debug(f"ValueError or no combinations left at {probed_bpm_name}.")
-            LOGGER.debug(f"betas:\n{betas}")
-            LOGGER.debug(f"alphas:\n{alphas}")
-            continue
-        betas_alfas[indx, :] = np.array([beti, beterr, alfi, alferr])
+        combinations = (patter[:, ix] & patter[:, iy] & (np.abs(dif_cot_model) > ZERO_THRESHOLD)
+                        & (np.sign(dif_cot_model) * np.sign(dif_cot_meas) > 0))
+
+    betmdl1 = bk_model[f"BET{plane}"].to_numpy()[:, np.newaxis]
+    alfmdl1 = bk_model[f"ALF{plane}"].to_numpy()[:, np.newaxis]
+    denom = dif_cot_model / betmdl1
+    denomalf = 2 * ((cot_model[:, ix] + cot_model[:, iy]) / 2 + alfmdl1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        betas = dif_cot_meas / denom
+        alphas = 0.5 * (denomalf * dif_cot_meas / dif_cot_model - (cot_meas[:, ix] + cot_meas[:, iy]))
+        # factor of the lattice errors in the alpha covariance
+        alpha_factors = 0.5 * (denomalf + dif_cot_meas / betmdl1) / denom
+
+    # sin^2 of the phase advances from the elements to the BPMs in the range (BPMs x range x elements)
+    sin_squared_elements = np.square(np.sin(elements_ph[:, np.newaxis, :] - phases_mdl[:, :, np.newaxis]))
+    probed = np.arange(nbpms)
+    denom_sin = sin_squared_elements[probed[:, np.newaxis], m, bpm_locs]
+    # elements between each BPM in the range and the probed BPM, weighted with their beta
+    elements_locs = np.arange(elements_ph.shape[1])[np.newaxis, np.newaxis, :]
+    between = ((elements_locs >= np.minimum(bpm_locs, bpm_locs[:, m:m + 1])[:, :, np.newaxis])
+               & (elements_locs < np.maximum(bpm_locs, bpm_locs[:, m:m + 1])[:, :, np.newaxis]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bet_sin = np.where(between, sin_squared_elements * elements_bet[:, np.newaxis, :]
+                           / denom_sin[:, :, np.newaxis], 0)
+    sign = np.sign(np.arange(2 * m + 1) - int(meas_input.range_of_bpms / 2))
+
+    n_combinations = np.sum(combinations, axis=1)
+    for n in np.unique(n_combinations[n_combinations > 0]):
+        indx = np.flatnonzero(n_combinations == n)
+        comb = np.nonzero(combinations[indx])[1].reshape(len(indx), n)
+        c_x, c_y = ix[comb], iy[comb]
+        c_denom = np.take_along_axis(denom[indx], comb, axis=1)
+        c_denomalf = np.take_along_axis(denomalf[indx], comb, axis=1)
+        sin_x = np.take_along_axis(denom_sin[indx], c_x, axis=1)
+        sin_y = np.take_along_axis(denom_sin[indx], c_y, axis=1)
+        betmdl = betmdl1[indx]
+
+        # lines of the phase errors and the lattice errors of each combination
+        line_beta = _get_combination_lines(c_x, c_y, -1 / (sin_x * c_denom), 1 / (sin_y * c_denom), m)
+        line_alpha = _get_combination_lines(
+            c_x, c_y,
+            -1 / (sin_x * c_denom * betmdl) * c_denomalf + 1 / sin_x,
+            1 / (sin_y * c_denom * betmdl) * c_denomalf + 1 / sin_y, m)
+        line_lattice = np.einsum("nck,nkl->ncl", _get_combination_lines(c_x, c_y, -sign[c_x], sign[c_y], m),
+                                 bet_sin[indx])
+        lattice_cov = {key: np.einsum("ncl,nl,ndl->ncd", line_lattice, weight[indx], line_lattice)
+                       for key, weight in weights.items()}
+        phase_cov_beta = np.einsum("nck,nk,ndk->ncd", line_beta, np.square(phases_err[indx]), line_beta)
+        phase_cov_alpha = np.einsum("nck,nk,ndk->ncd", line_alpha, np.square(phases_err[indx]), line_alpha)
+        inv_denom = 1 / (c_denom[:, :, np.newaxis] * c_denom[:, np.newaxis, :])
+        factors = np.take_along_axis(alpha_factors[indx], comb, axis=1)
+        mat_v_beta = phase_cov_beta + lattice_cov["BET"] * inv_denom
+        mat_v_alpha = (phase_cov_alpha + lattice_cov["ALF"] * factors[:, :, np.newaxis] * factors[:, np.newaxis, :]
+                       + lattice_cov["ALF_K2"] * inv_denom)
+
+        valid = np.any(mat_v_beta, axis=(1, 2)) & np.any(mat_v_alpha, axis=(1, 2))
+        if not np.all(valid):
+            LOGGER.debug(f"No combinations left at {list(bk_model.index[indx[~valid]])}.")
+        indx, comb = indx[valid], comb[valid]
+        beti, beterr = _covariant_weighting(mat_v_beta[valid], np.take_along_axis(betas[indx], comb, axis=1))
+        alfi, alferr = _covariant_weighting(mat_v_alpha[valid], np.take_along_axis(alphas[indx], comb, axis=1))
+        n_comb[indx] = n
+        betas_alfas[indx, :] = np.column_stack((beti, beterr, alfi, alferr))
 
     beta_df[f"BET{plane}"] = betas_alfas[:, 0]
     beta_df[f"{ERR}BET{plane}"] = betas_alfas[:, 1]
@@ -198,115 +214,58 @@ def get_elements_with_errors(meas_input, plane):
     return elements, error_method
 
 
-def calculate_beta_alpha_from_single_combination(c, sin_squared_elements, outer_elmts, cot_model,
-                                                 cot_meas, outer_meas_phase_adv, probed_bpm_name,
-                                                 betmdl1, alfmdl1, range_of_bpms):
+def _get_elements_in_range(elements, bpms, plane, mdltune, m):
     """
-    Calculates beta and alpha functions as well as the respective covariance matrix lines for the
-    given BPM combination (triplet).
-
-    Args:
-        c: relative indices of other two BPMs wrt probed one.
-        sin_squared_elements:
-        outer_elmts:
-        cot_model:
-        cot_meas:
-        outer_meas_phase_adv:
-        probed_bpm_name:
-        betmdl1:
-        alfmdl1:
-        range_of_bpms:
+    Gets the elements with errors in the range of ``m`` BPMs on either side of each BPM, padded to the
+    longest range, with the tune added where wrapping around the ring.
 
     Returns:
-
+        The phases and the betas of the elements (BPMs x elements), the weights of the lattice errors
+        in the covariances of beta (``BET``) and alpha (``ALF`` and ``ALF_K2``) and the locations
+        of the BPMs of the range among the elements (BPMs x range).
     """
-    m = int(range_of_bpms / 2)
-    ix = c[0]
-    iy = c[1]
-    fac1, fac2 = -np.sign(c[0]-m), np.sign(c[1]-m)
-    dif_cot_model = cot_model[ix] - cot_model[iy]
-    # calculate beta
-    dif_cot_meas = cot_meas[ix] - cot_meas[iy]
-    denom = dif_cot_model / betmdl1
-    beta_i = dif_cot_meas / denom
-    avg_cot_model = (cot_model[ix] + cot_model[iy]) / 2
-    denomalf = 2 * (avg_cot_model + alfmdl1)
-    avg_cot_meas = (cot_meas[ix] + cot_meas[iy]) / 2
-
-    alfa_i = 0.5 * (denomalf * dif_cot_meas / dif_cot_model - 2 * avg_cot_meas)
-
-    lng = len(outer_elmts)
-    line_length = 4 * len(outer_elmts.index) + 2 * m + 1
-    outer_elmts_bet = outer_elmts.loc[:, "BETA"].to_numpy()
-    outer_el_k2 = outer_elmts.loc[:, "K2L"].to_numpy()
-    betaline = np.zeros(line_length)
-    alfaline = np.zeros(line_length)
-
-    # slice
-    mloc = outer_elmts.index.get_loc(probed_bpm_name)
-    xloc_r = outer_elmts.index.get_loc(outer_meas_phase_adv.index[ix])
-    yloc_r = outer_elmts.index.get_loc(outer_meas_phase_adv.index[iy])
-    denom_sinx = sin_squared_elements[xloc_r, m]
-    denom_siny = sin_squared_elements[yloc_r, m]
-    xmloc1, xmloc2 = min(xloc_r, mloc), max(xloc_r, mloc)
-    ymloc1, ymloc2 = min(yloc_r, mloc), max(yloc_r, mloc)
-
-    # get betas and sin for the elements in the slice
-    elem_ph_xa = sin_squared_elements[xmloc1:xmloc2, ix]
-    elem_ph_ya = sin_squared_elements[ymloc1:ymloc2, iy]
-    elem_beta_xa = outer_elmts_bet[xmloc1:xmloc2]
-    elem_beta_ya = outer_elmts_bet[ymloc1:ymloc2]
-    elem_k2_xa = outer_el_k2[xmloc1:xmloc2]
-    elem_k2_ya = outer_el_k2[ymloc1:ymloc2]
-
-    bet_sin_ix = elem_ph_xa * elem_beta_xa / (denom_sinx * denom)
-    bet_sin_iy = elem_ph_ya * elem_beta_ya / (denom_siny * denom)
-
-    off1 = range_of_bpms
-    off2 = range_of_bpms + lng
-    off3 = range_of_bpms + 2 * lng
-    off4 = range_of_bpms + 3 * lng
-
-    # apply phase uncertainty
-    betaline[ix] = -1 / (denom_sinx * denom)
-    betaline[iy] = 1 / (denom_siny * denom)
-    # apply quadrupolar field uncertainty (quadrupole longitudinal misalignment already included)
-    betaline[xmloc1 + off1:xmloc2 + off1] += fac1 * bet_sin_ix
-    betaline[ymloc1 + off1:ymloc2 + off1] += fac2 * bet_sin_iy
-    # apply sextupole transverse misalignment
-    betaline[xmloc1 + off2: xmloc2 + off2] += fac1 * elem_k2_xa * bet_sin_ix
-    betaline[ymloc1 + off2: ymloc2 + off2] += fac2 * elem_k2_ya * bet_sin_iy
-    # apply quadrupole longitudinal misalignments
-    betaline[xmloc1 + off3: xmloc2 + off3] += fac1 * bet_sin_ix
-    betaline[ymloc1 + off3: ymloc2 + off3] += fac2 * bet_sin_iy
-    betaline[xmloc1 + off4: xmloc2 + off4] -= fac1 * bet_sin_ix
-    betaline[ymloc1 + off4: ymloc2 + off4] -= fac2 * bet_sin_iy
-    # apply phase uncertainty
-    alfaline[ix] = -1 / (denom_sinx * denom * betmdl1) * denomalf + 1 / denom_sinx
-    alfaline[iy] = 1 / (denom_siny * denom * betmdl1) * denomalf + 1 / denom_siny
-    # apply quadrupolar field uncertainty (quadrupole longitudinal misalignment already included)
-    alfaline[xmloc1 + off1:xmloc2 + off1] += fac1 * (.5 * (bet_sin_ix * denomalf + bet_sin_ix / betmdl1 * dif_cot_meas))
-    alfaline[ymloc1 + off1:ymloc2 + off1] += fac2 * (.5 * (bet_sin_iy * denomalf + bet_sin_iy / betmdl1 * dif_cot_meas))
-    # apply sextupole transverse misalignment
-    alfaline[xmloc1 + off2: xmloc2 + off2] += fac1 * elem_k2_xa * bet_sin_ix
-    alfaline[ymloc1 + off2: ymloc2 + off2] += fac2 * elem_k2_ya * bet_sin_iy
-    # apply quadrupole longitudinal misalignments
-    alfaline[xmloc1 + off3: xmloc2 + off3] += fac1 * (.5 * elem_k2_xa * (bet_sin_ix * denomalf + bet_sin_ix / betmdl1 * dif_cot_meas))
-    alfaline[ymloc1 + off3: ymloc2 + off3] += fac2 * (.5 * elem_k2_ya * (bet_sin_iy * denomalf + bet_sin_iy / betmdl1 * dif_cot_meas))
-    alfaline[xmloc1 + off4: xmloc2 + off4] -= fac1 * (.5 * (bet_sin_ix * denomalf + bet_sin_ix / betmdl1 * dif_cot_meas))
-    alfaline[ymloc1 + off4: ymloc2 + off4] -= fac2 * (.5 * (bet_sin_iy * denomalf + bet_sin_iy / betmdl1 * dif_cot_meas))
-
-    return beta_i, alfa_i, betaline, alfaline
+    n_elements, n_bpms = len(elements), len(bpms)
+    bpm_elements = elements.index.get_indexer(bpms)
+    if np.any(bpm_elements < 0):
+        raise KeyError(f"BPMs {list(bpms[bpm_elements < 0])} not found in the elements with errors.")
+    # the elements of the previous, the current and the next turn make the ranges contiguous
+    range_positions = np.arange(n_bpms)[:, np.newaxis] + np.arange(-m, m + 1)[np.newaxis, :]
+    range_bpm_elements = bpm_elements[range_positions % n_bpms] + (range_positions // n_bpms + 1) * n_elements
+    first, last = range_bpm_elements[:, :1], range_bpm_elements[:, -1:]
+    element_positions = first + np.arange(np.max(last - first) + 1)[np.newaxis, :]
+    in_range = element_positions <= last
+    element_positions = np.minimum(element_positions, 3 * n_elements - 1)
+    turns = np.repeat(np.arange(-1, 2), n_elements)
+
+    def _in_range(column):
+        return np.where(in_range, np.tile(elements[column].to_numpy(), 3)[element_positions], 0)
+
+    phases = (np.tile(elements[f"MU{plane}"].to_numpy(), 3) + turns * mdltune)[element_positions] * PI2
+    k2l_squared = np.square(_in_range("K2L"))
+    weights = dict(BET=_in_range("dK1") + k2l_squared * _in_range("dX") + _in_range("KdS") + _in_range("mKdS"),
+                   ALF=_in_range("dK1") + k2l_squared * _in_range("KdS") + _in_range("mKdS"),
+                   ALF_K2=k2l_squared * _in_range("dX"))
+    return phases, _in_range(f"BET{plane}"), weights, range_bpm_elements - first
+
+
+def _get_combination_lines(c_x, c_y, values_x, values_y, m):
+    """ Lines over the range of BPMs of each combination, with values at the two BPMs used. """
+    lines = np.zeros(c_x.shape + (2 * m + 1,))
+    np.put_along_axis(lines, c_x[..., np.newaxis], np.broadcast_to(values_x, c_x.shape)[..., np.newaxis], axis=-1)
+    np.put_along_axis(lines, c_y[..., np.newaxis], np.broadcast_to(values_y, c_y.shape)[..., np.newaxis], axis=-1)
+    return lines
 
 
 def _covariant_weighting(mat, col):
+    """ Covariance weighted average and its error of ``col``, for a stack of matrices. """
     mat_inv = np.linalg.pinv(mat, rcond=RCOND)
-    wb = np.sum(mat_inv, axis=1)
-    mat_inv_sum = np.sum(wb)
-    if mat_inv_sum == 0:
+    wb = np.sum(mat_inv, axis=-1)
+    mat_inv_sum = np.sum(wb, axis=-1)
+    if np.any(mat_inv_sum == 0):
         raise ValueError
     # returns value and error
-    return float(np.dot(wb.T, col) / mat_inv_sum), np.sqrt(np.dot(wb.T, np.dot(mat, wb)) / mat_inv_sum ** 2)
+    return (np.einsum("...i,...i", wb, col) / mat_inv_sum,
+            np.sqrt(np.einsum("...i,...ij,...j", wb, mat, wb) / mat_inv_sum ** 2))
 
 
 def _assign_uncertainties(twiss_full, errordefspath):
@@ -363,7 +322,7 @@ def _get_header(header_dict, error_method, range_of_bpms, rmsbb):
 def three_bpm_method(meas_input, phase, plane, meas_and_mdl_tunes):
     """
     Calculates betas and alphas from using adjacent BPMs (3 combination).
-    ``phase["MEAS"]``, ``phase["MODEL"]``, ``phase["ERRMEAS"]`` (from ``get_phases``) are of the
+    The phase advances ``MEAS``, ``MODEL``, ``ERRMEAS`` (from ``phase.calculate``) are of the
     form:
 
     +----------+----------+----------+----------+----------+
@@ -376,7 +335,7 @@ def three_bpm_method(meas_input, phase, plane, meas_and_mdl_tunes):
     |   BPM3   |  phi_13  |  phi_23  |    0     |  phi_43  |
     +----------+----------+----------+----------+----------+
 
-    and ``tilt_slice_matrix(matrix, shift, slice, tune)`` brings it into the form:
+    and ``phase.band(kind, [-2, -1, 0, 1, 2], tune)`` gives the band around the diagonal in the form:
 
     +-----------+--------+--------+--------+--------+
     |           |  BPM1  |  BPM2  |  BPM3  |  BPM4  |
@@ -406,23 +365,24 @@ def three_bpm_method(meas_input, phase, plane, meas_and_mdl_tunes):
 
     Args:
         meas_input: Optics measurement configuration object.
-        phase: phase matrices of measurement with errors and model tfs (bpm x bpm).
+        phase: `PhaseAdvances` of measurement with errors and model (bpm x bpm).
         plane: marking the horizontal or vertical plane, **X** or **Y**.
         meas_and_mdl_tunes: measured  and model tunes.
 
     Returns:
         `TfsDataFrame` containing betas and alfas from phase.
     """
-    if len(phase["MEAS"].index) < 3:
+    if len(phase) < 3:
         raise ValueError("At least 3 BPMs are required for 3-BPM method!"
-                        f"Instead only {len(phase['MEAS'])} were found in input.")
+                        f"Instead only {len(phase)} were found in input.")
 
     tune, mdltune = meas_and_mdl_tunes
     beta_df = _get_filtered_model_df(meas_input, phase, plane)
-    # tilt phase advances in order to have the phase advances in a neighbourhood
-    tilted_meas = _tilt_slice_matrix(phase["MEAS"].to_numpy(), 2, 5, tune) * PI2
-    tilted_model = _tilt_slice_matrix(phase["MODEL"].to_numpy(), 2, 5, mdltune) * PI2
-    tilted_errmeas = _tilt_slice_matrix(phase["ERRMEAS"].to_numpy(), 2, 5, 0) * PI2
+    # band of phase advances in order to have the phase advances in a neighbourhood
+    neighbours = np.arange(-2, 3)
+    tilted_meas = phase.band("MEAS", neighbours, tune) * PI2
+    tilted_model = phase.band("MODEL", neighbours, mdltune) * PI2
+    tilted_errmeas = phase.band("ERRMEAS", neighbours) * PI2
     betmdl = beta_df.loc[:, f"BET{plane}{MDL}"].to_numpy()
     alfmdl = beta_df.loc[:, f"ALF{plane}{MDL}"].to_numpy()
     with np.errstate(divide='ignore'):
@@ -478,28 +438,9 @@ def _get_delta_columns(beta_df, plane):
     return beta_df
 
 
-def _tilt_slice_matrix(matrix, slice_shift, slice_width, tune=0):
-    """
-    Tilts and slices the ``matrix``.
-    Tilting means shifting each column upwards one step more than the previous columnns, i.e.
-
-    a a a a a       a b c d
-    b b b b b       b c d e
-    c c c c c  -->  c d e f
-    ...             ...
-    y y y y y       y z a b
-    z z z z z       z a b c
-    """
-    invrange = matrix.shape[0] - 1 - np.arange(matrix.shape[0])
-    matrix[matrix.shape[0] - slice_shift:, :slice_shift] += tune
-    matrix[:slice_shift, matrix.shape[1] - slice_shift:] -= tune
-    return np.roll(matrix[np.arange(matrix.shape[0]), circulant(invrange)[invrange]],
-                   slice_shift, axis=0)[:slice_width]
-
-
 def _get_filtered_model_df(meas_input, phase, plane, best=False):
     model = _try_best_model(meas_input) if best else meas_input.accelerator.model
-    df = pd.DataFrame(model).loc[phase["MEAS"].index, ["S", f"BET{plane}", f"ALF{plane}", f"MU{plane}"]]
+    df = pd.DataFrame(model).loc[phase.index, ["S", f"BET{plane}", f"ALF{plane}", f"MU{plane}"]]
     if not best:
         df.rename(columns={f"BET{plane}": f"BET{plane}{MDL}", f"ALF{plane}": f"ALF{plane}{MDL}", f"MU{plane}": f"MU{plane}{MDL}"}, inplace=True)
     return df
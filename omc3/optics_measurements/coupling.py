@@ -9,7 +9,7 @@ optics outputs.
 from collections import OrderedDict
 from functools import partial, reduce
 from pathlib import Path
-from typing import Callable, Dict, List, Sequence, Tuple, Union
+from typing import Callable, Dict, List, Tuple, Union
 
 import numpy as np
 import pandas as pd
@@ -19,7 +19,6 @@ from optics_functions.coupling import coupling_via_cmatrix
 
 from omc3.definitions.constants import PI2, PI2I
 from omc3.harpy.constants import COL_MU
-from omc3.optics_measurements.beta_from_phase import _tilt_slice_matrix
 from omc3.optics_measurements.constants import (
     AMPLITUDE,
     F1001,
@@ -39,6 +38,7 @@ from omc3.optics_measurements.constants import (
     MDL,
     DELTA, F1010_NAME, F1001_NAME
 )
+from omc3.optics_measurements.phase import PhaseAdvances
 from omc3.utils import logging_tools, stats
 
 LOGGER = logging_tools.get_logger(__name__)
@@ -51,7 +51,7 @@ CUTOFF: int = 5
 def calculate_coupling(
     meas_input: dict,
     input_files: dict,
-    phase_dict: Dict[str, Tuple[Dict[str, tfs.TfsDataFrame], Sequence[tfs.TfsDataFrame]]],
+    phase_dict: Dict[str, Dict[str, PhaseAdvances]],
     tune_dict: Dict[str, float],
     header_dict: OrderedDict,
 ) -> None:
@@ -71,10 +71,9 @@ def calculate_coupling(
         meas_input (dict): `OpticsInput` object containing analysis settings from the command-line.
         input_files (dict): `InputFiles` (dict) object containing frequency spectra files (linx/y) for
             each transverse plane (as keys).
-        phase_dict (Dict[str, Tuple[Dict[str, tfs.TfsDataFrame], tfs.TfsDataFrame]]): dictionary containing
+        phase_dict (Dict[str, Dict[str, PhaseAdvances]]): dictionary containing
             the measured phase advances, with an entry for each transverse plane. In said entry is a
-            dictionary with the measured phase advances for 'free' and 'uncompensated' cases, as well as
-            the location of the output ``TfsDataFrames`` for the phases.
+            dictionary with the measured phase advances for 'free' and 'uncompensated' cases.
         tune_dict (Dict[str, float]): `TuneDict` object containing measured tunes. There is an entry
             calculated for the 'Q', 'QF', 'QM', 'QFM' and 'ac2bpm' modes, each value being a float.
         header_dict (OrderedDict): header dictionary of common items for coupling output files,
@@ -92,13 +91,13 @@ def calculate_coupling(
     joined: tfs.TfsDataFrame = _joined_frames(input_files)  # merge transverse input frames
     joined_index: pd.Index = (
         meas_input.accelerator.model.index.intersection(joined.index)
-        .intersection(phase_dict["X"][compensation]["MEAS"].index)
-        .intersection(phase_dict["Y"][compensation]["MEAS"].index)
+        .intersection(phase_dict["X"][compensation].index)
+        .intersection(phase_dict["Y"][compensation].index)
     )
     joined = joined.loc[joined_index].copy()
 
-    phases_x: tfs.TfsDataFrame = phase_dict["X"][compensation]["MEAS"].loc[joined_index, joined_index].copy()
-    phases_y: tfs.TfsDataFrame = phase_dict["Y"][compensation]["MEAS"].loc[joined_index, joined_index].copy()
+    phases_x: PhaseAdvances = phase_dict["X"][compensation].select(joined_index)
+    phases_y: PhaseAdvances = phase_dict["Y"][compensation].select(joined_index)
 
     LOGGER.debug("Averaging (arithmetic mean) amplitude columns")
     for col in [SECONDARY_AMPLITUDE_X, SECONDARY_AMPLITUDE_Y]:
@@ -217,7 +216,7 @@ def compensate_rdts_ryoichi():
 
 # ----- Helpers ----- #
 
-def _find_pair(phases: tfs.TfsDataFrame, mode: int = 1):
+def _find_pair(phases: PhaseAdvances, mode: int = 1):
     """
     Does the BPM pairing for coupling calculation.
 
@@ -233,32 +232,32 @@ def _find_pair(phases: tfs.TfsDataFrame, mode: int = 1):
         return _take_next(phases, mode)
 
 
-def _take_next(phases: tfs.TfsDataFrame, shift: int = 1):
+def _take_next(phases: PhaseAdvances, shift: int = 1):
     """
     Takes the following BPM for momentum reconstruction by a given shift.
 
     Args:
-        phases (tfs.TfsDataFrame): Dataframe matrix of phase advances, as calculated in phase.py.
+        phases (PhaseAdvances): phase advances, as calculated in phase.py.
         shift (int): Value to determine the BPM pairing. If ``0`` is given,
            tries to find the best candidate. If a value ``n>=1`` is given,
            then takes the n-th following BPM downstream for the pairing.
    """
-    indices = np.roll(np.arange(phases.to_numpy().shape[0]), shift)
-    return indices, phases.to_numpy()[np.arange(phases.to_numpy().shape[0]), indices] - 0.25
+    indices = np.roll(np.arange(len(phases)), shift)
+    return indices, phases.band("MEAS", [-shift])[0] - 0.25
 
 
-def _find_candidate(phases: tfs.TfsDataFrame) -> Tuple[np.ndarray, np.ndarray]:
+def _find_candidate(phases: PhaseAdvances) -> Tuple[np.ndarray, np.ndarray]:
     """
     Finds the best candidate for momentum reconstruction.
 
     Args:
-      phases (tfs.TfsDataFrame): Dataframe matrix of phase advances, as calculated in phase.py.
+      phases (PhaseAdvances): phase advances, as calculated in phase.py.
       bd (int): beam direction, will be negative for beam 2.
 
     Returns:
         The indices of best candidates, and the corresponding phase advances between these indices.
     """
-    slice_ = _tilt_slice_matrix(phases.to_numpy(), 0, 2 * CUTOFF) - 0.25  # do not overwrite built-in 'slice'
+    slice_ = phases.band("MEAS", np.arange(min(2 * CUTOFF, len(phases)))) - 0.25  # do not overwrite built-in 'slice'
     indices = np.argmin(abs(slice_), axis=0)
     deltas = slice_[indices, range(len(indices))]
     indices = (indices + np.arange(len(indices))) % len(indices)
@@ -4,19 +4,30 @@ Data Models
 
 Models used in optics measurements to store and pass around data.
 """
-from typing import Dict
+import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from threading import Lock
+from typing import Dict, List, Optional, Sequence, Set, Tuple
 
 import numpy as np
 import pandas as pd
 
 import tfs
+from tfs.reader import _TfsMetaData, _read_metadata
 from omc3.definitions.constants import PLANES
+from omc3.harpy.constants import HEADER_UNSCALED_AMPS
 from omc3.optics_measurements import dpp, iforest
-from omc3.optics_measurements.constants import BPM_RESOLUTION, AMPLITUDE, CALIBRATION, ERR, ERR_CALIBRATION
+from omc3.optics_measurements.constants import (BPM_RESOLUTION, AMPLITUDE, CALIBRATION, ERR, ERR_CALIBRATION,
+                                                NAME, PHASE)
 from omc3.utils import logging_tools
 
 LOGGER = logging_tools.get_logger(__name__)
 
+SECONDARY_LINE_COLUMN = re.compile(r"^(ERR)?(FREQ|AMP|PHASE)_?\d_?\d$")
+COUPLING_LINES = {"X": {f"{AMPLITUDE}01", f"{PHASE}01"},  # as used in coupling.COLS_TO_KEEP_X/Y
+                  "Y": {f"{AMPLITUDE}10", f"{PHASE}10"}}
+
 class InputFiles(dict):
     """
     Stores the input files, provides methods to gather quantity specific data
@@ -26,16 +37,43 @@ class InputFiles(dict):
         - ``get_joined_frame`` (plane, columns, zero_dpp=False, how='inner')
         - ``get_columns`` (frame, column)
         - ``get_data`` (frame, column)
+
+    The frames of each plane are additionally kept in a columnar store (see ``_ColumnarStore``),
+    from which joined frames and BPM intersections are sliced and memoised.
+    Frames must therefore not be modified in place, other than via ``calibrate``.
+
+    Lin files are read in **num_processes** threads. With **column_projection**, only the secondary
+    lines needed by the requested analyses are read (see ``projected_lines``), the remaining
+    columns are read from the files on their first request via ``joined_frame``.
+    Harpy results passed in memory are used as they are, without rescaling the amplitudes,
+    if their frames are marked by the ``HEADER_UNSCALED_AMPS`` header (see ``harpy.handler.Lins``).
     """
     def __init__(self, files_to_analyse, optics_opt):
         super(InputFiles, self).__init__(zip(PLANES, ([], [])))
+        self._stores, self._joined_cache, self._bpms_cache = {}, {}, {}
+        self._lin_files = {plane: [] for plane in PLANES}
+        self._unloaded = {plane: [] for plane in PLANES}
+        self._load_lock = Lock()
         read_files = isinstance(files_to_analyse[0], str)
-        for file_in in files_to_analyse:
-            for plane in PLANES:
-                df_to_load = (tfs.read(f"{file_in}.lin{plane.lower()}").set_index("NAME", drop=False)
-                              if read_files else file_in[plane])
-                df_to_load.index.name = None
-                self[plane].append(self._repair_backwards_compatible_frame(df_to_load, plane))
+        to_load = [(file_in, plane) for file_in in files_to_analyse for plane in PLANES]
+        if read_files:
+            lines = {plane: projected_lines(optics_opt, plane) for plane in PLANES}
+            paths = [f"{file_in}.lin{plane.lower()}" for file_in, plane in to_load]
+            read_args = [(path, lines[plane]) for path, (_, plane) in zip(paths, to_load)]
+            if optics_opt.num_processes == 1:
+                loaded = list(map(_read_lin_file, *zip(*read_args)))
+            else:
+                with ThreadPoolExecutor(max_workers=optics_opt.num_processes) as executor:
+                    loaded = list(executor.map(_read_lin_file, *zip(*read_args)))
+        else:
+            paths = [None] * len(to_load)
+            loaded = [(file_in[plane], set()) for file_in, plane in to_load]
+        for (file_in, plane), path, (df_to_load, unloaded) in zip(to_load, paths, loaded):
+            df_to_load.index.name = None
+            df_to_load = self._repair_backwards_compatible_frame(df_to_load, plane)
+            self[plane].append(df_to_load)
+            self._lin_files[plane].append(path)
+            self._unloaded[plane].append(unloaded)
 
         if len(self['X']) + len(self['Y']) == 0:
             raise IOError("No valid input files")
@@ -48,14 +86,51 @@ class InputFiles(dict):
                 self[plane] = iforest.clean_with_isolation_forest(self[plane], optics_opt, plane)
             self[plane] = dpp.append_dpp(self[plane], dpp.arrange_dpps(dpp_values))
             self[plane] = dpp.append_amp_dpp(self[plane], amp_dpp_values)
+        self._clear_cache()
+
+    def _clear_cache(self):
+        """ Drops the columnar stores and memoised results, to be called after the frames changed. """
+        self._stores, self._joined_cache, self._bpms_cache = {}, {}, {}
+
+    def _load_columns(self, plane: str, columns: Sequence[str]):
+        """ Reads the requested columns, left out by the column projection, from the lin files. """
+        if not any(set(columns) & unloaded for unloaded in self._unloaded[plane]):
+            return
+        with self._load_lock:
+            for i, unloaded in enumerate(self._unloaded[plane]):
+                to_load = [column for column in columns if column in unloaded]
+                if not to_load:
+                    continue
+                LOGGER.debug(f"Reading columns {to_load} from {self._lin_files[plane][i]}")
+                data = _read_columns(self._lin_files[plane][i], [NAME] + to_load)
+                df = self[plane][i]
+                # replace instead of modifying the frame, which could be in use in other threads
+                self[plane][i] = tfs.TfsDataFrame(pd.concat([df, data.loc[:, to_load].reindex(df.index)], axis=1),
+                                                  headers=df.headers)
+                self._unloaded[plane][i] = unloaded - set(to_load)
+            self._clear_cache()
+
+    def _store(self, plane: str) -> "_ColumnarStore":
+        # the caches can be replaced by _clear_cache in other threads, so keep the result in a local
+        store = self._stores.get(plane)
+        if store is None:
+            store = _ColumnarStore(self[plane])
+            self._stores[plane] = store
+        return store
 
     @staticmethod  # TODO later remove
     def _repair_backwards_compatible_frame(df, plane):
         """
         Multiplies unscaled amplitudes by 2 to get from complex amplitudes to the real ones.
         This is for backwards compatibility with Drive,
-        i.e. harpy has this
+        i.e. harpy has this.
+        Harpy results passed in memory, marked by the ``HEADER_UNSCALED_AMPS`` header,
+        are already scaled and only the header is removed.
         """
+        headers = getattr(df, "headers", {})
+        if HEADER_UNSCALED_AMPS in headers:
+            return tfs.TfsDataFrame(df, headers={key: value for key, value in headers.items()
+                                                 if key != HEADER_UNSCALED_AMPS})
         df[f"AMP{plane}"] = df.loc[:, f"AMP{plane}"].to_numpy() * 2
         if f"NATAMP{plane}" in df.columns:
             df[f"NATAMP{plane}"] = df.loc[:, f"NATAMP{plane}"].to_numpy() * 2
@@ -74,12 +149,13 @@ class InputFiles(dict):
         return np.array([df.DPP for df in self[plane]])
 
     def dpp_frames(self, plane, dpp_value):
-        dpp_dfs = []
-        for i in np.argwhere(np.abs(self.dpps(plane) - dpp_value) < 1e-6).T[0]:
-            dpp_dfs.append(self[plane][i])
-        if len(dpp_dfs) == 0:
-            raise ValueError(f"No data found for dp/p {dpp}")
-        return dpp_dfs
+        return [self[plane][i] for i in self._dpp_indices(plane, dpp_value)]
+
+    def _dpp_indices(self, plane, dpp_value) -> np.ndarray:
+        indices = np.argwhere(np.abs(self.dpps(plane) - dpp_value) < 1e-6).T[0]
+        if len(indices) == 0:
+            raise ValueError(f"No data found for dp/p {dpp_value}")
+        return indices
 
     def _all_frames(self, plane):
         return self[plane]
@@ -101,28 +177,33 @@ class InputFiles(dict):
         """
         if how not in ['inner', 'outer']:
             raise RuntimeWarning("'how' should be either 'inner' or 'outer', 'inner' will be used.")
-        frames_to_join = self.dpp_frames(plane, dpp_value) if dpp_value is not None else self._all_frames(plane)
-        if dpp_amp:
-            frames_to_join = [df for df in frames_to_join if df.DPPAMP > 0]
-        if len(frames_to_join) == 0:
-            raise ValueError(f"No data found for non-zero |dp/p|")
-        joined_frame = pd.DataFrame(frames_to_join[0]).reindex(columns=columns, fill_value=np.nan)
-        if len(frames_to_join) > 1:
-            for i, df in enumerate(frames_to_join[1:]):
-                joined_frame = pd.merge(joined_frame, df.reindex(columns=columns, fill_value=np.nan),
-                                        how=how, left_index=True,
-                                        right_index=True, suffixes=('', '__' + str(i + 1)))
-        for column in columns:
-            joined_frame.rename(columns={column: column + '__0'}, inplace=True)
-        return joined_frame
+        columns = list(columns)
+        self._load_columns(plane, columns)
+        key = (plane, tuple(columns), dpp_value, dpp_amp, how)
+        joined_frame = self._joined_cache.get(key)
+        if joined_frame is None:
+            files = self._dpp_indices(plane, dpp_value) if dpp_value is not None else range(len(self[plane]))
+            if dpp_amp:
+                files = [i for i in files if self[plane][i].DPPAMP > 0]
+            if len(files) == 0:
+                raise ValueError(f"No data found for non-zero |dp/p|")
+            joined_frame = self._store(plane).joined_frame(columns, list(files), how)
+            if joined_frame is None:  # not purely numerical columns
+                joined_frame = _merge_frames([self[plane][i] for i in files], columns, how)
+            self._joined_cache[key] = joined_frame
+        return joined_frame.copy()
 
     def bpms(self, plane=None, dpp_value=None):
         if plane is None:
             return self.bpms(plane="X", dpp_value=dpp_value).intersection(self.bpms(plane="Y", dpp_value=dpp_value))
-        indices = [df.index for df in (self.dpp_frames(plane, dpp_value) if dpp_value is not None else self._all_frames(plane))]
-        for ind in indices[1:]:
-            indices[0] = indices[0].intersection(ind)
-        return indices[0]
+        key = (plane, dpp_value)
+        bpms = self._bpms_cache.get(key)
+        if bpms is None:
+            files = self._dpp_indices(plane, dpp_value) if dpp_value is not None else range(len(self[plane]))
+            store = self._store(plane)
+            bpms = store.index[store.rows(list(files), how="inner")]
+            self._bpms_cache[key] = bpms
+        return bpms
 
     def calibrate(self, calibs: Dict[str, pd.DataFrame]):
         """
@@ -152,6 +233,7 @@ class InputFiles(dict):
                     self[plane][i][f"{ERR}{AMPLITUDE}{plane}"]**2 +
                     ((self[plane][i][f"{AMPLITUDE}{plane}"] * data.loc[:, ERR_CALIBRATION]).fillna(bpm_resolution))**2
                 )
+        self._clear_cache()
 
     @ staticmethod
     def get_columns(frame, column):
@@ -165,10 +247,7 @@ class InputFiles(dict):
         Returns:
             list of columns.
         """
-        str_list = list(frame.columns[frame.columns.str.startswith(column + '__')].to_numpy())
-        new_list = list(map(lambda s: s[len(f"{column}__"):], str_list))
-        new_list.sort(key=int)
-        return [f"{column}__{x}" for x in new_list]
+        return _get_columns(tuple(frame.columns), column)
 
     def get_data(self, frame, column) -> np.ndarray:
         """
@@ -183,3 +262,134 @@ class InputFiles(dict):
         """
         columns = self.get_columns(frame, column)
         return frame.loc[:, columns].to_numpy()
+
+
+def projected_lines(optics_opt, plane: str) -> Optional[Set[str]]:
+    """
+    Returns the secondary line columns (e.g. ``AMP01``, ``PHASE01``) of the lin files of the given
+    plane needed by the requested analyses, or ``None`` if all columns are to be read.
+    All other columns of the lin files are always read.
+    The RDTs (``nonlinear``) need all lines, the coupling (``coupling_method``) only the coupling
+    lines and the chromatic beating (``chromatic_beating``) works on the linear optics only.
+    """
+    if not optics_opt.column_projection or optics_opt.nonlinear:
+        return None
+    if optics_opt.coupling_method:
+        return set(COUPLING_LINES[plane])
+    return set()
+
+
+def _read_lin_file(path: str, lines: Optional[Set[str]] = None) -> Tuple[tfs.TfsDataFrame, Set[str]]:
+    """
+    Reads the lin file, leaving out the secondary lines not in ``lines``, if given.
+    Returns the frame indexed by ``NAME`` and the set of columns left out.
+    """
+    if lines is None:
+        return tfs.read(path).set_index(NAME, drop=False), set()
+    metadata = _read_metadata(path)
+    names = list(metadata.column_names)
+    columns = [name for name in names if name in lines or not SECONDARY_LINE_COLUMN.match(name)]
+    return _read_columns(path, columns, metadata), set(names) - set(columns)
+
+
+def _read_columns(path: str, columns: Sequence[str], metadata: _TfsMetaData = None) -> tfs.TfsDataFrame:
+    """
+    Reads only the given columns of the lin file, which have to include ``NAME``, as ``tfs.read`` would.
+    The metadata (headers, column names and types) is parsed by ``tfs-pandas``, if not given.
+    """
+    if metadata is None:
+        metadata = _read_metadata(path)
+    types = dict(zip(metadata.column_names, metadata.column_types))
+    data_frame = pd.read_csv(path, engine="c", skiprows=metadata.non_data_lines, sep=r"\s+", quotechar='"',
+                             names=metadata.column_names, usecols=columns,
+                             dtype={name: types[name] for name in columns})
+    for column in data_frame.select_dtypes(include=["string", "object"]):  # as in tfs.read
+        data_frame[column] = data_frame[column].fillna("")
+    return tfs.TfsDataFrame(data_frame, headers=metadata.headers).set_index(NAME, drop=False)
+
+
+@lru_cache(maxsize=1024)
+def _get_columns(frame_columns: tuple, column: str) -> List[str]:
+    prefix = f"{column}__"
+    numbers = [name[len(prefix):] for name in frame_columns if name.startswith(prefix)]
+    numbers.sort(key=int)
+    return [f"{prefix}{x}" for x in numbers]
+
+
+def _merge_frames(frames: Sequence[pd.DataFrame], columns: Sequence[str], how: str) -> pd.DataFrame:
+    """ Merges the given columns of the frames, renaming them to ``column__i`` for the i-th frame. """
+    joined_frame = pd.DataFrame(frames[0]).reindex(columns=columns, fill_value=np.nan)
+    if len(frames) > 1:
+        for i, df in enumerate(frames[1:]):
+            joined_frame = pd.merge(joined_frame, df.reindex(columns=columns, fill_value=np.nan),
+                                    how=how, left_index=True,
+                                    right_index=True, suffixes=('', '__' + str(i + 1)))
+    for column in columns:
+        joined_frame.rename(columns={column: column + '__0'}, inplace=True)
+    return joined_frame
+
+
+class _ColumnarStore:
+    """
+    Columnar view of the frames of one plane.
+    The BPMs of all frames are mapped onto their union (in order of first appearance) and
+    each requested column is kept as a (BPMs x files) array, with ``NaN`` for BPMs missing in a file.
+    Column arrays are built on first access.
+    """
+    def __init__(self, frames: Sequence[pd.DataFrame]):
+        self.frames = frames
+        if len(frames):
+            self.index = pd.Index(pd.unique(np.concatenate([df.index.to_numpy() for df in frames])))
+        else:
+            self.index = pd.Index([])
+        self.positions = [self.index.get_indexer(df.index) for df in frames]
+        self.present = np.zeros((len(self.index), len(frames)), dtype=bool)
+        for i, positions in enumerate(self.positions):
+            self.present[positions, i] = True
+        self._columns = {}
+
+    def column(self, column: str):
+        """
+        Returns the (BPMs x files) array of the column,
+        or ``None`` if it is not a float column in all files containing it.
+        """
+        if column not in self._columns:
+            data = np.full(self.present.shape, np.nan)
+            for i, (df, positions) in enumerate(zip(self.frames, self.positions)):
+                if column not in df.columns:
+                    continue
+                values = df[column]
+                if not isinstance(values, pd.Series) or values.dtype.kind != "f":
+                    data = None
+                    break
+                data[positions, i] = values.to_numpy()
+            self._columns[column] = data
+        return self._columns[column]
+
+    def rows(self, files: List[int], how: str) -> np.ndarray:
+        """
+        Returns the union positions of the BPMs of the joined files, in the order a chain of
+        ``pd.merge`` gives: the order of the first file for ``inner``, sorted for ``outer``.
+        """
+        if how == "inner" or len(files) == 1:
+            first = self.positions[files[0]]
+            return first[self.present[np.ix_(first, files)].all(axis=1)]
+        rows = np.flatnonzero(self.present[:, files].any(axis=1))
+        return rows[self.index[rows].argsort()]
+
+    def joined_frame(self, columns: List[str], files: List[int], how: str):
+        """
+        Returns the joined frame of the columns with columns named ``column__i`` for the i-th file,
+        or ``None`` if a column can not be taken from the store.
+        """
+        if len(set(columns)) != len(columns):
+            return None
+        arrays = [self.column(column) for column in columns]
+        if any(array is None for array in arrays):
+            return None
+        rows = self.rows(files, how)
+        data = np.empty((len(rows), len(files), len(columns)))
+        for j, array in enumerate(arrays):
+            data[:, :, j] = array[np.ix_(rows, files)]
+        return pd.DataFrame(data.reshape(len(rows), -1), index=self.index[rows],
+                            columns=[f"{column}__{i}" for i in range(len(files)) for column in columns])
@@ -80,10 +80,10 @@ def _phase_to_betastar_error(l, ph, eph):
     return abs((eph * l * (abs(np.cos(ph)) - 1)) / (np.sin(ph) ** 2))
 
 
-def _get_meas_phase(bpml, bpmr, phases_df):
-    return (phases_df["MEAS"].loc[bpml, bpmr],
-            phases_df["ERRMEAS"].loc[bpml, bpmr],
-            phases_df["MODEL"].loc[bpml, bpmr])
+def _get_meas_phase(bpml, bpmr, phase_advances):
+    return (phase_advances.loc("MEAS", bpml, bpmr),
+            phase_advances.loc("ERRMEAS", bpml, bpmr),
+            phase_advances.loc("MODEL", bpml, bpmr))
 
 
 def _get_lstar(bpml, bpmr, model):
@@ -9,7 +9,10 @@ import datetime
 import os
 import sys
 from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from copy import deepcopy
+from functools import partial
+from typing import Callable, NamedTuple, Sequence, Tuple
 
 import numpy as np
 
@@ -24,14 +27,24 @@ from omc3.optics_measurements.constants import (
 )
 from omc3.optics_measurements.data_models import InputFiles
 from omc3.utils import iotools, logging_tools
+from omc3.utils.contexts import timeit
 
 LOGGER = logging_tools.get_logger(__name__)
 LOG_FILE = "measure_optics.log"
 
 
+class Stage(NamedTuple):
+    """ Part of the optics measurement, run once the stages it depends on are done. """
+    name: str
+    function: Callable[[], None]
+    dependencies: Tuple[str, ...] = ()
+
+
 def measure_optics(input_files: InputFiles, measure_input):
     """
     Main function to compute various lattice optics parameters from frequency spectra.
+    The independent stages of the analysis, i.e. the two planes up to coupling and the RDT,
+    CRDT and chromatic beating afterwards, run in parallel if **num_processes** is more than 1.
 
     Args:
         input_files: `InputFiles` object containing frequency spectra files (linx/y).
@@ -47,34 +60,101 @@ def measure_optics(input_files: InputFiles, measure_input):
     common_header = _get_header(measure_input, tune_dict)
     invariants = {}
     phase_dict = {}
+    stages = []
     for plane in PLANES:
-        phase_dict[plane], out_dfs = phase.calculate(measure_input, input_files, tune_dict, plane)
-        phase.write(out_dfs, [common_header]*4, measure_input.outputdir, plane)
-        phase.write_special(measure_input, phase_dict[plane]['free'], tune_dict[plane]["QF"], plane)
-        if measure_input.only_coupling:
-            continue
-        beta_df, beta_header = beta_from_phase.calculate(measure_input, tune_dict, phase_dict[plane], common_header, plane)
-        beta_from_phase.write(beta_df, beta_header, measure_input.outputdir, plane)
-
-        ratio = beta_from_amplitude.calculate(measure_input, input_files, tune_dict, beta_df, common_header, plane)
-        invariants[plane] = kick.calculate(measure_input, input_files, ratio, common_header, plane)
-        ip_df = interaction_point.betastar_from_phase(measure_input, phase_dict[plane]['free'])
-        interaction_point.write(ip_df, common_header, measure_input.outputdir, plane)
-        dispersion.calculate_orbit(measure_input, input_files, common_header, plane)
-        dispersion.calculate_dispersion(measure_input, input_files, common_header, plane)
-        if plane == "X":
-            dispersion.calculate_normalised_dispersion(measure_input, input_files, beta_df, common_header)
-    coupling.calculate_coupling(measure_input, input_files, phase_dict, tune_dict, common_header)
-    if measure_input.only_coupling:
+        stages.append(Stage(f"phase {plane}", partial(
+            _calculate_phase, input_files, measure_input, tune_dict, common_header, phase_dict, plane)))
+        if not measure_input.only_coupling:
+            stages.append(Stage(f"optics {plane}", partial(
+                _calculate_optics, input_files, measure_input, tune_dict, common_header, phase_dict,
+                invariants, plane), (f"phase {plane}",)))
+    # coupling adds Cminus to the common header, so it waits for the files of both planes
+    # and the RDTs and CRDTs wait for coupling, as in the serial analysis
+    plane_stages = tuple(stage.name for stage in stages)
+    stages.append(Stage("coupling", partial(
+        coupling.calculate_coupling, measure_input, input_files, phase_dict, tune_dict, common_header),
+        plane_stages))
+    if not measure_input.only_coupling:
+        if 'rdt' in measure_input.nonlinear:
+            stages.append(Stage("rdt", partial(
+                _calculate_rdt, input_files, measure_input, tune_dict, phase_dict, invariants, common_header),
+                ("coupling",)))
+        if 'crdt' in measure_input.nonlinear:
+            stages.append(Stage("crdt", partial(
+                _calculate_crdt, input_files, measure_input, invariants, common_header), ("coupling",)))
+        if measure_input.chromatic_beating:
+            stages.append(Stage("chromatic beating", partial(
+                chromatic_beating, input_files, measure_input, tune_dict)))
+    run_stages(stages, measure_input.num_processes)
+
+
+def run_stages(stages: Sequence[Stage], num_processes: int = 1):
+    """
+    Runs the stages in the given order if ``num_processes`` is 1. Otherwise each stage runs in
+    a pool of ``num_processes`` threads as soon as the stages it depends on are done.
+    The time spent in each stage is logged.
+
+    Args:
+        stages: `Stage` objects, each only depending on stages given before it.
+        num_processes: number of threads to run the stages in.
+    """
+    names = set()
+    for stage in stages:
+        if not names.issuperset(stage.dependencies):
+            raise ValueError(f"Stage '{stage.name}' depends on stages not given before it: "
+                             f"{sorted(set(stage.dependencies) - names)}")
+        names.add(stage.name)
+
+    if num_processes == 1:
+        for stage in stages:
+            _run_stage(stage)
         return
-    if 'rdt' in measure_input.nonlinear:
-        iotools.create_dirs(os.path.join(measure_input.outputdir, "rdt"))
-        rdt.calculate(measure_input, input_files, tune_dict, phase_dict, invariants, common_header)
-    if 'crdt' in measure_input.nonlinear:
-        iotools.create_dirs(os.path.join(measure_input.outputdir, "crdt"))
-        crdt.calculate(measure_input, input_files, invariants, common_header)
-    if measure_input.chromatic_beating:
-        chromatic_beating(input_files, measure_input, tune_dict)
+
+    pending, running, done = list(stages), {}, set()
+    with ThreadPoolExecutor(max_workers=num_processes) as executor:
+        while pending or running:
+            for stage in [stage for stage in pending if done.issuperset(stage.dependencies)]:
+                pending.remove(stage)
+                running[executor.submit(_run_stage, stage)] = stage.name
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                future.result()  # re-raises the exception of a failed stage
+                done.add(running.pop(future))
+
+
+def _run_stage(stage: Stage):
+    with timeit(lambda spanned: LOGGER.info(f"Time for {stage.name}: {spanned:.2f}s")):
+        stage.function()
+
+
+def _calculate_phase(input_files, measure_input, tune_dict, common_header, phase_dict, plane):
+    phase_dict[plane], out_dfs = phase.calculate(measure_input, input_files, tune_dict, plane)
+    phase.write(out_dfs, [common_header]*4, measure_input.outputdir, plane)
+    phase.write_special(measure_input, phase_dict[plane]['free'], tune_dict[plane]["QF"], plane)
+
+
+def _calculate_optics(input_files, measure_input, tune_dict, common_header, phase_dict, invariants, plane):
+    beta_df, beta_header = beta_from_phase.calculate(measure_input, tune_dict, phase_dict[plane], common_header, plane)
+    beta_from_phase.write(beta_df, beta_header, measure_input.outputdir, plane)
+
+    ratio = beta_from_amplitude.calculate(measure_input, input_files, tune_dict, beta_df, common_header, plane)
+    invariants[plane] = kick.calculate(measure_input, input_files, ratio, common_header, plane)
+    ip_df = interaction_point.betastar_from_phase(measure_input, phase_dict[plane]['free'])
+    interaction_point.write(ip_df, common_header, measure_input.outputdir, plane)
+    dispersion.calculate_orbit(measure_input, input_files, common_header, plane)
+    dispersion.calculate_dispersion(measure_input, input_files, common_header, plane)
+    if plane == "X":
+        dispersion.calculate_normalised_dispersion(measure_input, input_files, beta_df, common_header)
+
+
+def _calculate_rdt(input_files, measure_input, tune_dict, phase_dict, invariants, common_header):
+    iotools.create_dirs(os.path.join(measure_input.outputdir, "rdt"))
+    rdt.calculate(measure_input, input_files, tune_dict, phase_dict, invariants, common_header)
+
+
+def _calculate_crdt(input_files, measure_input, invariants, common_header):
+    iotools.create_dirs(os.path.join(measure_input.outputdir, "crdt"))
+    crdt.calculate(measure_input, input_files, invariants, common_header)
 
 
 def chromatic_beating(input_files, measure_input, tune_dict):
@@ -7,13 +7,14 @@ It provides functions to compute betatron phase advances and structures to store
 """
 from os.path import join
 from pathlib import Path
-from typing import Dict, Tuple
+from typing import Dict, List, Tuple
 
 import numpy as np
 import pandas as pd
 import tfs
 from numpy.typing import ArrayLike
 
+from omc3.definitions.constants import PI2, PI2I
 from omc3.optics_measurements.constants import (DELTA, ERR, EXT, MDL, PHASE_NAME, SPECIAL_PHASE_NAME,
                                                 TOTAL_PHASE_NAME)
 from omc3.optics_measurements.data_models import InputFiles
@@ -22,10 +23,12 @@ from omc3.utils import logging_tools, stats
 
 LOGGER = logging_tools.get_logger(__name__)
 
+BANDWIDTH = 10  # default number of neighbouring BPMs on either side to keep the phase advances for
+
 
 def calculate(
     meas_input: dict, input_files: dict, tunes, plane, no_errors=False
-) -> Dict[str, Tuple[Dict[str, tfs.TfsDataFrame], tfs.TfsDataFrame]]:
+) -> Tuple[Dict[str, "PhaseAdvances"], List[tfs.TfsDataFrame]]:
     """
     Calculate phases for 'free' and 'uncompensated' cases from the measurement files, and return a
     dictionary combining the results for each transverse plane.
@@ -70,7 +73,7 @@ def calculate(
         dfs = free_dfs + drv_dfs
 
 
-    if len(phase_advances["MEAS"].index) < 3:
+    if len(phase_advances) < 3:
         LOGGER.warning("Less than 3 non-NaN phase-advances found. "
                        "This will most likely lead to errors later on in the N-BPM or 3-BPM methods.\n"
                        "Common issues to check:\n\n"
@@ -96,7 +99,7 @@ def _calculate_with_compensation(meas_input, input_files, tunes, plane, model_df
         no_errors: if ``True``, measured errors shall not be propagated (only their spread).
 
     Returns:
-        A `dictionary` of `TfsDataFrames` indexed (BPMi x BPMj) yielding phase advance `phi_ij`.
+        `PhaseAdvances` yielding the phase advances `phi_ij` of the (BPMi x BPMj) matrices:
 
          - "MEAS": measured phase advances,
          - "ERRMEAS": errors of measured phase advances,
@@ -115,7 +118,7 @@ def _calculate_with_compensation(meas_input, input_files, tunes, plane, model_df
         +------++--------+--------+--------+--------+
 
         The phase advance between BPM_i and BPM_j can be obtained via:
-        phase_advances["MEAS"].loc[BPMi,BPMj]
+        phase_advances.loc("MEAS", BPMi, BPMj)
         list of output data frames(for files)
     """
     LOGGER.info("Calculating phase advances")
@@ -131,7 +134,6 @@ def _calculate_with_compensation(meas_input, input_files, tunes, plane, model_df
                                                      * meas_input.accelerator.beam_direction
                                                      )
     phases_mdl = df.loc[:, f"MU{plane}"].to_numpy()
-    phase_advances = {"MODEL": _get_square_data_frame(_get_all_phase_diff(phases_mdl), df.index)}
     if compensation == "model":
         df = _compensate_by_model(input_files, meas_input, df, plane)
     phases_meas = input_files.get_data(df, f"MU{plane}")
@@ -140,26 +142,16 @@ def _calculate_with_compensation(meas_input, input_files, tunes, plane, model_df
 
     phases_errors = input_files.get_data(df, f"{ERR}MU{plane}")
     if phases_meas.ndim < 2:
-        phase_advances["MEAS"] = _get_square_data_frame(_get_all_phase_diff(phases_meas), df.index)
-        phase_advances["ERRMEAS"] = _get_square_data_frame(
-                np.zeros((len(phases_meas), len(phases_meas))), df.index)
-        return phase_advances
-    if meas_input.union:
+        phases_meas, phases_errors = phases_meas[:, np.newaxis], None
+    elif meas_input.union:
         mask = np.isnan(phases_meas)
         phases_meas[mask], phases_errors[mask] = 0.0, np.inf
         if no_errors:
             phases_errors[~mask] = 1e-10
     elif no_errors:
         phases_errors = None
-    phases_3d = phases_meas[np.newaxis, :, :] - phases_meas[:, np.newaxis, :]
-    if phases_errors is not None:
-        errors_3d = phases_errors[np.newaxis, :, :] + phases_errors[:, np.newaxis, :]
-    else:
-        errors_3d = None
-    phase_advances["MEAS"] = _get_square_data_frame(stats.circular_mean(
-            phases_3d, period=1, errors=errors_3d, axis=2) % 1.0, df.index)
-    phase_advances["ERRMEAS"] = _get_square_data_frame(stats.circular_error(
-            phases_3d, period=1, errors=errors_3d, axis=2), df.index)
+    phase_advances = PhaseAdvances(df.index, phases_mdl, phases_meas, phases_errors,
+                                   bandwidth=max(BANDWIDTH, meas_input.range_of_bpms // 2))
     return phase_advances, [_create_output_df(phase_advances, df, plane),
                             _create_output_df(phase_advances, df, plane, tot=True)]
 
@@ -195,43 +187,217 @@ def write(dfs, headers, output, plane):
 
 
 def _create_output_df(phase_advances, model, plane, tot=False):
-    meas = phase_advances["MEAS"]
-    mod = phase_advances["MODEL"]
-    err = phase_advances["ERRMEAS"]
     if tot:
+        first_bpm, other_bpms = 0, np.arange(len(phase_advances))
         output_data = model.loc[:, ["S", f"MU{plane}"]].iloc[:, :]
         output_data["NAME"] = output_data.index
         output_data = output_data.assign(S2=model.at[model.index[0], "S"], NAME2=model.index[0])
-        output_data[f"PHASE{plane}"] = meas.to_numpy()[0, :]
-        output_data[f"{ERR}PHASE{plane}"] = err.to_numpy()[0, :]
-        output_data[f"PHASE{plane}{MDL}"] = mod.to_numpy()[0, :]
+        output_data[f"PHASE{plane}"] = phase_advances.get("MEAS", first_bpm, other_bpms)
+        output_data[f"{ERR}PHASE{plane}"] = phase_advances.get("ERRMEAS", first_bpm, other_bpms)
+        output_data[f"PHASE{plane}{MDL}"] = phase_advances.get("MODEL", first_bpm, other_bpms)
     else:
         output_data = model.loc[:, ["S", f"MU{plane}"]].iloc[:-1, :]
         output_data["NAME"] = output_data.index
         output_data = output_data.assign(S2=model.loc[:, "S"].to_numpy()[1:], NAME2=model.index[1:].to_numpy())
-        output_data[f"PHASE{plane}"] = np.diag(meas.to_numpy(), k=1)
-        output_data[f"{ERR}PHASE{plane}"] = np.diag(err.to_numpy(), k=1)
-        output_data[f"PHASE{plane}{MDL}"] = np.diag(mod.to_numpy(), k=1)
+        output_data[f"PHASE{plane}"] = phase_advances.band("MEAS", [1])[0, :-1]
+        output_data[f"{ERR}PHASE{plane}"] = phase_advances.band("ERRMEAS", [1])[0, :-1]
+        output_data[f"PHASE{plane}{MDL}"] = phase_advances.band("MODEL", [1])[0, :-1]
     output_data.rename(columns={f"MU{plane}": f"MU{plane}{MDL}"}, inplace=True)
     output_data[f"{DELTA}PHASE{plane}"] = df_ang_diff(output_data, f"PHASE{plane}", f"PHASE{plane}{MDL}")
     output_data[f"{ERR}{DELTA}PHASE{plane}"] = output_data.loc[:, f"{ERR}PHASE{plane}"].to_numpy()
     return output_data
 
 
-def _get_all_phase_diff(phases_a: ArrayLike, phases_b: ArrayLike = None):
-    if phases_b is None:
-        phases_b = phases_a
-    return (phases_a[np.newaxis, :] - phases_b[:, np.newaxis]) % 1.0
+class PhaseAdvances:
+    """
+    Phase advances ``phi_ij`` from BPM_i to BPM_j in units of 2 pi, of one plane.
+
+    Only the band of the phase advances to the ``bandwidth`` neighbouring BPMs on either side
+    of each BPM is computed and stored, wrapping around the end of the BPM list.
+    The phases per measurement file are kept, so that the phase advances between BPMs outside
+    of this band are computed on demand, i.e. each lookup gives the same values as the
+    (BPMs x BPMs) matrices of the phase advances.
+
+    The phase advances are looked up by ``kind``:
 
+     - "MEAS": measured phase advances,
+     - "ERRMEAS": errors of measured phase advances,
+     - "MODEL": model phase advances.
 
-def _get_square_data_frame(data, index):
-    return pd.DataFrame(data=data, index=index, columns=index)
+    Args:
+        index: names of the BPMs.
+        phases_model: model phases of the BPMs.
+        phases_meas: (BPMs x files) array of the measured phases.
+        phases_errors: (BPMs x files) array of the errors of the measured phases, or ``None``
+                       if the errors shall not be used as weights.
+        bandwidth: number of neighbouring BPMs on either side to store the phase advances for.
+    """
+    def __init__(self, index: pd.Index, phases_model: ArrayLike, phases_meas: np.ndarray,
+                 phases_errors: np.ndarray = None, bandwidth: int = None):
+        self.index = index
+        self.bandwidth = min(BANDWIDTH if bandwidth is None else bandwidth, len(index) // 2)
+        self._phases_model = np.asarray(phases_model)
+        self._phases_meas = phases_meas
+        if phases_errors is not None and not _errors_are_weights(phases_errors):
+            phases_errors = None
+        self._phases_errors = phases_errors
+        offsets = np.arange(-self.bandwidth, self.bandwidth + 1)
+        self._band = dict(zip(("MEAS", "ERRMEAS"), self._compute(*self._band_indices(offsets))))
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, kind: str, rows: ArrayLike, columns: ArrayLike) -> np.ndarray:
+        """
+        Phase advances from the BPMs at positions ``rows`` to the BPMs at positions ``columns``,
+        where ``rows`` and ``columns`` are broadcast against each other.
+        """
+        rows, columns = np.broadcast_arrays(np.asarray(rows), np.asarray(columns))
+        if kind == "MODEL":
+            return (self._phases_model[columns] - self._phases_model[rows]) % 1.0
+        n_bpms = len(self)
+        offsets = (columns - rows) % n_bpms
+        offsets = np.where(offsets > self.bandwidth, offsets - n_bpms, offsets)
+        in_band = offsets >= -self.bandwidth
+        values = np.empty(rows.shape)
+        values[in_band] = self._band[kind][offsets[in_band] + self.bandwidth, rows[in_band]]
+        if not np.all(in_band):
+            meas, err = self._compute(rows[~in_band], columns[~in_band])
+            values[~in_band] = meas if kind == "MEAS" else err
+        return values
+
+    def loc(self, kind: str, bpms_from, bpms_to):
+        """ Phase advances from the BPMs ``bpms_from`` to ``bpms_to``, given by name. """
+        rows, columns = self._get_positions(bpms_from), self._get_positions(bpms_to)
+        values = self.get(kind, rows, columns)
+        return values if values.ndim else values.item()
+
+    def band(self, kind: str, offsets: ArrayLike, tune: float = 0.) -> np.ndarray:
+        """
+        Phase advances from each BPM_i to BPM_(i+offset), as (offsets x BPMs) array.
+        The ``tune`` is added (subtracted) where the phase advance wraps around the end
+        (beginning) of the BPM list.
+        """
+        rows, columns = self._band_indices(np.asarray(offsets))
+        values = self.get(kind, rows, columns)
+        if tune:
+            values = values + tune * ((rows + np.asarray(offsets)[:, np.newaxis]) // len(self))
+        return values
+
+    def select(self, bpms) -> "PhaseAdvances":
+        """ Phase advances between the given BPMs only, in the given order. """
+        positions = self._get_positions(bpms)
+        return PhaseAdvances(self.index[positions], self._phases_model[positions],
+                             self._phases_meas[positions],
+                             None if self._phases_errors is None else self._phases_errors[positions],
+                             bandwidth=self.bandwidth)
+
+    def _get_positions(self, bpms):
+        if np.isscalar(bpms):
+            return self.index.get_loc(bpms)
+        bpms = np.asarray(bpms)
+        positions = self.index.get_indexer(bpms.ravel()).reshape(bpms.shape)
+        if np.any(positions < 0):
+            raise KeyError(f"BPMs {list(bpms[positions < 0])} not in phase advances.")
+        return positions
+
+    def _band_indices(self, offsets):
+        rows = np.arange(len(self))[np.newaxis, :]
+        return rows, (rows + offsets[:, np.newaxis]) % len(self)
+
+    def _compute(self, rows, columns):
+        return _get_phase_advances_statistics(self._phases_meas, self._phases_errors, rows, columns)
+
+
+def _get_phase_advances_statistics(phases: np.ndarray, errors: np.ndarray = None,
+                                   rows: np.ndarray = None, columns: np.ndarray = None):
+    """
+    Computes the weighted circular mean and its error of the phase advances between the pairs of
+    BPMs over the measurement files, i.e. the same as ``stats.circular_mean`` and
+    ``stats.circular_error`` (with ``period=1``) along the files-axis of the (BPMs x BPMs x files)
+    array of phase differences, without building this array.
+    The files are streamed one at a time through accumulators of the complex phasors,
+    the weights and their squares, so the memory is independent of the number of files.
+
+    Args:
+        phases: (BPMs x files) array of measured phases in units of 2 pi.
+        errors: (BPMs x files) array of errors of the phases, or ``None`` to not use weights.
+                See ``_errors_are_weights``.
+        rows: positions of the BPMs the phase advances start from. Defaults to all BPMs.
+        columns: positions of the BPMs the phase advances end at, broadcast against ``rows``.
+                 Defaults to all BPMs, i.e. the (BPMs x BPMs) matrix of phase advances.
+
+    Returns:
+        Tuple of the arrays of the phase advances ``phi_ij`` (in ``[0, 1)``) and their errors.
+    """
+    n_files = phases.shape[1]
+    if rows is None:
+        rows, columns = np.arange(phases.shape[0])[:, np.newaxis], np.arange(phases.shape[0])[np.newaxis, :]
+    shape = np.broadcast_shapes(np.shape(rows), np.shape(columns))
+    phasors = np.exp(PI2I * phases)
+
+    sum_of_weights = np.zeros(shape) if errors is not None else n_files
+    sum_of_squared_weights = np.zeros(shape) if errors is not None else n_files
+    complex_average = np.zeros(shape, dtype=complex)
+    for phasors_file, weights_file in _iter_file_phasors(phasors, errors, rows, columns):
+        if weights_file is None:
+            complex_average += phasors_file
+            continue
+        sum_of_weights += weights_file
+        sum_of_squared_weights += np.square(weights_file)
+        complex_average += weights_file * phasors_file
+    with np.errstate(invalid="ignore", divide="ignore"):
+        complex_average /= sum_of_weights
+
+    # second pass for the variance, to avoid the cancellation in 1 - |mean|^2 for small spreads
+    sample_variance = np.zeros(shape)
+    for phasors_file, weights_file in _iter_file_phasors(phasors, errors, rows, columns):
+        deviation = np.square(np.abs(phasors_file - complex_average))
+        sample_variance += deviation if weights_file is None else weights_file * deviation
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sample_variance /= sum_of_weights
+        if errors is not None:
+            sample_variance += 1. / sum_of_weights
+            sample_size = np.square(sum_of_weights) / sum_of_squared_weights
+        else:
+            sample_size = np.full(shape, float(n_files))
+        sample_size = np.where(sample_size > 2, sample_size, 2)
+        error_of_complex_average = np.sqrt(sample_variance * sample_size / (sample_size - 1))
+        phase_error = np.nan_to_num(error_of_complex_average / np.abs(complex_average))
+    phase_error = phase_error * stats.t_value_correction(sample_size)
+    phase_error = np.where(phase_error > 0.25 * PI2, 0.3, phase_error / PI2)
+    return (np.angle(complex_average) / PI2) % 1.0, phase_error
+
+
+def _iter_file_phasors(phasors: np.ndarray, errors: np.ndarray, rows: np.ndarray, columns: np.ndarray):
+    """ Yields the phasors of the phase advances between the BPM pairs and their weights per file. """
+    for i_file in range(phasors.shape[1]):
+        phasors_file = phasors[rows, i_file].conj() * phasors[columns, i_file]
+        if errors is None:
+            yield phasors_file, None
+            continue
+        errors_file = errors[:, i_file]
+        yield phasors_file, 1 / np.square((errors_file[columns] + errors_file[rows]) * PI2)
+
+
+def _errors_are_weights(errors: np.ndarray) -> bool:
+    """
+    Checks the errors of the phase advances between all pairs of BPMs the same way as
+    ``stats.weights_from_errors``, i.e. no weights are used if any of them are ``NaN`` or zero.
+    """
+    if np.any(np.isnan(errors)):
+        LOGGER.warning("NaNs found, weights are not used.")
+        return False
+    if any(np.any(np.isin(-errors[:, i_file], errors[:, i_file])) for i_file in range(errors.shape[1])):
+        LOGGER.warning("Zeros found, weights are not used.")
+        return False
+    return True
 
 
 def write_special(meas_input, phase_advances, plane_tune, plane):
     # TODO REFACTOR AND SIMPLIFY
     accel = meas_input.accelerator
-    meas = phase_advances["MEAS"]
+    meas_index = phase_advances.index
     bd = accel.beam_direction
     elements = accel.elements
     special_phase_columns = ['ELEMENT1',
@@ -250,15 +416,15 @@ def write_special(meas_input, phase_advances, plane_tune, plane):
     
     for elem1, elem2 in accel.important_phase_advances():
         mus1 = elements.loc[elem1, f"MU{plane}"] - elements.loc[:, f"MU{plane}"]
-        minmu1 = abs(mus1.loc[meas.index]).idxmin()
+        minmu1 = abs(mus1.loc[meas_index]).idxmin()
         mus2 = elements.loc[:, f"MU{plane}"] - elements.loc[elem2, f"MU{plane}"]
-        minmu2 = abs(mus2.loc[meas.index]).idxmin()
-        bpm_phase_advance = meas.loc[minmu1, minmu2]
+        minmu2 = abs(mus2.loc[meas_index]).idxmin()
+        bpm_phase_advance = phase_advances.loc("MEAS", minmu1, minmu2)
         model_value = elements.loc[elem2, f"MU{plane}"] - elements.loc[elem1, f"MU{plane}"]
         if (elements.loc[elem1, "S"] - elements.loc[elem2, "S"]) * bd > 0.0:
             bpm_phase_advance += plane_tune
             model_value += plane_tune
-        bpm_err = phase_advances["ERRMEAS"].loc[minmu1, minmu2]
+        bpm_err = phase_advances.loc("ERRMEAS", minmu1, minmu2)
         elems_to_bpms = -mus1.loc[minmu1] - mus2.loc[minmu2]
         ph_result = ((bpm_phase_advance + elems_to_bpms) * bd)
         model_value = (model_value * bd) % 1
@@ -5,14 +5,13 @@ Resonance Driving Terms
 This module contains RDT calculations related functionality of ``optics_measurements``.
 It provides functions to compute global resonance driving terms **f_jklm**.
 """
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from os.path import join
 
 import numpy as np
 import pandas as pd
 import tfs
-from scipy.optimize import curve_fit
-from scipy.sparse import diags
 
 from omc3.definitions.constants import PLANES
 from omc3.optics_measurements.constants import ERR, EXT, AMPLITUDE
@@ -63,6 +62,8 @@ def _generate_plane_rdts(order):
 
 def calculate(measure_input, input_files, tunes, phases, invariants, header):
     """
+    Calculates the RDTs seen in the lin files up to **rdt_magnet_order**. The amplitudes and phases
+    of the lines are joined once per plane and the RDTs are processed in **num_processes** threads.
 
     Args:
         measure_input:
@@ -79,28 +80,38 @@ def calculate(measure_input, input_files, tunes, phases, invariants, header):
     LOGGER.info(f"Calculating RDTs up to magnet order {meas_input['rdt_magnet_order']}")
 
     single_plane_rdts, double_plane_rdts = _generate_plane_rdts(meas_input["rdt_magnet_order"])
+    lines = {plane: _join_lines(input_files, plane, single_plane_rdts[plane] + double_plane_rdts[plane])
+             for plane in PLANES}
+    rdts_to_process = []
     for plane in PLANES:
         bpm_names = input_files.bpms(plane=plane, dpp_value=0)
         for_rdts = _best_90_degree_phases(meas_input, bpm_names, phases, tunes, plane)
         LOGGER.info(f"Average phase advance between BPM pairs: {for_rdts.loc[:,'MEAS'].mean()}")
-        for rdt in single_plane_rdts[plane]:
-            try:
-                df = _process_rdt(meas_input, input_files, for_rdts, invariants, plane, rdt)
-            except ValueError as e:  # catch the AMP line not being found in the lin file
-                LOGGER.warning(f"RDT calculation failed for {jklm2str(*rdt)}: {str(e)}")
-                continue
-            write(df, add_freq_to_header(header, plane, rdt), meas_input, plane, rdt)
+        rdts_to_process.extend((for_rdts, plane, rdt) for rdt in single_plane_rdts[plane])
     for plane in PLANES:
         bpm_names = input_files.bpms(dpp_value=0)
         for_rdts = _best_90_degree_phases(meas_input, bpm_names, phases, tunes, plane)
         LOGGER.info(f"Average phase advance between BPM pairs: {for_rdts.loc[:, 'MEAS'].mean()}")
-        for rdt in double_plane_rdts[plane]:
-            try:
-                df = _process_rdt(meas_input, input_files, for_rdts, invariants, plane, rdt)
-            except ValueError as e:
-                LOGGER.warning(f"RDT calculation failed for {jklm2str(*rdt)}: {str(e)}")
-                continue
-            write(df, add_freq_to_header(header, plane, rdt), meas_input, plane, rdt)
+        rdts_to_process.extend((for_rdts, plane, rdt) for rdt in double_plane_rdts[plane])
+
+    def _process(for_rdts_plane_rdt):
+        for_rdts, plane, rdt = for_rdts_plane_rdt
+        try:
+            return _process_rdt(meas_input, input_files, for_rdts, invariants, plane, rdt, lines)
+        except ValueError as e:  # catch the AMP line not being found in the lin file
+            LOGGER.warning(f"RDT calculation failed for {jklm2str(*rdt)}: {str(e)}")
+            return None
+
+    def _write_all(results):
+        for (_, plane, rdt), df in zip(rdts_to_process, results):
+            if df is not None:
+                write(df, add_freq_to_header(header, plane, rdt), meas_input, plane, rdt)
+
+    if meas_input.num_processes == 1:
+        _write_all(map(_process, rdts_to_process))
+        return
+    with ThreadPoolExecutor(max_workers=meas_input.num_processes) as executor:
+        _write_all(executor.map(_process, rdts_to_process))
 
 
 def write(df, header, meas_input, plane, rdt):
@@ -131,15 +142,25 @@ def _rdt_to_order_and_type(rdt):
 
 
 def _best_90_degree_phases(meas_input, bpm_names, phases, tunes, plane):
-    filtered = phases[plane]["uncompensated"]["MEAS"].loc[bpm_names, bpm_names]
-    phase_meas = pd.concat((filtered % 1, (filtered.iloc[:, :NBPMS_FOR_90] + tunes[plane]["Q"]) % 1), axis=1)
-    second_bmps = np.abs(phase_meas * _get_n_upper_diagonals(NBPMS_FOR_90, phase_meas.shape) - 0.25).idxmin(axis=1)
-    filtered.iloc[-NBPMS_FOR_90:,:NBPMS_FOR_90] = (filtered.iloc[-NBPMS_FOR_90:,:NBPMS_FOR_90] + tunes[plane]["Q"]) % 1
+    phase_advances = phases[plane]["uncompensated"].select(bpm_names)
+    tune = tunes[plane]["Q"]
+    positions = np.arange(len(phase_advances))
+    offsets = np.arange(1, NBPMS_FOR_90 + 1)
+    candidates = phase_advances.band("MEAS", offsets, tune) % 1
+    deviations = np.abs(candidates - 0.25)
+    best = np.argmin(np.nan_to_num(deviations, nan=np.inf), axis=0)
+
+    # the first BPM is taken, if no downstream candidate is closer to 90 degrees than to 0 degrees
+    fallback = ~(deviations[best, positions] < 0.25)
+    first_bpm_phases = phase_advances.get("MEAS", positions, 0)
+    first_bpm_phases[-NBPMS_FOR_90:] = (first_bpm_phases[-NBPMS_FOR_90:] + tune) % 1
+    second_bpms = np.where(fallback, 0, (positions + offsets[best]) % len(phase_advances))
 
     # get the pairs zip(bpm_names, second_bpms)
-    filtered["NAME2"] = second_bmps
-    filtered["MEAS"] = np.diag(filtered.loc[bpm_names, second_bmps])
-    filtered["ERRMEAS"] = np.diag(phases[plane]["uncompensated"]["ERRMEAS"].loc[bpm_names, second_bmps])
+    filtered = pd.DataFrame(index=phase_advances.index)
+    filtered["NAME2"] = phase_advances.index[second_bpms].to_numpy()
+    filtered["MEAS"] = np.where(fallback, first_bpm_phases, candidates[best, positions])
+    filtered["ERRMEAS"] = phase_advances.get("ERRMEAS", positions, second_bpms)
 
     # Merge final dataframe
     for_rdts = pd.merge(filtered.loc[:, ["NAME2", "MEAS", "ERRMEAS"]], meas_input.accelerator.model.loc[:, ["S"]],
@@ -147,10 +168,6 @@ def _best_90_degree_phases(meas_input, bpm_names, phases, tunes, plane):
     return for_rdts
 
 
-def _get_n_upper_diagonals(n, shape):
-    return diags(np.ones((n, shape[0])), np.arange(n)+1, shape=shape).toarray()
-
-
 def _determine_line(rdt, plane):
     j, k, l, m = rdt
     lines = dict(X=(1 - j + k, m - l, 0),
@@ -166,26 +183,44 @@ def add_freq_to_header(header, plane, rdt):
     return mod_header
 
 
-def _process_rdt(meas_input, input_files, phase_data, invariants, plane, rdt):
+def _join_lines(input_files, plane, rdts):
+    """
+    Joins the phases of the plane and the amplitudes and phases of the lines of the given RDTs
+    from the lin files of the plane at once.
+
+    Returns:
+        `Dict` of the (BPMs x files) `DataFrames` of each column.
+    """
+    columns = [f"MU{plane}"]
+    for rdt in rdts:
+        try:
+            _, suffix = get_line_sign_and_suffix(_determine_line(rdt, plane), input_files, plane)
+        except ValueError:  # reported when processing the RDT
+            continue
+        columns.extend(column for column in (f"AMP{suffix}", f"PHASE{suffix}") if column not in columns)
+    joined = input_files.joined_frame(plane, columns, dpp_value=0)
+    return {column: joined.loc[:, input_files.get_columns(joined, column)] for column in columns}
+
+
+def _process_rdt(meas_input, input_files, phase_data, invariants, plane, rdt, lines):
     df = pd.DataFrame(phase_data)
     second_bpms = df.loc[:, "NAME2"].to_numpy()
     df["S2"] = df.loc[second_bpms, "S"].to_numpy()
     df["COUNT"] = len(input_files.dpp_frames(plane, 0))
     line = _determine_line(rdt, plane)
     phase_sign, suffix = get_line_sign_and_suffix(line, input_files, plane)
-    comp_coeffs1 = to_complex(
-        input_files.joined_frame(plane, [f"AMP{suffix}"], dpp_value=0).loc[df.index, :].to_numpy(),
-        phase_sign * input_files.joined_frame(plane, [f"PHASE{suffix}"], dpp_value=0).loc[df.index, :].to_numpy())
+    amplitudes, phases = lines[plane][f"AMP{suffix}"], lines[plane][f"PHASE{suffix}"]
+    comp_coeffs1 = to_complex(amplitudes.loc[df.index, :].to_numpy(),
+                              phase_sign * phases.loc[df.index, :].to_numpy())
     # Multiples of tunes needs to be added to phase at second BPM if that is in second turn
-    phase2 = phase_sign * input_files.joined_frame(plane, [f"PHASE{suffix}"], dpp_value=0).loc[second_bpms, :].to_numpy()
-    comp_coeffs2 = to_complex(
-        input_files.joined_frame(plane, [f"AMP{suffix}"], dpp_value=0).loc[second_bpms, :].to_numpy(),
-        _add_tunes_if_in_second_turn(df, input_files, line, phase2))
+    phase2 = phase_sign * phases.loc[second_bpms, :].to_numpy()
+    comp_coeffs2 = to_complex(amplitudes.loc[second_bpms, :].to_numpy(),
+                              _add_tunes_if_in_second_turn(df, input_files, line, phase2))
     # Get amplitude and phase of the line from linx/liny file
     line_amp, line_phase, line_amp_e, line_phase_e = complex_secondary_lines(  # TODO use the errors
         df.loc[:, "MEAS"].to_numpy()[:, np.newaxis] * meas_input.accelerator.beam_direction,
         df.loc[:, "ERRMEAS"].to_numpy()[:, np.newaxis], comp_coeffs1, comp_coeffs2)
-    rdt_phases_per_file = _calculate_rdt_phases_from_line_phases(df, input_files, line, line_phase)
+    rdt_phases_per_file = _calculate_rdt_phases_from_line_phases(df, input_files, line, line_phase, lines)
     rdt_angles = stats.circular_mean(rdt_phases_per_file, period=1, axis=1) % 1
     df[f"PHASE"] = rdt_angles
     df[f"{ERR}PHASE"] = stats.circular_error(rdt_phases_per_file, period=1, axis=1)
@@ -205,30 +240,30 @@ def _add_tunes_if_in_second_turn(df, input_files, line, phase2):
     return phase2
 
 
-def _calculate_rdt_phases_from_line_phases(df, input_files, line, line_phase):
+def _calculate_rdt_phases_from_line_phases(df, input_files, line, line_phase, lines):
     phases = np.zeros((2, df.index.size, len(input_files.dpp_frames("X", 0))))
     for i, plane in enumerate(PLANES):
         if line[i] != 0:
-            phases[i] = input_files.joined_frame(plane, [f"MU{plane}"], dpp_value=0).loc[df.index, :].to_numpy() % 1
+            phases[i] = lines[plane][f"MU{plane}"].loc[df.index, :].to_numpy() % 1
     return line_phase - line[0] * phases[0] - line[1] * phases[1] + 0.25
 
 
 def _fit_rdt_amplitudes(invariants, line_amp, plane, rdt):
     """
     Returns RDT amplitudes in units of meters ^ {1 - n/2}, where n is the order of RDT.
+    The model ``f * kick_data`` is linear, so the amplitudes of all BPMs are given by the
+    least squares solution and their errors as the ones of ``scipy.optimize.curve_fit``.
     """
-    amps, err_amps = np.empty(line_amp.shape[0]), np.empty(line_amp.shape[0])
     kick_data = get_linearized_problem(invariants, plane, rdt)  # corresponding to actions in meters
-    guess = np.mean(line_amp / kick_data, axis=1)
-
-    def fitting(x, f):
-        return f * x
-
-    for i, bpm_rdt_data in enumerate(line_amp):
-        popt, pcov = curve_fit(fitting, kick_data, bpm_rdt_data, p0=guess[i])
-        amps[i] = popt[0]
-        err_amps[i] = np.sqrt(pcov)[0] if np.isfinite(np.sqrt(pcov)[0]) else 0. # if single file is used, the error is reported as Inf, which is then overwritten with 0
-    return amps, err_amps
+    if not (np.all(np.isfinite(kick_data)) and np.all(np.isfinite(line_amp))):
+        raise ValueError("The line amplitudes or the actions contain infs or NaNs")
+    sum_squared_kicks = np.sum(np.square(kick_data))
+    amps = line_amp @ kick_data / sum_squared_kicks
+    n_files = len(kick_data)
+    if n_files < 2:  # if single file is used, the error is reported as 0
+        return amps, np.zeros_like(amps)
+    sum_squared_residuals = np.sum(np.square(line_amp - amps[:, np.newaxis] * kick_data), axis=1)
+    return amps, np.sqrt(sum_squared_residuals / (n_files - 1) / sum_squared_kicks)
 
 
 def get_linearized_problem(invs, plane, rdt):
@@ -18,7 +18,9 @@ to use. Check :ref:`modules/model:Model` to see which ones are needed.
 
 - **outfile_path** *(str)*:
 
-    Name of fullresponse file.
+    Name of fullresponse file. With madx, it also holds the checkpoints
+    of the finished MAD-X jobs, from which an interrupted run is resumed.
+    Checkpoints of a run with different settings are refused.
 
 
 - **creator** *(str)*:
@@ -44,6 +46,14 @@ to use. Check :ref:`modules/model:Model` to see which ones are needed.
     default: ``2e-05``
 
 
+- **float32_response**:
+
+    Calculate the response in single precision,
+    which halves its memory (twiss-only).
+
+    action: ``store_true``
+
+
 - **optics_params** *(str)*:
 
     List of parameters to correct upon (e.g. BBX BBY; twiss-only).
@@ -88,7 +98,9 @@ def response_params():
                          )
     params.add_parameter(name="outfile_path",
                          type=PathOrStr,
-                         help="Name of fullresponse file."
+                         help="Name of fullresponse file. With madx, it also holds the checkpoints "
+                              "of the finished MAD-X jobs, from which an interrupted run is resumed. "
+                              "Checkpoints of a run with different settings are refused."
                          )
     params.add_parameter(name="delta_k",
                          type=float,
@@ -100,6 +112,10 @@ def response_params():
                          choices=OPTICS_PARAMS_CHOICES,
                          help="List of parameters to correct upon (e.g. BBX BBY; twiss-only).",
                          )
+    params.add_parameter(name="float32_response",
+                         action="store_true",
+                         help="Calculate the response in single precision, which halves its memory (twiss-only).",
+                         )
     params.add_parameter(help="Print debug information.",
                          name="debug",
                          action="store_true",
@@ -118,12 +134,12 @@ def create_response_entrypoint(opt: DotDict, other_opt) -> Dict[str, pd.DataFram
 
     if opt.creator == "madx":
         fullresponse = response_madx.create_fullresponse(
-            accel_inst, opt.variable_categories, delta_k=opt.delta_k
+            accel_inst, opt.variable_categories, delta_k=opt.delta_k, checkpoint_path=opt.outfile_path
         )
 
     elif opt.creator == "twiss":
         fullresponse = response_twiss.create_response(
-            accel_inst, opt.variable_categories, opt.optics_params
+            accel_inst, opt.variable_categories, opt.optics_params, float32=opt.float32_response
         )
 
     if opt.outfile_path is not None:
@@ -0,0 +1,58 @@
+"""
+Fullresponse Converter
+----------------------
+
+Script to convert fullresponse files from the older table layout into the chunked layout
+of :mod:`omc3.correction.response_io`, from which only the responses to the variables
+used in a correction are read.
+
+
+**Arguments:**
+
+*--Required--*
+
+- **inputfile** *(PathOrStr)*: Path to the fullresponse file to convert.
+
+
+*--Optional--*
+
+- **outputfile** *(PathOrStr)*: Path to write the converted fullresponse file to.
+  If not given, the input file is converted in place.
+"""
+from pathlib import Path
+
+from generic_parser import EntryPointParameters, entrypoint
+
+from omc3.correction.response_io import convert_fullresponse
+from omc3.utils.iotools import PathOrStr
+from omc3.utils.logging_tools import get_logger
+
+LOG = get_logger(__name__)
+
+
+def get_params():
+    return EntryPointParameters(
+        inputfile=dict(
+            required=True,
+            type=PathOrStr,
+            help="Path to the fullresponse file to convert.",
+        ),
+        outputfile=dict(
+            type=PathOrStr,
+            help=("Path to write the converted fullresponse file to. "
+                  "If not given, the input file is converted in place."),
+        ),
+    )
+
+
+@entrypoint(get_params(), strict=True)
+def main(opt):
+    outputfile = None if opt.outputfile is None else Path(opt.outputfile)
+    convert_fullresponse(Path(opt.inputfile), outputfile)
+
+
+# Script Mode ------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    main()
@@ -12,7 +12,7 @@ import pandas as pd
 from numpy.typing import ArrayLike, NDArray
 
 from omc3.utils import logging_tools
-from omc3.utils.outliers import get_filter_mask
+from omc3.utils.outliers import get_moving_filter_mask
 from dataclasses import dataclass
 
 
@@ -98,7 +98,8 @@ def get_moving_average(data_series: pd.Series, filter_opt: MinMaxFilterOpt) -> T
 def clean_outliers_moving_average(data_series: pd.Series, filter_opt: OutlierFilterOpt) -> Tuple[pd.Series, pd.Series, NDArray[bool]]:
     """
     Get a moving average of the ``data_series`` over ``length`` entries, by means of
-    :func:`outlier filter <omc3.utils.outliers.get_filter_mask>`.
+    :func:`outlier filter <omc3.utils.outliers.get_filter_mask>` in a
+    :func:`moving window <omc3.utils.outliers.get_moving_filter_mask>`.
     The values are shifted, so that the averaged value takes ceil((length-1)/2) values previous
     and floor((length-1)/2) following values into account.
 
@@ -109,9 +110,8 @@ def clean_outliers_moving_average(data_series: pd.Series, filter_opt: OutlierFil
     LOG.debug(f"Filtering and calculating moving average of length {filter_opt.window:d}.")
     window, limit = filter_opt.window, filter_opt.limit
     init_mask = ~data_series.isna()
-    mask = init_mask.copy()
-    for i in range(len(data_series)-filter_opt.window):
-        mask[i:i+window] &= get_filter_mask(data_series[i:i+window], limit=limit, mask=init_mask[i:i+window])
+    mask = pd.Series(get_moving_filter_mask(data_series.to_numpy(), window, limit=limit, mask=init_mask.to_numpy()),
+                     index=init_mask.index, name=init_mask.name)
 
     _is_almost_empty_mask(mask, window)
     data_mav, err_mav = _get_interpolated_moving_average(data_series, ~mask, window)
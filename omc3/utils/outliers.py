@@ -4,7 +4,10 @@ Outliers
 
 Helper functions for outlier detection.
 """
+from functools import lru_cache
+
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from numpy.typing import ArrayLike
 from scipy.stats import t
 
@@ -12,6 +15,8 @@ from omc3.utils import logging_tools
 
 LOGGER = logging_tools.get_logger(__name__)
 
+MAX_CHUNK_ELEMENTS = 2 ** 20  # windows x window-length elements processed at once
+
 
 def get_filter_mask(data: ArrayLike, x_data: ArrayLike = None, limit: float = 0.0,
                     niter: int = 20, nsig: int = None, mask: ArrayLike = None) -> ArrayLike:
@@ -111,6 +116,89 @@ def get_filter_mask(data: ArrayLike, x_data: ArrayLike = None, limit: float = 0.
     return mask
 
 
+def get_moving_filter_mask(data: ArrayLike, window: int, limit: float = 0.0, niter: int = 20,
+                           mask: ArrayLike = None) -> np.ndarray:
+    """
+    Filters the data with :func:`get_filter_mask` in a moving window, i.e. a data-point is kept
+    only if it is kept in every window it is part of. The windows start at every index
+    up to ``len(data) - window`` (excluded) and the filter is applied to each window independently,
+    considering the data-points given by ``mask``, with the number of sigmas
+    depending on the number of these points in the window.
+
+    The filter iterations are done for many windows at once on strided views of the data,
+    which is equivalent to calling :func:`get_filter_mask` on every window.
+
+    Args:
+         data (ArrayLike): Data to filter.
+         window (int): Length of the moving window.
+         limit (float): Only data deviating more than this limit from the average is filtered.
+         niter (int): Maximum number of filter iterations to do per window.
+         mask (ArrayLike): Boolean mask of data-points to consider.
+                           If ``None``, all data is considered.
+
+    Returns:
+        np.ndarray: Boolean array containing ``True`` entries for data-points that are good,
+                    and ``False`` for the ones that should be filtered.
+    """
+    data = np.asarray(data, dtype=float)
+    init_mask = np.ones_like(data, dtype=bool) if mask is None else np.asarray(mask, dtype=bool)
+    if not len(data) == len(init_mask):
+        raise ValueError("Mask is not equally long as dataset.")
+
+    n_windows = len(data) - window
+    filtered = np.zeros_like(init_mask)  # filtered in any window
+    if n_windows <= 0:
+        return init_mask.copy()
+    nsigs = _get_significance_cuts(window)
+    data_windows, mask_windows = sliding_window_view(data, window), sliding_window_view(init_mask, window)
+    chunk = max(1, MAX_CHUNK_ELEMENTS // window)
+    for start in range(0, n_windows, chunk):
+        end = min(start + chunk, n_windows)
+        window_masks = _filter_windows(data_windows[start:end], mask_windows[start:end].copy(),
+                                       nsigs, limit, niter)
+        for offset in range(window):
+            filtered[start + offset:end + offset] |= ~window_masks[:, offset]
+    return init_mask & ~filtered
+
+
+def _filter_windows(data: np.ndarray, mask: np.ndarray, nsigs: np.ndarray, limit: float, niter: int
+                    ) -> np.ndarray:
+    """ The iterations of :func:`get_filter_mask` on the rows of ``data``, for all rows at once. """
+    data = np.where(mask, data, 0.)  # no NaNs in the sums below
+    n_current = np.sum(mask, axis=1)
+    nsig = nsigs[n_current]
+    n_previous = n_current + 1
+    active = np.ones(len(data), dtype=bool)
+    for _ in range(niter):
+        n_current = np.sum(mask, axis=1)
+        active &= (n_current < n_previous) & (n_current > 2)
+        if not np.any(active):
+            break
+        n_previous = n_current
+        rows = slice(None) if np.all(active) else np.flatnonzero(active)  # views while all are active
+        y, y_mask = data[rows], mask[rows]
+        weights, n = y_mask.astype(float), n_current[rows]
+        avg = np.einsum("ij,ij->i", y, weights) / n
+        deviation = y - avg[:, np.newaxis]
+        std = np.sqrt(np.einsum("ij,ij,ij->i", deviation, deviation, weights) / n)
+        cut = np.maximum(limit, nsig[rows] * std)
+        mask[rows] = y_mask & (np.abs(deviation) < cut[:, np.newaxis])
+    else:
+        LOGGER.debug("Outlier Filter loop exceeds maximum number of iterations."
+                     " Current filter-mask will be used.")
+    return mask
+
+
+@lru_cache(maxsize=32)
+def _get_significance_cuts(max_length: int) -> np.ndarray:
+    """ The sigma cuts of :func:`_get_significance_cut_from_length` for lengths up to ``max_length``.
+    The entry for length zero is ``NaN``, it is never used as at least three points are needed. """
+    cuts = np.full(max_length + 1, np.nan)
+    cuts[1:] = _get_significance_cut_from_length(np.arange(1, max_length + 1))
+    cuts.flags.writeable = False
+    return cuts
+
+
 def _get_data_without_slope(mask, x, y):
     """ Remove the slope on the data by performing a linear fit. """
     m, b = np.polyfit(x[mask], y[mask], 1)
@@ -11,6 +11,8 @@ finite-sized sample.
 - TODO: LOGGER or Raising error and warnings?
 - TODO: if zeros or nans occur in errors, fallback to uniform weights only in affected cases
 """
+from threading import Lock
+
 import numpy as np
 from scipy.special import erf
 from scipy.stats import t
@@ -21,6 +23,8 @@ from omc3.utils import logging_tools
 LOGGER = logging_tools.get_logger(__name__)
 
 CONFIDENCE_LEVEL = (1 + erf(1 / np.sqrt(2))) / 2
+# the quantiles of the t-distribution are computed by cdflib, which is not thread-safe
+_T_PPF_LOCK = Lock()
 
 
 def circular_mean(data, period=PI2, errors=None, axis=None):
@@ -347,4 +351,5 @@ def t_value_correction(sample_size):
         multiplicative correction factor(s) of same shape as sample_size.
         Can contain nans.
     """
-    return t.ppf(CONFIDENCE_LEVEL, np.where(sample_size > 2, sample_size, 2) - 1)
+    with _T_PPF_LOCK:
+        return t.ppf(CONFIDENCE_LEVEL, np.where(sample_size > 2, sample_size, 2) - 1)
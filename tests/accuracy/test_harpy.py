@@ -10,8 +10,18 @@ import pytest
 import tfs
 
 import turn_by_turn as tbt
+from generic_parser import DotDict
+
 from omc3.definitions.constants import PLANES
-from omc3.hole_in_one import hole_in_one_entrypoint
+from omc3.harpy import clean as harpy_clean
+from omc3.harpy import fft_backend
+from omc3.harpy.bpm_matrix import BPMMatrix
+from omc3.harpy.frequency import windowed_padded_rfft
+from omc3.hole_in_one import HARPY_DEFAULTS, hole_in_one_entrypoint
+from omc3.utils import logging_tools
+from omc3.utils.contexts import timeit
+
+LOG = logging_tools.get_logger(__name__)
 
 LIMITS = dict(F1=1e-6, A1=1.5e-3, P1=3e-4, F2=1.5e-4, A2=1.5e-1, P2=0.03)
 NOISE = 3.2e-5
@@ -87,6 +97,131 @@ def test_harpy_without_model(_test_file, _model_file):
     model = tfs.read(_model_file)
     _assert_spectra(lin, model)
 
+@pytest.mark.basic
+@pytest.mark.parametrize("option, value, turn_bits", (
+    ("spectral_engine", "zoom", 18),
+    ("svd_engine", "randomized", 18),
+    ("svd_engine", "lanczos", 18),
+    ("peak_refinement", "parabolic", 12),
+    ("peak_refinement", "jacobsen", 12),
+    ("peak_refinement", "naff", 12),
+))
+def test_harpy_options(_test_file, _model_file, option, value, turn_bits):
+    model = _get_model_dataframe()
+    tfs.write(_model_file, model, save_index="NAME")
+    _write_tbt_file(model, os.path.dirname(_test_file))
+    hole_in_one_entrypoint(harpy=True,
+                           clean=True,
+                           autotunes="transverse",
+                           outputdir=os.path.dirname(_test_file),
+                           files=[_test_file],
+                           model=_model_file,
+                           to_write=["lin"],
+                           turn_bits=turn_bits,
+                           unit="m",
+                           **{option: value})
+    lin = dict(X=tfs.read(f"{_test_file}.linx"), Y=tfs.read(f"{_test_file}.liny"))
+    model = tfs.read(_model_file)
+    _assert_spectra(lin, model)
+
+
+@pytest.mark.extended
+@pytest.mark.parametrize("svd_engine", ("randomized", "lanczos"))
+def test_svd_engine_against_exact(svd_engine):
+    """ Benchmarks the truncated SVD engines against the exact SVD,
+    by comparing the cleaned data and the BPM resolution. """
+    model = _get_model_dataframe()
+    bpm_data = BPMMatrix(index=model.index, data=_get_tbt_matrices(model)[0]["X"].to_numpy())
+    bpm_data.data[3, :] += 100 * NOISE * np.random.randn(NTURNS)  # dominant BPM
+    results = {}
+    for engine in ("exact", svd_engine):
+        harpy_input = DotDict(HARPY_DEFAULTS, svd_engine=engine)
+        with timeit(lambda spanned: LOG.info(f"Time for SVD clean with {engine} engine: {spanned}")):
+            results[engine] = harpy_clean._svd_clean(
+                BPMMatrix(index=bpm_data.index, data=bpm_data.data.copy()), harpy_input)
+
+    (exact_data, exact_res, exact_bad, _), (data, res, bad, _) = results["exact"], results[svd_engine]
+    assert bad == exact_bad
+    assert all(data.index == exact_data.index)
+    diff_data = _rms(data.data - exact_data.data)
+    diff_res = _rms(_rel_diff(res, exact_res))
+    LOG.info(f"{svd_engine} vs. exact: RMS of cleaned data difference {diff_data:.1e}, "
+             f"RMS of relative BPM resolution difference {diff_res:.1e}")
+    assert diff_data < NOISE
+    assert diff_res < 0.05
+
+
+@pytest.mark.extended
+@pytest.mark.parametrize("clean", (True, False))
+def test_peak_refinement_precision_vs_runtime(_test_file, _model_file, clean):
+    """ Benchmarks the precision of the main lines with and without peak refinement
+    for different frequency resolutions, i.e. ``turn_bits``. """
+    model = _get_model_dataframe()
+    tfs.write(_model_file, model, save_index="NAME")
+    _write_tbt_file(model, os.path.dirname(_test_file))
+    model = tfs.read(_model_file)
+    tune_errors = {}
+    for turn_bits, peak_refinement in itertools.product((12, 14, 18), (None, "parabolic", "jacobsen", "naff")):
+        with timeit(lambda spanned: LOG.info(f"Time for harpy with turn_bits {turn_bits} "
+                                             f"and peak refinement {peak_refinement}: {spanned}")):
+            hole_in_one_entrypoint(harpy=True,
+                                   clean=clean,
+                                   peak_refinement=peak_refinement,
+                                   autotunes="transverse",
+                                   outputdir=os.path.dirname(_test_file),
+                                   files=[_test_file],
+                                   model=_model_file,
+                                   to_write=["lin"],
+                                   turn_bits=turn_bits,
+                                   unit="m")
+        lin = dict(X=tfs.read(f"{_test_file}.linx"), Y=tfs.read(f"{_test_file}.liny"))
+        tune_errors[(turn_bits, peak_refinement)] = max(
+            _rms(_diff(lin[plane].loc[:, f"TUNE{plane}"].to_numpy(), model.loc[:, f"TUNE{plane}"].to_numpy()))
+            for plane in PLANES)
+        phase_error = max(
+            _rms(_angle_diff(lin[plane].loc[:, f"MU{plane}"].to_numpy(), model.loc[:, f"MU{plane}"].to_numpy()))
+            for plane in PLANES)
+        LOG.info(f"RMS of tune error {tune_errors[(turn_bits, peak_refinement)]:.1e}, "
+                 f"RMS of phase error {phase_error:.1e}")
+
+    for peak_refinement in ("parabolic", "jacobsen", "naff"):
+        assert tune_errors[(12, peak_refinement)] < LIMITS["F1"]
+        assert tune_errors[(12, peak_refinement)] < 2 * tune_errors[(18, None)]
+    assert tune_errors[(12, None)] > LIMITS["F1"]
+
+
+@pytest.mark.extended
+@pytest.mark.parametrize("n_bpms, n_turns, turn_bits", ((100, 6600, 18), (500, 6600, 16)))
+def test_fft_backends_benchmark(n_bpms, n_turns, turn_bits):
+    """ Benchmarks the FFT backends on the spectra of realistic BPM x turn matrices. """
+    tunes = [0.28, 0.31, 0]
+    bpm_data = BPMMatrix(index=[f"BPM{i}" for i in range(n_bpms)],
+                         data=np.cos(2 * np.pi * (np.random.rand(n_bpms, 1) + tunes[0] * np.arange(n_turns)))
+                              + NOISE * np.random.randn(n_bpms, n_turns))
+    harpy_input = DotDict(HARPY_DEFAULTS, tunes=tunes, autotunes=None, nattunes=None, natdeltas=None,
+                          turn_bits=turn_bits, fft_chunk_size=50, fft_wisdom=None)
+    backends = [("numpy", 1), ("scipy", 1), ("scipy", os.cpu_count())]
+    if fft_backend.is_pyfftw_installed():
+        backends.extend([("pyfftw", 1), ("pyfftw", os.cpu_count())])
+
+    spectra = {}
+    for backend, workers in backends:
+        harpy_input.update(fft_backend=backend, fft_workers=workers)
+        windowed_padded_rfft(harpy_input, bpm_data, tunes)  # planning
+        with timeit(lambda spanned: LOG.info(f"Time for spectra of {n_bpms} BPMs x {n_turns} turns with "
+                                             f"turn_bits {turn_bits}, {backend} ({workers} workers): {spanned}")):
+            spectra[(backend, workers)] = windowed_padded_rfft(harpy_input, bpm_data, tunes)
+
+    frequencies, coefficients = spectra[("numpy", 1)]
+    main_lines = np.argmax(np.abs(coefficients.to_numpy()), axis=1)
+    for backend_frequencies, backend_coefficients in spectra.values():
+        assert np.allclose(coefficients.to_numpy(), backend_coefficients.to_numpy(),
+                           rtol=0, atol=1e-12 * np.max(np.abs(coefficients.to_numpy())))
+        assert np.array_equal(np.argmax(np.abs(backend_coefficients.to_numpy()), axis=1), main_lines)
+        assert np.array_equal(frequencies.to_numpy()[np.arange(n_bpms), main_lines],
+                              backend_frequencies.to_numpy()[np.arange(n_bpms), main_lines])
+
+
 @pytest.mark.extended
 @pytest.mark.parametrize("clean, keep_exact_zeros, sing_val, peak_to_peak, window, max_peak,"
                          "svd_dominance_limit, num_svd_iterations, tolerance, tune_clean_limit, turn_bits, output_bits",
@@ -206,6 +341,11 @@ def _get_model_dataframe():
 
 
 def _write_tbt_file(model, dir_path):
+    tbt_data = tbt.TbtData(matrices=_get_tbt_matrices(model), bunch_ids=[0], nturns=NTURNS)  # let date default
+    tbt.write(os.path.join(dir_path, "test_file"), tbt_data)
+
+
+def _get_tbt_matrices(model):
     ints = np.arange(NTURNS) - NTURNS / 2
     data_x = model.loc[:, "AMPX"].to_numpy()[:, None] * np.cos(2 * np.pi * (model.loc[:, "MUX"].to_numpy()[:, None] + model.loc[:, "TUNEX"].to_numpy()[:, None] * ints[None, :]))
     data_y = model.loc[:, "AMPY"].to_numpy()[:, None] * np.cos(2 * np.pi * (model.loc[:, "MUY"].to_numpy()[:, None] + model.loc[:, "TUNEY"].to_numpy()[:, None] * ints[None, :]))
@@ -214,8 +354,7 @@ def _write_tbt_file(model, dir_path):
         X=pd.DataFrame(data=np.random.randn(model.index.size, NTURNS) * NOISE + data_x + COUPLING * data_y + data_z, index=model.index),
         Y=pd.DataFrame(data=np.random.randn(model.index.size, NTURNS) * NOISE + data_y + COUPLING * data_x, index=model.index))
     ]
-    tbt_data = tbt.TbtData(matrices=matrices, bunch_ids=[0], nturns=NTURNS)  # let date default
-    tbt.write(os.path.join(dir_path, "test_file"), tbt_data)
+    return matrices
 
 
 def _other(plane):
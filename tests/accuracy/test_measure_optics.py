@@ -3,6 +3,7 @@ from pathlib import Path
 
 import numpy as np
 import pytest
+from pandas.testing import assert_frame_equal
 
 import tfs
 from omc3.hole_in_one import _optics_entrypoint  # <- Protected member of module. Make public?
@@ -78,6 +79,30 @@ def test_measure_optics(
     evaluate_accuracy(optics_opt.outputdir, LIMITS)
 
 
+@pytest.mark.extended
+def test_parallel_stages_same_output(tmp_path, input_data):
+    data = input_data["driven"]
+    lins, optics_opt = data['lins'], data['optics_opt']
+    outputs = {}
+    for num_processes in (1, 3):
+        outputs[num_processes] = tmp_path / f"processes_{num_processes}"
+        optics_opt.update(
+            outputdir=outputs[num_processes],
+            compensation="model",
+            chromatic_beating=True,
+            num_processes=num_processes,
+        )
+        measure_optics.measure_optics(InputFiles(lins[slice(None, 7)], optics_opt), optics_opt)
+
+    serial_files = sorted(f.name for f in outputs[1].glob("*.tfs"))
+    assert serial_files == sorted(f.name for f in outputs[3].glob("*.tfs"))
+    for name in serial_files:
+        serial, parallel = tfs.read(outputs[1] / name), tfs.read(outputs[3] / name)
+        assert_frame_equal(serial, parallel)
+        assert {key: value for key, value in serial.headers.items() if key != "Date"} == \
+               {key: value for key, value in parallel.headers.items() if key != "Date"}
+
+
 # Helper ---
 
 
@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 from typing import Sequence
 
@@ -7,8 +9,19 @@ import pytest
 import tfs
 import turn_by_turn as tbt
 from generic_parser import DotDict
+from pandas.testing import assert_frame_equal
 
-from omc3.hole_in_one import _add_suffix_and_iter_bunches, hole_in_one_entrypoint
+from omc3.harpy.clean import svd_decomposition
+from omc3.definitions.constants import PI2
+from omc3.harpy import fft_backend
+from omc3.harpy.bpm_matrix import BPMMatrix
+from omc3.harpy.constants import HEADER_UNSCALED_AMPS
+from omc3.harpy.frequency import (SpectrumFrequencies, _search_highest_coefs,
+                                  _search_highest_coefs_of_lines, get_peak_refinement,
+                                  windowed_padded_rfft, windowing)
+from omc3.harpy.handler import _get_cut_tbt_matrix, _scale_to_meters
+from omc3.hole_in_one import (HARPY_DEFAULTS, _add_suffix_and_iter_bunches, _background_lin_writer,
+                              _harpy_entrypoint, _read_tbt_files, _run_harpy, hole_in_one_entrypoint)
 from tests.accuracy.test_harpy import _get_model_dataframe
 
 
@@ -121,6 +134,281 @@ def test_harpy_with_suffix_and_bunchid(tmp_path, suffix, bunches):
                     assert not file_path.is_file()
 
 
+@pytest.mark.basic
+def test_tbt_matrix_not_copied_until_scaled():
+    """ Tests that the TbT matrix is only copied once, when scaled to meters,
+    so that the input data is not modified by the cleaning. """
+    model = _get_model_dataframe()
+    tbt_data = create_tbt_data(model=model, n_turns=20)
+    frame = tbt_data.matrices[0]["X"]
+
+    bpm_data = _get_cut_tbt_matrix(tbt_data, [2, 12], "X")
+    assert np.shares_memory(bpm_data.data, frame.to_numpy())
+    assert bpm_data.shape == (len(model.index), 10)
+    assert all(bpm_data.index == model.index)
+
+    scaled = _scale_to_meters(bpm_data, "mm")
+    assert not np.shares_memory(scaled.data, frame.to_numpy())
+    assert np.allclose(scaled.data, frame.iloc[:, 2:12].to_numpy() * 1e-3)
+
+    selected = scaled.loc(model.index[[5, 2]])
+    assert all(selected.index == model.index[[5, 2]])
+    assert np.all(selected.data == scaled.data[[5, 2]])
+    with pytest.raises(KeyError):
+        scaled.loc(["NOT_A_BPM"])
+
+
+@pytest.mark.basic
+@pytest.mark.parametrize("use_svd", (True, False))
+def test_chunked_fft_same_as_full(use_svd):
+    """ Tests that the spectra calculated in BPM-chunks, also in parallel,
+    are the same as when calculated for all BPMs at once. """
+    model = _get_model_dataframe()
+    bpm_data = _get_cut_tbt_matrix(create_tbt_data(model=model, n_turns=200), [0, 200], "X")
+    svd = svd_decomposition(bpm_data, 4)[:2] if use_svd else None
+    tunes = [model["TUNEX"].iloc[0], model["TUNEY"].iloc[0], 0]
+    harpy_input = DotDict(HARPY_DEFAULTS, tunes=tunes, autotunes=None, nattunes=None, natdeltas=None,
+                          turn_bits=12, output_bits=8, fft_wisdom=None)
+
+    spectra = {}
+    for chunk_size, threads in ((None, 1), (7, 1), (7, 3)):
+        harpy_input.update(fft_chunk_size=chunk_size, fft_threads=threads)
+        spectra[(chunk_size, threads)] = windowed_padded_rfft(harpy_input, bpm_data, tunes, svd)
+
+    frequencies, coefficients = spectra[(None, 1)]
+    assert frequencies.grid_indices.shape == coefficients.shape
+    assert frequencies.grid_indices.shape[0] == len(model.index)
+    for chunked_frequencies, chunked_coefficients in spectra.values():
+        assert_frame_equal(frequencies.to_frame(), chunked_frequencies.to_frame())
+        assert_frame_equal(coefficients, chunked_coefficients)
+
+
+@pytest.mark.basic
+@pytest.mark.parametrize("use_svd", (True, False))
+@pytest.mark.parametrize("autotunes", (None, "transverse"))
+def test_zoom_spectra_same_as_fft(use_svd, autotunes):
+    """ Tests that evaluating the spectra only in the frequency windows of interest
+    gives the same spectra as the full FFT. """
+    model = _get_model_dataframe()
+    bpm_data = _get_cut_tbt_matrix(create_tbt_data(model=model, n_turns=200), [0, 200], "X")
+    svd = svd_decomposition(bpm_data, 4)[:2] if use_svd else None
+    tunes = [model["TUNEX"].iloc[0], model["TUNEY"].iloc[0], 0]
+    harpy_input = DotDict(HARPY_DEFAULTS, tunes=tunes, autotunes=autotunes, nattunes=None,
+                          natdeltas=None, turn_bits=12, output_bits=8, resonances=2,
+                          fft_chunk_size=None, fft_wisdom=None)
+
+    frequencies, coefficients = windowed_padded_rfft(harpy_input, bpm_data, tunes, svd)
+    harpy_input.update(spectral_engine="zoom")
+    zoom_frequencies, zoom_coefficients = windowed_padded_rfft(harpy_input, bpm_data, tunes, svd)
+    assert_frame_equal(frequencies.to_frame(), zoom_frequencies.to_frame())
+    assert_frame_equal(coefficients, zoom_coefficients, rtol=1e-10)
+
+
+@pytest.mark.basic
+@pytest.mark.parametrize("spectral_engine", ("fft", "zoom"))
+@pytest.mark.parametrize("backend, workers", (("scipy", 1), ("scipy", 2),
+                                              pytest.param("pyfftw", 2, marks=pytest.mark.skipif(
+                                                  not fft_backend.is_pyfftw_installed(),
+                                                  reason="pyFFTW not installed"))))
+def test_fft_backends_same_spectra(tmp_path, spectral_engine, backend, workers):
+    """ Tests that the spectra calculated with the different FFT backends are the same. """
+    model = _get_model_dataframe()
+    bpm_data = _get_cut_tbt_matrix(create_tbt_data(model=model, n_turns=200), [0, 200], "X")
+    tunes = [model["TUNEX"].iloc[0], model["TUNEY"].iloc[0], 0]
+    harpy_input = DotDict(HARPY_DEFAULTS, tunes=tunes, autotunes=None, nattunes=None, natdeltas=None,
+                          turn_bits=12, output_bits=8, fft_chunk_size=None, fft_wisdom=None,
+                          spectral_engine=spectral_engine)
+
+    frequencies, coefficients = windowed_padded_rfft(harpy_input, bpm_data, tunes)
+    harpy_input.update(fft_backend=backend, fft_workers=workers, fft_wisdom=str(tmp_path / "wisdom"))
+    backend_frequencies, backend_coefficients = windowed_padded_rfft(harpy_input, bpm_data, tunes)
+    assert_frame_equal(frequencies.to_frame(), backend_frequencies.to_frame())
+    assert_frame_equal(coefficients, backend_coefficients, rtol=1e-10)
+    assert fft_backend.get_backend(backend, workers) is fft_backend.get_backend(backend, workers)
+    if backend == "pyfftw":
+        assert (tmp_path / "wisdom").is_file()
+
+
+@pytest.mark.basic
+def test_fftw_wisdom_written_from_threads(tmp_path):
+    """ Tests that the wisdom file survives concurrent writes and is read back as written. """
+    wisdom_file = str(tmp_path / "wisdom")
+    wisdoms = [(b"(fftw-3.3.10 fftw_wisdom #x%d)" % idx, b"", bytes(range(256)) * idx) for idx in range(8)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(partial(fft_backend.write_wisdom, wisdom_file), wisdoms))
+    assert fft_backend.read_wisdom(wisdom_file) in wisdoms
+    assert [path.name for path in tmp_path.iterdir()] == ["wisdom"]
+
+    (tmp_path / "wisdom").write_bytes(b"not a wisdom file")
+    with pytest.raises(IOError):
+        fft_backend.read_wisdom(wisdom_file)
+
+
+@pytest.mark.basic
+@pytest.mark.parametrize("peak_refinement", ("parabolic", "jacobsen", "naff"))
+def test_peak_refinement_beyond_frequency_grid(peak_refinement):
+    """ Tests that the refined peaks of lines between the frequencies of a coarse grid
+    are more precise than the grid. """
+    n_turns, turn_bits = 500, 10
+    tunes, amps, phases = np.array([0.2712345, 0.31, 0.4098765]), np.array([1., 2., 0.5]), np.array([0.1, -0.2, 0.3])
+    bpm_matrix = BPMMatrix(index=["BPM1", "BPM2", "BPM3"],
+                           data=amps[:, None] * np.cos(PI2 * (tunes[:, None] * np.arange(n_turns) + phases[:, None])))
+    harpy_input = DotDict(HARPY_DEFAULTS, turn_bits=turn_bits, output_bits=turn_bits, to_write=["full_spectra"],
+                          fft_chunk_size=None, fft_wisdom=None, peak_refinement=peak_refinement)
+    frequencies, coefficients = windowed_padded_rfft(harpy_input, bpm_matrix, [0.3, 0.3, 0])
+    refine = get_peak_refinement(harpy_input, bpm_matrix)
+
+    for freq in (0.3, 0.7):  # also mirrored frequencies
+        max_coefs, max_freqs = _search_highest_coefs(freq, 0.2, frequencies, coefficients)
+        refined_coefs, refined_freqs = _search_highest_coefs(freq, 0.2, frequencies, coefficients, refine)
+        expected_freqs = tunes if freq < 0.5 else 1 - tunes
+        assert np.max(np.abs(max_freqs - expected_freqs)) > 1e-5
+        assert np.max(np.abs(refined_freqs - expected_freqs)) < 2e-6
+        assert np.allclose(np.abs(refined_coefs), amps, rtol=1e-3)
+        assert np.allclose(np.angle(refined_coefs) / PI2, phases, atol=1e-3)
+
+
+@pytest.mark.basic
+def test_search_highest_coefs_of_lines():
+    """ Tests the search of all lines at once against the search in the full spectra per line,
+    also for empty windows, lines above 0.5 and equal maxima. """
+    n_bpms, n_bins, sub_bins = 20, 64, 4
+    grid = np.arange(n_bins * sub_bins) / (2 * n_bins * sub_bins)
+    grid_indices = np.arange(n_bins) * sub_bins + np.random.randint(sub_bins, size=(n_bpms, n_bins))
+    spectrum_frequencies = SpectrumFrequencies(index=pd.RangeIndex(n_bpms), grid=grid, grid_indices=grid_indices)
+    frequencies = grid[grid_indices]
+    coefficients = np.random.randn(n_bpms, n_bins) + 1j * np.random.randn(n_bpms, n_bins)
+    coefficients[:, 10:12] = 1  # equal maxima
+    coefficients[0, :] = 0  # no line found
+    freqs, tolerances = [0.1, 0.9, 0.0, 0.3, 0.6, 0.0835, 0.25], [0.02, 0.01, 0.001, 0.0, 0.05, 0.005, 0.001]
+
+    max_coefs, max_freqs = _search_highest_coefs_of_lines(freqs, tolerances, spectrum_frequencies,
+                                                          pd.DataFrame(coefficients))
+    for i, (freq, tolerance) in enumerate(zip(freqs, tolerances)):
+        p_freq = freq if freq < 0.5 else 1 - freq
+        on_window = (frequencies >= p_freq - tolerance) & (frequencies <= p_freq + tolerance)
+        filtered_coefs = np.where(on_window, coefficients, 0)
+        max_indices = np.argmax(np.abs(filtered_coefs), axis=1)
+        expected_coefs = filtered_coefs[np.arange(n_bpms), max_indices]
+        expected_freqs = frequencies[np.arange(n_bpms), max_indices]
+        expected_freqs = np.where(expected_coefs != 0, expected_freqs if freq < 0.5 else 1 - expected_freqs, 0)
+        assert np.array_equal(max_coefs[:, i], expected_coefs)
+        assert np.array_equal(max_freqs[:, i], expected_freqs)
+        single_coefs, single_freqs = _search_highest_coefs(freq, tolerance, spectrum_frequencies,
+                                                           pd.DataFrame(coefficients))
+        assert np.array_equal(single_coefs.to_numpy(), expected_coefs)
+        assert np.array_equal(single_freqs.to_numpy(), expected_freqs)
+
+
+@pytest.mark.basic
+def test_spectrum_frequencies_selection():
+    grid = np.linspace(0, 0.5, 11)
+    frequencies = SpectrumFrequencies(index=pd.Index(["A", "B", "C"]), grid=grid,
+                                      grid_indices=np.array([[0, 3], [1, 4], [2, 10]]))
+    selected = frequencies.loc(["C", "A"])
+    assert list(selected.index) == ["C", "A"]
+    assert np.array_equal(selected.to_numpy(), grid[[[2, 10], [0, 3]]])
+    assert_frame_equal(selected.to_frame(), frequencies.to_frame().loc[["C", "A"]])
+
+
+@pytest.mark.basic
+@pytest.mark.parametrize("window", ("rectangle", "welch", "triangle", "hann", "hamming", "nuttal3", "nuttal4"))
+def test_windowing_cached(window):
+    values = windowing(100, window)
+    assert windowing(100, window) is values
+    assert not values.flags.writeable
+    assert np.isclose(np.sum(values), 1)
+    with pytest.raises(NotImplementedError):
+        windowing(100, "unknown")
+
+
+@pytest.mark.basic
+@pytest.mark.parametrize("read_ahead", (True, False))
+def test_read_tbt_files_lazily(monkeypatch, read_ahead):
+    """ Tests the function :func:`omc3.hole_in_one._read_tbt_files`
+    by checking that the files are read in order and only when needed."""
+    read_files = []
+
+    def mock_read_tbt(file_name, datatype):
+        read_files.append(file_name)
+        return f"data_{file_name}"
+
+    monkeypatch.setattr(tbt, "read_tbt", mock_read_tbt)
+    all_options = [DotDict(files=f"file_{idx}", tbt_datatype="lhc") for idx in range(4)]
+    n_read_ahead = int(read_ahead)
+
+    tbt_datas = _read_tbt_files(all_options, read_ahead=read_ahead)
+    assert not len(read_files)
+    for idx, (data, option) in enumerate(tbt_datas):
+        assert option is all_options[idx]
+        assert data == f"data_{option.files}"
+        assert read_files[idx] == option.files
+        assert len(read_files) <= min(idx + 1 + n_read_ahead, len(all_options))
+    assert read_files == [option.files for option in all_options]
+
+
+@pytest.mark.extended
+def test_harpy_parallel_same_as_serial(tmp_path):
+    """ Runs harpy on multiple multi-bunch files, serial and in parallel (with read-ahead),
+    and checks that the returned lin-frames are the same and in the same order. """
+    model = _get_model_dataframe()
+    tbt_files = [tmp_path / f"test_file_{idx}.sdds" for idx in range(2)]
+    for tbt_file in tbt_files:
+        tbt.write(tbt_file, create_tbt_data(model=model, bunch_ids=[1, 5, 15]))
+
+    lins = {}
+    for num_processes in (1, 3):
+        harpy_options, _ = _harpy_entrypoint(dict(
+            files=[str(tbt_file) for tbt_file in tbt_files],
+            outputdir=str(tmp_path / f"processes_{num_processes}"),
+            autotunes="transverse",
+            to_write=["lin"],
+            turn_bits=4,  # make it fast
+            output_bits=4,
+            num_processes=num_processes,
+            read_ahead=num_processes > 1,
+        ))
+        lins[num_processes] = _run_harpy(harpy_options)
+
+    assert len(lins[1]) == len(lins[3]) == 6
+    for lin_serial, lin_parallel in zip(lins[1], lins[3]):
+        for plane in "XY":
+            assert_frame_equal(lin_serial[plane], lin_parallel[plane])
+            assert lin_serial[plane].headers == lin_parallel[plane].headers
+
+
+@pytest.mark.basic
+def test_lins_written_in_background_same_as_in_harpy(tmp_path):
+    """ Checks that the lin files written in the background are the same as the ones written by
+    harpy itself, and that the in-memory results have the unscaled main amplitudes. """
+    tbt_file = tmp_path / "test_file.sdds"
+    tbt.write(tbt_file, create_tbt_data(model=_get_model_dataframe()))
+
+    lins, lin_files = {}, {}
+    for background in (False, True):
+        outputdir = tmp_path / f"background_{background}"
+        harpy_options, _ = _harpy_entrypoint(dict(
+            files=[str(tbt_file)],
+            outputdir=str(outputdir),
+            autotunes="transverse",
+            to_write=["lin"],
+            turn_bits=4,  # make it fast
+            output_bits=4,
+        ))
+        with _background_lin_writer() as write_lins:
+            lins[background] = _run_harpy(harpy_options, write_lins if background else None)
+        lin_files[background] = {plane: tfs.read(outputdir / f"{tbt_file.name}.lin{plane.lower()}", index="NAME")
+                                 for plane in "XY"}
+
+    for plane in "XY":
+        assert_frame_equal(lin_files[False][plane], lin_files[True][plane])
+        assert lin_files[False][plane].headers == lin_files[True][plane].headers
+        assert_frame_equal(lins[False][0][plane], lins[True][0][plane])
+        assert np.allclose(lins[True][0][plane][f"AMP{plane}"], 2 * lin_files[True][plane][f"AMP{plane}"])
+        assert lins[True][0][plane].headers[HEADER_UNSCALED_AMPS]
+        assert HEADER_UNSCALED_AMPS not in lin_files[True][plane].headers
+
+
 # Helper ---
 
 def create_tbt_data(model: pd.DataFrame, bunch_ids: Sequence[int] = (0, ), n_turns: int = 10) -> tbt.TbtData:
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import scipy.optimize
+
+from omc3.kmod.analysis import (WaistFitParameters, average_beta_defocussing_quadrupole,
+                                average_beta_focussing_quadrupole, fit_beta_waist,
+                                return_sign_for_err, waist_jacobian, waist_residuals)
+
+BETA_WAIST, WAIST = 0.43, 0.012
+
+
+@pytest.mark.basic
+def test_waist_jacobian_against_finite_differences():
+    params = _get_fit_parameters()
+    b, w = np.full(19, 0.5), np.full(19, -0.03)
+    step = 1e-7
+    numeric = np.stack([
+        (waist_residuals(params, b + step, w) - waist_residuals(params, b - step, w)) / (2 * step),
+        (waist_residuals(params, b, w + step) - waist_residuals(params, b, w - step)) / (2 * step),
+    ], axis=1)
+    assert np.allclose(waist_jacobian(params, b, w), numeric, rtol=1e-6, atol=1e-9)
+
+
+@pytest.mark.basic
+def test_fit_beta_waist_same_as_single_fits():
+    params = _get_fit_parameters()
+    x0 = np.array([0.6, 0.0])
+    results = fit_beta_waist(params, x0)
+
+    assert results.shape == (19, 2)
+    assert np.allclose(results[0], [BETA_WAIST, WAIST], rtol=1e-8)
+    for fit in range(19):
+        single = params.take(slice(fit, fit + 1))
+
+        def fun(x): return np.sum(waist_residuals(single, x[:1], x[1:]) ** 2)
+        expected = scipy.optimize.minimize(fun=fun, x0=x0, method='nelder-mead', tol=1E-22).x
+        assert np.allclose(results[fit], expected, rtol=1e-7, atol=1e-9)
+
+
+@pytest.mark.basic
+def test_fit_beta_waist_non_finite_stays_at_start():
+    params = _get_fit_parameters()._replace(foc_beta=np.full(19, np.nan))
+    x0 = np.array([0.6, 0.0])
+    assert np.all(fit_beta_waist(params, x0) == x0)
+
+
+def _get_fit_parameters():
+    sign = return_sign_for_err(9)
+    length, k, lstar, bpm_distance = 6.37, 0.0087, 23.0, 21.6
+    foc_beta = average_beta_focussing_quadrupole(BETA_WAIST, WAIST, length, k, lstar)
+    def_beta = average_beta_defocussing_quadrupole(BETA_WAIST, -WAIST, length, -k, lstar)
+    phase_adv = (np.arctan((bpm_distance - WAIST) / BETA_WAIST)
+                 + np.arctan((bpm_distance + WAIST) / BETA_WAIST)) / (2 * np.pi)
+    return WaistFitParameters(
+        foc_length=length + sign[:, 0] * 0.001,
+        foc_k=k + sign[:, 1] * 0.001 * k,
+        foc_lstar=lstar + sign[:, 2] * 0.006,
+        foc_beta=foc_beta - sign[:, 3] * 0.5,
+        def_length=length + sign[:, 4] * 0.001,
+        def_k=-k - sign[:, 5] * 0.001 * k,
+        def_lstar=lstar + sign[:, 6] * 0.006,
+        def_beta=def_beta - sign[:, 7] * 0.5,
+        beta_norm=2.0 * (foc_beta + def_beta),
+        phase_adv=phase_adv + sign[:, 8] * 0.5e-3,
+        phase_adv_norm=phase_adv,
+        phase_weight=0.5,
+        bpm_distance=bpm_distance,
+    )
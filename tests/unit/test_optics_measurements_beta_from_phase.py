@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from omc3.definitions.constants import PI2
+from omc3.optics_measurements import beta_from_phase
+
+N_ELEMENTS = 30
+MDLTUNE = 0.28
+
+
+@pytest.mark.basic
+def test_covariant_weighting_batched_same_as_single():
+    rng = np.random.default_rng(1234)
+    lines = rng.normal(size=(6, 5, 3))
+    mats = lines @ np.swapaxes(lines, 1, 2) + np.eye(5) * 1e-3  # symmetric, positive definite
+    cols = rng.normal(size=(6, 5))
+    values, errors = beta_from_phase._covariant_weighting(mats, cols)
+    for mat, col, value, error in zip(mats, cols, values, errors):
+        mat_inv = np.linalg.pinv(mat, rcond=beta_from_phase.RCOND)
+        weights = np.sum(mat_inv, axis=1)
+        assert np.isclose(value, np.dot(weights, col) / np.sum(mat_inv), rtol=1e-12)
+        assert np.isclose(error, np.sqrt(weights @ mat @ weights) / np.sum(mat_inv), rtol=1e-10)
+
+
+@pytest.mark.basic
+def test_covariant_weighting_raises_on_zero_weights():
+    with pytest.raises(ValueError):
+        beta_from_phase._covariant_weighting(np.zeros((2, 3, 3)), np.ones((2, 3)))
+
+
+@pytest.mark.basic
+def test_elements_in_range_wrap_around():
+    elements = _elements()
+    bpms = elements.index[::3]
+    m = 2
+    phases, betas, weights, bpm_locs = beta_from_phase._get_elements_in_range(elements, bpms, "X", MDLTUNE, m)
+    mu, bet = elements["MUX"].to_numpy(), elements["BETX"].to_numpy()
+    n_bpms = len(bpms)
+    for i in range(n_bpms):
+        range_bpms = (np.arange(i - m, i + m + 1)) % n_bpms
+        turns = (np.arange(i - m, i + m + 1)) // n_bpms
+        # the BPMs are found at their locations, with the tune added on other turns
+        assert np.allclose(phases[i, bpm_locs[i]], (mu[range_bpms * 3] + turns * MDLTUNE) * PI2)
+        assert np.allclose(betas[i, bpm_locs[i]], bet[range_bpms * 3])
+        # no elements outside of the range
+        assert bpm_locs[i, 0] == 0
+        assert not np.any(betas[i, bpm_locs[i, -1] + 1:])
+        assert not np.any(weights["BET"][i, bpm_locs[i, -1] + 1:])
+    assert set(weights) == {"BET", "ALF", "ALF_K2"}
+
+
+@pytest.mark.basic
+def test_elements_in_range_missing_bpm():
+    elements = _elements()
+    with pytest.raises(KeyError):
+        beta_from_phase._get_elements_in_range(elements, pd.Index(["NOT_A_BPM"]), "X", MDLTUNE, 1)
+
+
+def _elements():
+    rng = np.random.default_rng(4321)
+    return pd.DataFrame(
+        data=dict(MUX=np.cumsum(rng.uniform(0, 0.02, N_ELEMENTS)), BETX=rng.uniform(10, 100, N_ELEMENTS),
+                  K2L=rng.normal(size=N_ELEMENTS), dK1=rng.uniform(size=N_ELEMENTS),
+                  dX=rng.uniform(size=N_ELEMENTS), KdS=rng.uniform(size=N_ELEMENTS),
+                  mKdS=rng.uniform(size=N_ELEMENTS)),
+        index=pd.Index([f"ELEMENT{i}" for i in range(N_ELEMENTS)], name="NAME"))
@@ -0,0 +1,125 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+import tfs
+from generic_parser import DotDict
+from pandas.testing import assert_frame_equal
+
+from omc3.harpy.constants import HEADER_UNSCALED_AMPS
+from omc3.optics_measurements.data_models import (
+    InputFiles, _ColumnarStore, _merge_frames, _read_columns, _read_lin_file, projected_lines
+)
+
+N_BPMS = 30
+N_FILES = 4
+LIN_FILE = Path(__file__).parent.parent / "inputs" / "rdt" / "skew_quadrupole" / "B1_skew_quadrupole1.linx"
+COUPLING_LIN_FILE = Path(__file__).parent.parent / "inputs" / "coupling" / "beam1.sdds.linx"
+
+
+@pytest.mark.basic
+@pytest.mark.parametrize("how", ["inner", "outer"])
+@pytest.mark.parametrize("files", [[0], [2], [0, 1, 2, 3], [3, 1]])
+def test_store_joined_frame_same_as_merge(how, files):
+    frames = _random_frames()
+    columns = ["MUX", "AMPX", "MISSING"]
+    store = _ColumnarStore(frames)
+    expected = _merge_frames([frames[i] for i in files], columns, how)
+    assert_frame_equal(store.joined_frame(columns, files, how), expected)
+    assert list(store.index[store.rows(files, "inner")]) == list(
+        _merge_frames([frames[i] for i in files], columns, "inner").index)
+
+
+@pytest.mark.basic
+def test_store_skips_non_float_columns():
+    frames = _random_frames()
+    store = _ColumnarStore(frames)
+    assert store.column("NAME") is None
+    assert store.joined_frame(["MUX", "NAME"], [0, 1], "inner") is None
+    assert store.joined_frame(["MUX", "MUX"], [0, 1], "inner") is None
+
+
+@pytest.mark.basic
+def test_joined_frame_with_cache_cleared_meanwhile():
+    frames = _random_frames()
+    input_files = InputFiles.__new__(InputFiles)
+    dict.__init__(input_files, X=frames, Y=[])
+    input_files._unloaded = {"X": [set()] * N_FILES, "Y": []}
+    input_files._clear_cache()
+    # e.g. another stage thread loading left-out columns right after a result is cached
+    input_files._joined_cache = _ClearedOnStore(input_files)
+    input_files._bpms_cache = _ClearedOnStore(input_files)
+
+    columns = ["MUX", "AMPX"]
+    assert_frame_equal(input_files.joined_frame("X", columns), _merge_frames(frames, columns, "inner"))
+    input_files._bpms_cache = _ClearedOnStore(input_files)
+    assert list(input_files.bpms("X")) == list(_merge_frames(frames, columns, "inner").index)
+
+
+@pytest.mark.basic
+def test_amplitudes_rescaled_unless_marked_unscaled():
+    frame = tfs.TfsDataFrame(_random_frames()[0], headers={"Q1": 0.28})
+    lin_frame = InputFiles._repair_backwards_compatible_frame(frame.copy(), "X")
+    assert np.allclose(lin_frame["AMPX"], 2 * frame["AMPX"])
+
+    harpy_frame = tfs.TfsDataFrame(frame.copy(), headers={"Q1": 0.28, HEADER_UNSCALED_AMPS: 1})
+    harpy_frame = InputFiles._repair_backwards_compatible_frame(harpy_frame, "X")
+    assert_frame_equal(pd.DataFrame(harpy_frame), pd.DataFrame(frame))
+    assert harpy_frame.headers == {"Q1": 0.28}
+
+
+@pytest.mark.basic
+def test_read_lin_file_with_projection():
+    full = tfs.read(LIN_FILE).set_index("NAME", drop=False)
+    projected, left_out = _read_lin_file(str(LIN_FILE), {"AMP01", "PHASE01"})
+
+    assert "AMP01" in projected.columns and "AMP20" in left_out and "FREQ01" in left_out
+    assert "AMPX" in projected.columns and "MUX" in projected.columns
+    assert set(projected.columns) | left_out == set(full.columns)
+    assert projected.headers == full.headers
+    assert_frame_equal(pd.DataFrame(projected), pd.DataFrame(full.loc[:, projected.columns]))
+    assert_frame_equal(pd.DataFrame(_read_columns(str(LIN_FILE), ["NAME", "AMP20"])),
+                       pd.DataFrame(full.loc[:, ["NAME", "AMP20"]]))
+
+
+@pytest.mark.basic
+@pytest.mark.parametrize("lin_file", (LIN_FILE, COUPLING_LIN_FILE))
+def test_read_lin_file_projection_same_as_tfs(lin_file):
+    full = tfs.read(lin_file).set_index("NAME", drop=False)
+    projected, left_out = _read_lin_file(str(lin_file), set())
+    assert projected.headers == full.headers
+    assert_frame_equal(pd.DataFrame(projected), pd.DataFrame(full.loc[:, projected.columns]))
+    assert len(left_out) and set(projected.columns) | left_out == set(full.columns)
+
+
+@pytest.mark.basic
+def test_projected_lines():
+    opt = DotDict(column_projection=True, nonlinear=[], coupling_method=2)
+    assert projected_lines(opt, "X") == {"AMP01", "PHASE01"}
+    assert projected_lines(opt, "Y") == {"AMP10", "PHASE10"}
+    assert projected_lines(DotDict(opt, coupling_method=0), "X") == set()
+    assert projected_lines(DotDict(opt, nonlinear=["rdt"]), "X") is None
+    assert projected_lines(DotDict(opt, column_projection=False), "X") is None
+
+
+class _ClearedOnStore(dict):
+    """ Cache which is replaced by the one of a cleared ``InputFiles`` as soon as a result is stored. """
+    def __init__(self, input_files):
+        super().__init__()
+        self._input_files = input_files
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._input_files._clear_cache()
+
+
+def _random_frames():
+    rng = np.random.default_rng(1234)
+    names = np.array([f"BPM{i}" for i in range(N_BPMS)])
+    frames = []
+    for _ in range(N_FILES):
+        bpms = names[rng.permutation(N_BPMS)[:N_BPMS - 4]]
+        frames.append(pd.DataFrame({"NAME": bpms, "MUX": rng.random(len(bpms)), "AMPX": rng.random(len(bpms))},
+                                   index=bpms))
+    return frames
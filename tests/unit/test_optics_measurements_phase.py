@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from omc3.optics_measurements.phase import PhaseAdvances
+from omc3.utils import stats
+
+N_BPMS = 40
+N_FILES = 7
+TUNE = 62.31
+
+
+@pytest.mark.basic
+@pytest.mark.parametrize("errors_case", ["weights", "no_errors", "union", "zeros"])
+def test_phase_advances_same_as_circular_stats(errors_case):
+    phases, errors = _random_phases_and_errors(errors_case)
+    phase_advances = _phase_advances(phases, errors, bandwidth=3)
+    rows, columns = np.arange(N_BPMS)[:, np.newaxis], np.arange(N_BPMS)[np.newaxis, :]
+    meas = phase_advances.get("MEAS", rows, columns)
+    err = phase_advances.get("ERRMEAS", rows, columns)
+
+    phases_3d = phases[np.newaxis, :, :] - phases[:, np.newaxis, :]
+    errors_3d = None if errors is None else errors[np.newaxis, :, :] + errors[:, np.newaxis, :]
+    meas_3d = stats.circular_mean(phases_3d, period=1, errors=errors_3d, axis=2) % 1.0
+    err_3d = stats.circular_error(phases_3d, period=1, errors=errors_3d, axis=2)
+
+    assert meas.shape == err.shape == (N_BPMS, N_BPMS)
+    assert np.allclose((meas - meas_3d + 0.5) % 1.0 - 0.5, 0, atol=1e-12)
+    assert np.allclose(err, err_3d, rtol=1e-10, atol=1e-15)
+
+
+@pytest.mark.basic
+def test_phase_advances_single_file():
+    phases, _ = _random_phases_and_errors("no_errors")
+    phase_advances = _phase_advances(phases[:, :1], None)
+    meas = phase_advances.get("MEAS", np.arange(N_BPMS)[:, np.newaxis], np.arange(N_BPMS))
+    err = phase_advances.get("ERRMEAS", np.arange(N_BPMS)[:, np.newaxis], np.arange(N_BPMS))
+    expected = phases[np.newaxis, :, 0] - phases[:, np.newaxis, 0]
+    assert np.allclose((meas - expected + 0.5) % 1.0 - 0.5, 0, atol=1e-12)
+    assert not np.any(err)
+
+
+@pytest.mark.basic
+@pytest.mark.parametrize("kind", ["MEAS", "ERRMEAS", "MODEL"])
+def test_phase_advances_band_wraps_around(kind):
+    phases, errors = _random_phases_and_errors("weights")
+    phase_advances = _phase_advances(phases, errors, bandwidth=2)
+    dense = phase_advances.get(kind, np.arange(N_BPMS)[:, np.newaxis], np.arange(N_BPMS))
+    offsets = np.arange(-4, 5)  # partly outside of the band
+    band = phase_advances.band(kind, offsets, TUNE)
+    for row, offset in enumerate(offsets):
+        columns = np.arange(N_BPMS) + offset
+        expected = dense[np.arange(N_BPMS), columns % N_BPMS]
+        expected[columns >= N_BPMS] += TUNE
+        expected[columns < 0] -= TUNE
+        assert np.allclose(band[row], expected, rtol=0, atol=1e-12)
+
+
+@pytest.mark.basic
+def test_phase_advances_lookup_by_name_and_selection():
+    phases, errors = _random_phases_and_errors("weights")
+    phase_advances = _phase_advances(phases, errors, bandwidth=2)
+    bpms = phase_advances.index[[3, 17, 35, 2]].to_numpy()
+    selected = phase_advances.select(bpms)
+
+    assert list(selected.index) == list(bpms)
+    for kind in ("MEAS", "ERRMEAS", "MODEL"):
+        expected = phase_advances.loc(kind, bpms[:, np.newaxis], bpms[np.newaxis, :])
+        assert np.allclose(selected.loc(kind, bpms[:, np.newaxis], bpms[np.newaxis, :]), expected, atol=1e-14)
+        assert np.allclose(selected.band(kind, [1])[0], expected[np.arange(4), [1, 2, 3, 0]], atol=1e-14)
+    assert np.isscalar(phase_advances.loc("MEAS", bpms[0], bpms[1]))
+    with pytest.raises(KeyError):
+        phase_advances.loc("MEAS", "NOT_A_BPM", bpms[1])
+
+
+def _phase_advances(phases, errors, bandwidth=None):
+    index = pd.Index([f"BPM{i}" for i in range(phases.shape[0])], name="NAME")
+    return PhaseAdvances(index, phases[:, 0], phases, errors, bandwidth=bandwidth)
+
+
+def _random_phases_and_errors(errors_case):
+    rng = np.random.default_rng(2718)
+    phases = np.cumsum(rng.random((N_BPMS, 1)), axis=0) + rng.normal(0, 0.01, (N_BPMS, N_FILES))
+    errors = rng.uniform(1e-3, 1e-2, (N_BPMS, N_FILES))
+    if errors_case == "no_errors":
+        return phases, None
+    if errors_case == "union":
+        # as in union mode, where missing BPMs are given infinite errors
+        mask = rng.random((N_BPMS, N_FILES)) < 0.2
+        mask[:, 0] = False
+        phases[mask], errors[mask] = 0.0, np.inf
+    if errors_case == "zeros":
+        errors[3, 2] = 0.0
+    return phases, errors
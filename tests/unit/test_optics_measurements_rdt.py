@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from scipy.optimize import curve_fit
+
+from omc3.optics_measurements import rdt
+
+RDT = (3, 0, 0, 0)
+N_BPMS = 20
+
+
+@pytest.mark.basic
+@pytest.mark.parametrize("n_files", (2, 3, 7))
+def test_fit_rdt_amplitudes_same_as_curve_fit(n_files):
+    invariants, line_amp = _invariants_and_line_amplitudes(n_files)
+    amps, err_amps = rdt._fit_rdt_amplitudes(invariants, line_amp, "X", RDT)
+
+    kick_data = rdt.get_linearized_problem(invariants, "X", RDT)
+    for i, bpm_rdt_data in enumerate(line_amp):
+        popt, pcov = curve_fit(lambda x, f: f * x, kick_data, bpm_rdt_data, p0=np.mean(bpm_rdt_data / kick_data))
+        assert np.isclose(amps[i], popt[0], rtol=1e-7)
+        assert np.isclose(err_amps[i], np.sqrt(pcov[0, 0]), rtol=1e-3)
+
+
+@pytest.mark.basic
+def test_fit_rdt_amplitudes_single_file():
+    invariants, line_amp = _invariants_and_line_amplitudes(1)
+    amps, err_amps = rdt._fit_rdt_amplitudes(invariants, line_amp, "X", RDT)
+    kick_data = rdt.get_linearized_problem(invariants, "X", RDT)
+    assert np.allclose(amps, line_amp[:, 0] / kick_data[0])
+    assert not np.any(err_amps)
+
+
+@pytest.mark.basic
+def test_fit_rdt_amplitudes_not_finite():
+    invariants, line_amp = _invariants_and_line_amplitudes(3)
+    line_amp[4, 1] = np.nan
+    with pytest.raises(ValueError):
+        rdt._fit_rdt_amplitudes(invariants, line_amp, "X", RDT)
+
+
+def _invariants_and_line_amplitudes(n_files):
+    rng = np.random.default_rng(31415)
+    invariants = {plane: np.column_stack((rng.uniform(1e-4, 1e-3, n_files), np.full(n_files, 1e-6)))
+                  for plane in "XY"}
+    kick_data = rdt.get_linearized_problem(invariants, "X", RDT)
+    amplitudes = rng.uniform(10, 100, N_BPMS)
+    line_amp = amplitudes[:, np.newaxis] * kick_data * rng.normal(1, 0.05, (N_BPMS, n_files))
+    return invariants, line_amp
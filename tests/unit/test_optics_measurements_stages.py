@@ -0,0 +1,54 @@
+import threading
+
+import pytest
+
+from omc3.optics_measurements.measure_optics import Stage, run_stages
+
+
+@pytest.mark.basic
+@pytest.mark.parametrize("num_processes", (1, 3))
+def test_stages_run_after_dependencies(num_processes):
+    done = []
+    lock = threading.Lock()
+
+    def _stage(name):
+        def _run():
+            with lock:
+                done.append(name)
+        return Stage(name, _run, DEPENDENCIES[name])
+
+    run_stages([_stage(name) for name in DEPENDENCIES], num_processes)
+    assert sorted(done) == sorted(DEPENDENCIES)
+    for name, dependencies in DEPENDENCIES.items():
+        assert all(done.index(dependency) < done.index(name) for dependency in dependencies)
+    if num_processes == 1:
+        assert done == list(DEPENDENCIES)
+
+
+@pytest.mark.basic
+@pytest.mark.parametrize("num_processes", (1, 3))
+def test_failing_stage_raises(num_processes):
+    def _fail():
+        raise RuntimeError("Stage failed")
+
+    with pytest.raises(RuntimeError, match="Stage failed"):
+        run_stages([Stage("a", lambda: None), Stage("b", _fail, ("a",)), Stage("c", lambda: None, ("b",))],
+                   num_processes)
+
+
+@pytest.mark.basic
+def test_unknown_dependency_raises():
+    with pytest.raises(ValueError):
+        run_stages([Stage("a", lambda: None, ("b",)), Stage("b", lambda: None)])
+
+
+DEPENDENCIES = {
+    "phase X": (),
+    "optics X": ("phase X",),
+    "phase Y": (),
+    "optics Y": ("phase Y",),
+    "coupling": ("phase X", "optics X", "phase Y", "optics Y"),
+    "rdt": ("coupling",),
+    "crdt": ("coupling",),
+    "chromatic beating": (),
+}
@@ -3,7 +3,9 @@ from pathlib import Path
 import pandas as pd
 import numpy as np
 
-from omc3.correction.response_io import write_fullresponse, read_fullresponse, write_varmap, read_varmap
+from omc3.correction.response_io import (convert_fullresponse, read_fullresponse, read_response_checkpoints,
+                                         read_varmap, write_fullresponse, write_response_checkpoint,
+                                         write_varmap)
 import pytest
 
 
@@ -48,6 +50,39 @@ def test_fullresponse_read_write(tmp_path):
         assert matrix_dict[p].equals(new_matrix_dict[p])
 
 
+@pytest.mark.basic
+@pytest.mark.parametrize("chunked", (True, False))
+def test_fullresponse_read_selection(tmp_path, chunked):
+    response = read_fullresponse(FULLRESPONSE_PATH)
+    out_path = tmp_path / "responsetest.h5"
+    write_fullresponse(out_path, response, chunked=chunked)
+
+    variables = list(response["BETX"].columns[[0, 1, 2, 7, 11, -1]]) + ["NOTAVARIABLE"]
+    bpms = list(response["BETX"].index[::3]) + ["NOTABPM"]
+    selection = read_fullresponse(out_path, optics_parameters=["BETX", "Q"], variables=variables, bpms=bpms)
+    assert len(selection) == 2
+    for key in ("BETX", "Q"):
+        expected = response[key].loc[response[key].index.isin(bpms), response[key].columns.isin(variables)]
+        assert selection[key].equals(expected)
+        assert list(selection[key].columns) == list(expected.columns)
+        assert list(selection[key].index) == list(expected.index)
+    assert selection["Q"].empty
+
+
+@pytest.mark.basic
+def test_fullresponse_convert(tmp_path):
+    out_path = tmp_path / "responsetest.h5"
+    write_fullresponse(out_path, read_fullresponse(FULLRESPONSE_PATH), chunked=False)
+    write_response_checkpoint(out_path, "batch0", pd.DataFrame(np.random.random([4, 3])))
+    convert_fullresponse(out_path)
+
+    assert not len(read_response_checkpoints(out_path))
+    response, converted = read_fullresponse(FULLRESPONSE_PATH), read_fullresponse(out_path)
+    assert response.keys() == converted.keys()
+    for key in response:
+        pd.testing.assert_frame_equal(converted[key], response[key])
+
+
 @pytest.mark.basic
 def test_fullresponse_read_fail():
     with pytest.raises(IOError):
@@ -0,0 +1,170 @@
+import re
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+import tfs
+
+from omc3.correction import response_madx
+from omc3.correction.response_io import CHECKPOINT, read_response_checkpoints
+from omc3.model.accelerators.accelerator import AccElementTypes
+
+VARIABLES = [f"kq.{idx}" for idx in range(7)]
+N_BPMS = 12
+DELTA_K = 2e-5
+RUNS_FILE = "runs.txt"
+
+
+@pytest.mark.basic
+def test_batches_same_as_single_job(tmp_path, fake_madx):
+    single = response_madx.create_fullresponse(_Accelerator(tmp_path), [], delta_k=DELTA_K,
+                                               num_proc=1, batch_size=len(VARIABLES) + 1)
+    batched = response_madx.create_fullresponse(_Accelerator(tmp_path), [], delta_k=DELTA_K,
+                                                num_proc=2, batch_size=2)
+    assert single.keys() == batched.keys()
+    for key in single:
+        assert list(batched[key].columns) == VARIABLES
+        pd.testing.assert_frame_equal(batched[key], single[key])
+    assert not list(tmp_path.glob("job.iterate.*"))
+    assert not list(tmp_path.glob("twiss.*"))
+
+
+@pytest.mark.basic
+def test_resume_from_checkpoints(tmp_path, fake_madx, monkeypatch):
+    expected = response_madx.create_fullresponse(_Accelerator(tmp_path), [], delta_k=DELTA_K, num_proc=1)
+    checkpoint_path = tmp_path / "fullresponse.h5"
+    runs_path = tmp_path / RUNS_FILE
+    runs_path.unlink()
+
+    # interrupted in the third batch
+    monkeypatch.setitem(_FAILING, "variable", VARIABLES[4])
+    with pytest.raises(RuntimeError):
+        response_madx.create_fullresponse(_Accelerator(tmp_path), [], delta_k=DELTA_K, num_proc=1,
+                                          batch_size=2, checkpoint_path=checkpoint_path)
+    assert len(read_response_checkpoints(checkpoint_path)) == 3  # two batches and the fingerprint
+
+    with pytest.raises(ValueError, match="delta_k"):
+        response_madx.create_fullresponse(_Accelerator(tmp_path), [], delta_k=2 * DELTA_K, num_proc=1,
+                                          checkpoint_path=checkpoint_path)
+    other_variables, other_optics, other_model = (_Accelerator(tmp_path), _Accelerator(tmp_path),
+                                                  _Accelerator(tmp_path / "other"))
+    other_variables.get_variables = lambda classes=None: VARIABLES[1:]
+    other_optics.get_base_madx_script = lambda: "! other optics\n"
+    for accel_inst in (other_variables, other_optics, other_model):
+        with pytest.raises(ValueError, match="different model"):
+            response_madx.create_fullresponse(accel_inst, [], delta_k=DELTA_K, num_proc=1,
+                                              checkpoint_path=checkpoint_path)
+
+    # resume, only the missing variables are run
+    monkeypatch.setitem(_FAILING, "variable", None)
+    runs_path.unlink()
+    resumed = response_madx.create_fullresponse(_Accelerator(tmp_path), [], delta_k=DELTA_K, num_proc=1,
+                                                batch_size=2, checkpoint_path=checkpoint_path)
+    assert runs_path.read_text().split() == VARIABLES[3:]
+    for key in expected:
+        pd.testing.assert_frame_equal(resumed[key], expected[key])
+
+
+@pytest.mark.basic
+def test_read_twiss_same_as_tfs(tmp_path):
+    twiss = _get_twiss(np.zeros(len(VARIABLES)))
+    twiss["S"] = np.arange(N_BPMS) * 10.0
+    twiss["KEYWORD"] = "MONITOR"
+    twiss_path = tmp_path / "twiss.dat"
+    tfs.write(twiss_path, twiss, save_index="NAME")
+
+    read = response_madx._read_twiss(twiss_path)
+    expected = tfs.read(twiss_path, index="NAME")
+    assert set(read.columns) == set(response_madx.TWISS_COLUMNS[1:] + ["Q1", "Q2"])
+    assert (read.dtypes == np.float64).all()
+    pd.testing.assert_frame_equal(read.loc[:, response_madx.TWISS_COLUMNS[1:]],
+                                  pd.DataFrame(expected.loc[:, response_madx.TWISS_COLUMNS[1:]]))
+    assert (read["Q1"] == expected.Q1).all() and (read["Q2"] == expected.Q2).all()
+
+
+@pytest.mark.basic
+def test_resume_from_checkpoints_finished_out_of_order(tmp_path, fake_madx):
+    checkpoint_path = tmp_path / "fullresponse.h5"
+    expected = response_madx.create_fullresponse(_Accelerator(tmp_path), [], delta_k=DELTA_K, num_proc=1,
+                                                 batch_size=1, checkpoint_path=checkpoint_path)
+
+    # only the batches 1 and 4 (of 0-7) finished
+    with pd.HDFStore(checkpoint_path, mode="a") as store:
+        for index in (0, 2, 3, 5, 6, 7):
+            store.remove(f"{CHECKPOINT}/{response_madx.BATCH}{index}")
+    finished = read_response_checkpoints(checkpoint_path)
+
+    resumed = response_madx.create_fullresponse(_Accelerator(tmp_path), [], delta_k=DELTA_K, num_proc=1,
+                                                batch_size=1, checkpoint_path=checkpoint_path)
+    for key in expected:
+        pd.testing.assert_frame_equal(resumed[key], expected[key])
+
+    checkpoints = read_response_checkpoints(checkpoint_path)
+    for name, batch_results in finished.items():
+        pd.testing.assert_frame_equal(checkpoints[name], batch_results)
+    checkpoints.pop(response_madx.FINGERPRINT)
+    variables = {var for batch_results in checkpoints.values() for var in batch_results.index.unique(level=0)}
+    assert variables == set(VARIABLES) | {response_madx.NOMINAL}
+
+
+# Helper -----------------------------------------------------------------------
+
+_FAILING = {"variable": None}  # variable for which the fake MAD-X run fails
+
+
+@pytest.fixture
+def fake_madx(monkeypatch):
+    """ Replaces the MAD-X runs by twiss outputs linear in the variables. """
+    monkeypatch.setattr(response_madx.madx_wrapper, "run_file", _fake_run_file)
+
+
+class _Accelerator:
+    """ Provides the parts of the accelerator class used in create_fullresponse. """
+    RE_DICT = {AccElementTypes.BPMS: r"^BPM"}
+
+    def __init__(self, model_dir):
+        self.model_dir = model_dir
+
+    @staticmethod
+    def get_variables(classes=None):
+        return VARIABLES
+
+    @staticmethod
+    def get_base_madx_script():
+        return "! base script\n"
+
+
+def _fake_run_file(input_file: Path, log_file: Path = None, cwd: Path = None, **kwargs):
+    strengths = dict.fromkeys(VARIABLES, 0.0)
+    for line in input_file.read_text().splitlines():
+        change = re.match(r"^(\S+) = \1([+-]\S+);$", line)
+        if change:
+            strengths[change.group(1)] += float(change.group(2))
+            continue
+
+        twiss = re.match(r"^twiss, file='(\S+)';$", line)
+        if twiss:
+            twiss_path = Path(twiss.group(1))
+            variable = twiss_path.name[len("twiss."):]
+            if variable == _FAILING["variable"]:
+                raise RuntimeError(f"MAD-X failed for {variable}.")
+            if variable != response_madx.NOMINAL:
+                with open(twiss_path.parent / RUNS_FILE, "a") as runs:
+                    runs.write(f"{variable}\n")
+            tfs.write(twiss_path, _get_twiss(np.array(list(strengths.values()))), save_index="NAME")
+    log_file.write_text(f"ran {input_file.name}\n")
+
+
+def _get_twiss(strengths: np.ndarray) -> tfs.TfsDataFrame:
+    rng = np.random.default_rng(42)
+    coefficients = rng.uniform(-1, 1, (10, N_BPMS, len(strengths)))
+    change = coefficients @ strengths
+    twiss = tfs.TfsDataFrame(index=pd.Index([f"BPM.{idx}" for idx in range(N_BPMS)], name="NAME"),
+                             headers={"Q1": 0.28 + change[0, 0], "Q2": 0.31 + change[1, 0]})
+    for idx, column in enumerate(("BETX", "BETY", "ALFX", "ALFY", "MUX", "MUY", "DX", "DY")):
+        base = 100.0 if column.startswith("BET") else 1.0
+        twiss[column] = base + np.arange(N_BPMS) + 50 * change[idx]
+    for idx, column in enumerate(("R11", "R12", "R21", "R22"), start=6):
+        twiss[column] = 1e-3 + change[idx]
+    return twiss
@@ -0,0 +1,112 @@
+import copy
+
+import numpy as np
+import pandas as pd
+import pytest
+import tfs
+
+from omc3.correction import response_twiss
+from omc3.correction.response_twiss import TwissResponse
+from omc3.optics_measurements.constants import BETA, DISPERSION, PHASE_ADV, S
+
+N_SECTIONS = 30
+VARMAP = {
+    "K0L": {},
+    "K0SL": {},
+    "K1L": {
+        "kq.a": pd.Series([1.0, -1.0], index=["mq.1", "mq.4"]),
+        "kq.b": pd.Series([0.5, 0.5, 2.0], index=["mq.7", "mq.12", "mq.1"]),
+        "kq.c": pd.Series([1.0], index=["mq.20"]),
+    },
+    "K1SL": {
+        "ks.a": pd.Series([1.0, 1.0], index=["mqs.3", "mqs.25"]),
+    },
+}
+OBSERVABLES = ["Q", "BETX", "BETY", "PHASEX", "PHASEY", "DX", "DY", "NDX",
+               "F1001R", "F1001I", "F1010R", "F1010I"]
+
+
+@pytest.mark.basic
+def test_update_model_same_as_new_response():
+    twiss_response = TwissResponse(_Accelerator(_get_model(seed=1)), [], copy.deepcopy(VARMAP))
+    twiss_response.get_response_for(OBSERVABLES)
+
+    accel_updated = _Accelerator(_get_model(seed=2))
+    twiss_response.update_model(accel_updated)
+    updated = twiss_response.get_response_for(OBSERVABLES)
+    expected = TwissResponse(accel_updated, [], copy.deepcopy(VARMAP)).get_response_for(OBSERVABLES)
+
+    assert updated.keys() == expected.keys()
+    for key in expected:
+        pd.testing.assert_frame_equal(updated[key], expected[key])
+
+
+@pytest.mark.basic
+def test_float32_close_to_float64():
+    accel_inst = _Accelerator(_get_model(seed=1))
+    response = TwissResponse(accel_inst, [], copy.deepcopy(VARMAP)).get_response_for(OBSERVABLES)
+    response_32 = TwissResponse(accel_inst, [], copy.deepcopy(VARMAP), float32=True).get_response_for(OBSERVABLES)
+
+    for key in response:
+        assert (response_32[key].dtypes == np.float64).all()
+        scale = np.abs(response[key].to_numpy()).max()
+        assert np.allclose(response_32[key], response[key], rtol=0, atol=1e-4 * scale)
+
+
+@pytest.mark.basic
+def test_create_response_forwards_float32(monkeypatch):
+    monkeypatch.setattr(response_twiss, "check_varmap_file", lambda accel_inst, categories: copy.deepcopy(VARMAP))
+    accel_inst = _Accelerator(_get_model(seed=1))
+    assert response_twiss.create_twiss_response(accel_inst, [], float32=True)._dtype == np.float32
+    response_32 = response_twiss.create_response(accel_inst, [], OBSERVABLES, float32=True)
+    expected = TwissResponse(accel_inst, [], copy.deepcopy(VARMAP), float32=True).get_response_for(OBSERVABLES)
+    for key in expected:
+        pd.testing.assert_frame_equal(response_32[key], expected[key])
+
+
+@pytest.mark.basic
+def test_mapping_to_variables():
+    twiss_response = TwissResponse(_Accelerator(_get_model(seed=1)), [], copy.deepcopy(VARMAP))
+    beta_beat = twiss_response.get_beta_beat(mapped=False)
+    beta_beat_mapped = twiss_response.get_beta_beat(mapped=True)
+
+    for plane in beta_beat:
+        assert list(beta_beat_mapped[plane].columns) == list(VARMAP["K1L"].keys())
+        for var, magnets in VARMAP["K1L"].items():
+            expected = sum(beta_beat[plane][magnet.upper()] * value for magnet, value in magnets.items())
+            assert np.allclose(beta_beat_mapped[plane][var], expected, rtol=1e-14, atol=0)
+
+
+# Helper -----------------------------------------------------------------------
+
+
+class _Accelerator:
+    """ Provides the parts of the accelerator class used in TwissResponse. """
+    beam = 1
+
+    def __init__(self, elements):
+        self.elements = elements
+
+    @staticmethod
+    def get_variables(classes=None):
+        return [var for order in VARMAP.values() for var in order]
+
+    @staticmethod
+    def get_element_types_mask(list_of_elements, types):
+        return np.ones(len(list_of_elements), dtype=bool)
+
+
+def _get_model(seed):
+    """ Sections of BPM, quadrupole and skew quadrupole with random optics. """
+    rng = np.random.default_rng(seed)
+    names = [name for idx in range(N_SECTIONS) for name in (f"BPM.{idx}.B1", f"MQ.{idx}", f"MQS.{idx}")]
+    n_elements = len(names)
+    model = tfs.TfsDataFrame(index=names, headers={"Q1": 62.28 + rng.uniform(-0.01, 0.01),
+                                                   "Q2": 60.31 + rng.uniform(-0.01, 0.01)})
+    model[S] = np.arange(n_elements) * 10.0
+    for plane, tune in zip("XY", ("Q1", "Q2")):
+        phase_steps = rng.uniform(0.5, 1.5, n_elements)
+        model[f"{PHASE_ADV}{plane}"] = np.cumsum(phase_steps) * model.headers[tune] / phase_steps.sum()
+        model[f"{BETA}{plane}"] = rng.uniform(20, 180, n_elements)
+        model[f"{DISPERSION}{plane}"] = rng.uniform(-1, 2, n_elements)
+    return model
@@ -5,6 +5,11 @@ import pytest
 from omc3.tune_analysis.bbq_tools import get_moving_average, clean_outliers_moving_average, MinMaxFilterOpt, \
     OutlierFilterOpt
 from omc3.tune_analysis.fitting_tools import get_poly_fun
+from omc3.utils import logging_tools
+from omc3.utils.contexts import timeit
+from omc3.utils.outliers import get_filter_mask, get_moving_filter_mask
+
+LOG = logging_tools.get_logger(__name__)
 
 
 @pytest.mark.basic
@@ -51,9 +56,60 @@ def test_clean_outliers_moving_average():
     # _plot_helper(sin_data, data, mav)
 
 
+@pytest.mark.basic
+@pytest.mark.parametrize("window, limit", ((5, 0), (20, 0), (20, 0.5), (200, 0), (1000, 0)))
+def test_moving_filter_mask_same_as_filter_per_window(window, limit):
+    data, mask = _get_bbq_like_data(3000, seed=window)
+    assert np.array_equal(get_moving_filter_mask(data, window, limit=limit, mask=mask),
+                          _moving_filter_mask_per_window(data, window, limit, mask))
+
+
+@pytest.mark.basic
+def test_moving_filter_mask_short_data():
+    data, mask = _get_bbq_like_data(10, seed=1)
+    assert np.array_equal(get_moving_filter_mask(data, 10, mask=mask), mask)
+    assert np.array_equal(get_moving_filter_mask(data, 9, mask=mask), _moving_filter_mask_per_window(data, 9, 0, mask))
+
+
+@pytest.mark.extended
+def test_clean_outliers_moving_average_benchmark():
+    """ Benchmarks the outlier cleaning on a BBQ-like series of the length of a full fill,
+    and checks the first part against the filter per window. """
+    n_samples, window = 1_000_000, 200
+    data, mask = _get_bbq_like_data(n_samples, seed=2022)
+    data_series = pd.Series(np.where(mask, data, np.nan))
+    with timeit(lambda spanned: LOG.info(f"Time for cleaning {n_samples} samples "
+                                         f"with window {window}: {spanned}")):
+        _, _, cleaned_mask = clean_outliers_moving_average(data_series, OutlierFilterOpt(window=window, limit=0))
+
+    n_check = 5000
+    expected = _moving_filter_mask_per_window(data[:n_check], window, 0, mask[:n_check])
+    # the last points of the excerpt are part of more windows in the full series
+    assert np.array_equal(cleaned_mask.to_numpy()[:n_check - window], expected[:n_check - window])
+
+
 # Helper -----------------------------------------------------------------------
 
 
+def _moving_filter_mask_per_window(data, window, limit, mask):
+    """ The moving filter as a loop over the windows. """
+    result = mask.copy()
+    for i in range(len(data) - window):
+        result[i:i + window] &= get_filter_mask(data[i:i + window], limit=limit, mask=mask[i:i + window])
+    return result
+
+
+def _get_bbq_like_data(n_samples, seed):
+    """ Tune-like data with noise, a drift, some spikes and NaNs. """
+    rng = np.random.default_rng(seed)
+    data = 0.31 + 1e-3 * np.sin(np.linspace(0, 20, n_samples)) + rng.normal(0, 2e-4, n_samples)
+    spikes = rng.random(n_samples) < 0.02
+    data[spikes] += rng.normal(0, 5e-3, np.sum(spikes))
+    mask = rng.random(n_samples) > 0.05
+    data[~mask] = np.nan
+    return data, mask
+
+
 def _plot_helper(*series):
     ax = series[0].plot()
     if len(series) > 1: